@@ -5,6 +5,73 @@ import os
 
 app = Flask(__name__)
 app.config['DATABASE_URL'] = os.environ['DATABASE_URL']
+# Routing engine: 'pgrouting' (pgr_dijkstra per request) or 'memory' (graph
+# loaded once at startup, searched in-process)
+app.config['ROUTING_ENGINE'] = os.environ.get('ROUTING_ENGINE', 'pgrouting')
+# Graph file exported with `python -m accessmapapi.routing.graphfile` for the
+# memory engine to map instead of reading the graph from the database
+app.config['GRAPH_FILE'] = os.environ.get('GRAPH_FILE')
+# Number of per-profile edge cost arrays the in-memory engine keeps around
+app.config['COST_CACHE_SIZE'] = int(os.environ.get('COST_CACHE_SIZE', 8))
+# Routing worker pool (see workers.py): route, travelcost and matrix
+# computations run on ROUTING_WORKERS threads (0 to run them inline), with
+# up to ROUTING_QUEUE_SIZE waiting. Requests beyond that get a 503, with a
+# Retry-After of ROUTING_RETRY_AFTER seconds.
+app.config['ROUTING_WORKERS'] = int(os.environ.get('ROUTING_WORKERS', 0))
+app.config['ROUTING_QUEUE_SIZE'] = int(os.environ.get('ROUTING_QUEUE_SIZE',
+                                                      16))
+app.config['ROUTING_RETRY_AFTER'] = int(os.environ.get('ROUTING_RETRY_AFTER',
+                                                       1))
+# Threads running the pgr_dijkstra queries of multi-waypoint routes, shared
+# by all requests
+app.config['ROUTE_LEG_WORKERS'] = int(os.environ.get('ROUTE_LEG_WORKERS', 4))
+# Most routes accepted by one /v2/routes/batch request
+app.config['ROUTE_BATCH_SIZE'] = int(os.environ.get('ROUTE_BATCH_SIZE',
+                                                    10000))
+# Most cells (sources x destinations) of one cost matrix
+app.config['MATRIX_MAX_SIZE'] = int(os.environ.get('MATRIX_MAX_SIZE',
+                                                   250000))
+# Cost matrices with more cells than this are streamed one row at a time
+app.config['MATRIX_STREAM_SIZE'] = int(os.environ.get('MATRIX_STREAM_SIZE',
+                                                      10000))
+# Vector tiles: below TILE_MIN_ZOOM tiles are empty, rendered tiles are kept
+# in TILE_CACHE_DIR (default: a directory in the system temp directory) and
+# clients may cache them for TILE_MAX_AGE seconds
+app.config['TILE_MIN_ZOOM'] = int(os.environ.get('TILE_MIN_ZOOM', 12))
+app.config['TILE_CACHE_DIR'] = os.environ.get('TILE_CACHE_DIR')
+app.config['TILE_MAX_AGE'] = int(os.environ.get('TILE_MAX_AGE', 3600))
+# Statement timeouts (milliseconds) for each kind of endpoint
+app.config['STATEMENT_TIMEOUT_ROUTING'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_ROUTING', 20000))
+app.config['STATEMENT_TIMEOUT_LAYERS'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_LAYERS', 30000))
+app.config['STATEMENT_TIMEOUT_TILES'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_TILES', 5000))
+# Route and travelcost result cache: RESULT_CACHE is 'memory' (per process),
+# 'sqlite' (a file at RESULT_CACHE_PATH shared by the worker processes,
+# default: in the system temp directory) or 'none'. Entries expire after
+# RESULT_CACHE_TTL seconds (0 for never).
+app.config['RESULT_CACHE'] = os.environ.get('RESULT_CACHE', 'memory')
+app.config['RESULT_CACHE_SIZE'] = int(os.environ.get('RESULT_CACHE_SIZE',
+                                                     4096))
+app.config['RESULT_CACHE_TTL'] = int(os.environ.get('RESULT_CACHE_TTL',
+                                                    86400))
+app.config['RESULT_CACHE_PATH'] = os.environ.get('RESULT_CACHE_PATH')
+# Reloading the routing data (see snapshot.py): POST /admin/reload with an
+# `Authorization: Bearer <ADMIN_TOKEN>` header (the admin endpoints are off
+# without a token), or touch the RELOAD_TRIGGER file - checked at most every
+# RELOAD_TRIGGER_INTERVAL seconds.
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+app.config['RELOAD_TRIGGER'] = os.environ.get('RELOAD_TRIGGER')
+app.config['RELOAD_TRIGGER_INTERVAL'] = float(
+    os.environ.get('RELOAD_TRIGGER_INTERVAL', 1))
+# Seconds a reload waits for the requests still using the data retired by the
+# previous reload, before giving up
+app.config['RELOAD_DRAIN_TIMEOUT'] = float(
+    os.environ.get('RELOAD_DRAIN_TIMEOUT', 300))
+# Send per-stage request timings back in a Server-Timing header
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING',
+                                             'false') == 'true'
 # To get debugging messages:
 app.config['PROPAGATE_EXCEPTIONS'] = True
 
@@ -16,8 +83,25 @@ def after_request(response):
     response.headers.add("Access-Control-Allow-Origin", "*")
     response.headers.add("Access-Control-Allow-Headers",
                          "Content-Type,Authorization")
-    response.headers.add("Access-Control-Allow-Methods", "GET")
+    response.headers.add("Access-Control-Allow-Methods", "GET, POST")
 
     return response
 
+
+import accessmapapi.timing
 import accessmapapi.views
+from accessmapapi import db, snapshot
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    # Return the session's connection to the pool after every request
+    db.session.remove()
+
+
+@app.before_first_request
+def load_routing_graph():
+    try:
+        snapshot.latest()
+    except Exception:
+        app.logger.exception('Could not load the routing graph.')
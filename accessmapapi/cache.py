@@ -0,0 +1,191 @@
+'''Small caches shared by the API.'''
+import collections
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+
+class LRUCache(object):
+    '''A thread-safe mapping that holds at most `maxsize` entries, evicting
+    the least recently used one when full.
+
+    :param maxsize: Maximum number of entries.
+    :type maxsize: int
+    :param ttl: Seconds after which entries expire, or None to keep them
+                until evicted.
+    :type ttl: float
+
+    '''
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        '''Return the cached value for `key`, calling `compute()` and caching
+        its result on a miss.'''
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache(object):
+    '''An LRUCache stored in a SQLite database file, so that it can be shared
+    by several worker processes on one machine. Keys and values must be
+    JSON-serializable, and values come back as their JSON round trip (e.g.
+    tuples as lists). Hit and miss counts are per process.
+
+    :param path: Path of the database file.
+    :type path: str
+    :param maxsize: Maximum number of entries.
+    :type maxsize: int
+    :param ttl: Seconds after which entries expire, or None to keep them
+                until evicted.
+    :type ttl: float
+
+    '''
+    def __init__(self, path, maxsize=128, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # SQLite connections can't be shared between threads
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY,
+                                value TEXT NOT NULL,
+                                expires REAL,
+                                used REAL NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_used '
+                         'ON cache (used)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def get(self, key, default=None):
+        key = json.dumps(key)
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT value, expires FROM cache '
+                               'WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return default
+            conn.execute('UPDATE cache SET used = ? WHERE key = ?',
+                         (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                         (json.dumps(key), json.dumps(value), expires, now))
+            conn.execute('''DELETE FROM cache
+                             WHERE key IN (SELECT key
+                                             FROM cache
+                                         ORDER BY used DESC
+                                            LIMIT -1 OFFSET ?)''',
+                         (self.maxsize,))
+
+    def get_or_compute(self, key, compute):
+        '''Return the cached value for `key`, calling `compute()` and caching
+        its result on a miss.'''
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache')
+
+
+# Data versioning: every cache of database-derived data keys on (or is
+# cleared by) the data version, which changes whenever the data is reloaded.
+# The startup time is part of the version so it never repeats across runs.
+_started = int(time.time())
+_version = {'counter': 0,
+            'modified': datetime.datetime.utcnow().replace(microsecond=0)}
+_version_lock = threading.Lock()
+_invalidate_callbacks = []
+
+
+def data_version():
+    '''An opaque token identifying the current version of the data.'''
+    return '{:x}-{}'.format(_started, _version['counter'])
+
+
+def data_modified():
+    '''When the current version of the data was loaded (UTC).'''
+    return _version['modified']
+
+
+def on_invalidate(callback):
+    '''Register a function to call (with no arguments) whenever the data
+    version changes. Can be used as a decorator.'''
+    _invalidate_callbacks.append(callback)
+    return callback
+
+
+def invalidate():
+    '''Move to a new data version, e.g. after the database has been reloaded,
+    and drop everything cached for the old one.'''
+    with _version_lock:
+        _version['counter'] += 1
+        _version['modified'] = (datetime.datetime.utcnow()
+                                .replace(microsecond=0))
+    for callback in _invalidate_callbacks:
+        callback()
@@ -1,12 +1,169 @@
+import contextlib
 import os
+import threading
+import time
 import sqlalchemy as sa
+from sqlalchemy import event, exc
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 
-engine = sa.create_engine(os.environ['DATABASE_URL'], convert_unicode=True)
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool that records how long callers wait for a connection.'''
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait = time.time() - start
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+
+engine = sa.create_engine(os.environ['DATABASE_URL'], convert_unicode=True,
+                          poolclass=TimedQueuePool,
+                          pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+                          max_overflow=int(os.environ.get('DB_MAX_OVERFLOW',
+                                                          10)),
+                          pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT',
+                                                          30)),
+                          pool_recycle=int(os.environ.get('DB_POOL_RECYCLE',
+                                                          3600)))
 #                           echo=True)
 session = scoped_session(sessionmaker(autocommit=False,
                                       autoflush=False,
                                       bind=engine))
 PublicBase = declarative_base(metadata=sa.MetaData(schema='public'))
 PublicBase.query = session.query_property()
+
+
+# Statement timeouts: each thread can ask for a different timeout (in
+# milliseconds, 0 for none) using `statement_timeout`. It is applied to
+# connections as they are checked out of the pool.
+DEFAULT_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+_local = threading.local()
+
+
+def current_statement_timeout():
+    '''The statement timeout requested by the current thread.'''
+    return getattr(_local, 'statement_timeout', DEFAULT_STATEMENT_TIMEOUT)
+
+
+@contextlib.contextmanager
+def statement_timeout(milliseconds):
+    '''Run the database statements of a block with a different timeout.
+
+    :param milliseconds: Timeout, or 0 for no timeout.
+    :type milliseconds: int
+
+    '''
+    previous = current_statement_timeout()
+    _local.statement_timeout = int(milliseconds)
+    try:
+        yield
+    finally:
+        _local.statement_timeout = previous
+
+
+# Test connections as they are checked out, so that a connection the
+# database has dropped (e.g. after a restart) is replaced instead of failing
+# the request that happens to get it.
+PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true') == 'true'
+
+
+@event.listens_for(engine, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    timeout = current_statement_timeout()
+    set_timeout = connection_record.info.get('statement_timeout') != timeout
+    if not (set_timeout or PRE_PING):
+        return
+
+    cursor = dbapi_connection.cursor()
+    try:
+        if set_timeout:
+            cursor.execute('SET statement_timeout = %s', (timeout,))
+            # SET is transactional, so it would be undone by the pool's
+            # rollback
+            dbapi_connection.commit()
+            connection_record.info['statement_timeout'] = timeout
+        else:
+            cursor.execute('SELECT 1')
+            dbapi_connection.rollback()
+    except Exception:
+        # The pool discards this connection and tries another one
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class PreparedStatement(object):
+    '''A query that PostgreSQL parses and plans once per connection, then
+    runs with bound parameters - instead of a new statement for every
+    request. The statement is PREPAREd the first time it is used on each
+    pooled connection.
+
+    :param name: Name of the prepared statement (unique per application).
+    :type name: str
+    :param params: (name, PostgreSQL type) of each parameter, in order. The
+                   query refers to them as $1, $2...
+    :type params: list of tuples
+    :param sql: The query.
+    :type sql: str
+
+    '''
+    def __init__(self, name, params, sql):
+        self.name = name
+        self.param_names = [param[0] for param in params]
+        self._prepare = sa.text('PREPARE {} ({}) AS {}'.format(
+            name, ', '.join(param[1] for param in params), sql))
+        self._execute = sa.text('EXECUTE {} ({})'.format(
+            name, ', '.join(':' + param[0] for param in params)))
+
+    def execute(self, **values):
+        '''Run the statement.
+
+        :param values: Value of every parameter, by name.
+        :returns: list of result rows.
+
+        '''
+        with engine.connect() as conn:
+            prepared = conn.info.setdefault('prepared', set())
+            if self.name not in prepared:
+                conn.execute(self._prepare)
+                prepared.add(self.name)
+            result = conn.execute(self._execute,
+                                  **dict((name, values[name])
+                                         for name in self.param_names))
+            rows = list(result)
+            result.close()
+        return rows
+
+
+def pool_metrics():
+    '''Current state of the connection pool, plus checkout wait statistics
+    since startup.'''
+    pool = engine.pool
+    with pool.stats_lock:
+        return {'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'wait_seconds_total': pool.wait_total,
+                'wait_seconds_max': pool.wait_max}
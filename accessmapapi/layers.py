@@ -0,0 +1,193 @@
+'''Serving the GeoJSON data layers.
+
+Layers are written straight from the `ST_AsGeoJSON` text of each row into
+the response, a chunk at a time, reading rows from a server-side cursor - so
+memory use stays flat however many features are returned.
+
+The full-city layers (e.g. `/v2/sidewalks.geojson?all=true`) are also cached:
+the serialized response body is kept per layer in the data snapshot (see
+snapshot.py), and served with ETag and Last-Modified headers so that clients
+can revalidate with a conditional GET instead of downloading the whole layer
+again. Layers in use are built again for the new snapshot when the data is
+reloaded, before it is swapped in.
+
+Layer requests can ask for generalized geometries (see `generalization`):
+simplified for a map zoom level and with fewer decimals, in the database,
+so that zoomed-out requests send and serialize a fraction of the vertices.'''
+import hashlib
+import json
+import math
+import threading
+
+from flask import Response, request, stream_with_context
+
+from accessmapapi import app, db, snapshot, timing
+
+
+# Rows fetched per round trip from the server-side cursor
+YIELD_PER = 1000
+# Approximate size of each chunk of the response body, in characters
+CHUNK_SIZE = 65536
+# Decimals of the layers' coordinates when not generalized (about 1 cm)
+PRECISION = 7
+# Highest zoom level of the `zoom` parameter, as for tiles
+MAX_ZOOM = 22
+
+
+def generalization(args):
+    '''Validate the geometry generalization query parameters of a layer
+    request:
+
+        zoom: web map zoom level the layer is shown at. Lines are simplified
+              to half a (256 px tile) pixel at that zoom.
+        tolerance: simplify lines to within this distance instead, in
+                   degrees.
+        precision: number of decimals of the coordinates, 0 to 7. By default
+                   just enough to stay well within the tolerance, or 7
+                   without simplification.
+
+    :param args: The request's query parameters.
+    :type args: dict
+    :returns: (tolerance, precision) for sql_utils.geojson.
+    :raises ValueError: with a message for the client, if a parameter is
+                        invalid.
+
+    '''
+    tolerance = 0.0
+    if 'zoom' in args:
+        try:
+            zoom = int(args['zoom'])
+            if not 0 <= zoom <= MAX_ZOOM:
+                raise ValueError
+        except ValueError:
+            raise ValueError('zoom must be an integer from 0 to {}.'.format(
+                MAX_ZOOM))
+        tolerance = 360.0 / (256 * 2 ** zoom) / 2
+    if 'tolerance' in args:
+        try:
+            tolerance = float(args['tolerance'])
+            if not 0 <= tolerance < 1:
+                raise ValueError
+        except ValueError:
+            raise ValueError('tolerance must be a number of degrees, at least '
+                             '0 and below 1.')
+
+    if 'precision' in args:
+        try:
+            precision = int(args['precision'])
+            if not 0 <= precision <= PRECISION:
+                raise ValueError
+        except ValueError:
+            raise ValueError('precision must be an integer from 0 to '
+                             '{}.'.format(PRECISION))
+    elif tolerance > 0:
+        # Rounding moves vertices by at most half the tolerance
+        precision = min(int(math.ceil(-math.log10(tolerance))), PRECISION)
+    else:
+        precision = PRECISION
+    return tolerance, precision
+
+
+def features(select, properties):
+    '''Generate the text of a GeoJSON FeatureCollection in chunks.
+
+    :param select: SQLAlchemy query whose rows have the feature geometry as
+                   GeoJSON text in a `geom` column (NULL for features
+                   without a geometry).
+    :type select: sqlalchemy.orm.Query
+    :param properties: Function returning the properties dict of a row.
+    :type properties: callable
+
+    '''
+    with db.statement_timeout(app.config['STATEMENT_TIMEOUT_LAYERS']), \
+            timing.stage('features'):
+        rows = select.yield_per(YIELD_PER).execution_options(
+            stream_results=True)
+
+        chunk = ['{"type":"FeatureCollection","features":[']
+        size = 0
+        separator = ''
+        for row in rows:
+            fragment = ''.join([separator,
+                                '{"type":"Feature","geometry":',
+                                'null' if row.geom is None else row.geom,
+                                ',"properties":',
+                                json.dumps(properties(row)),
+                                '}'])
+            separator = ','
+            chunk.append(fragment)
+            size += len(fragment)
+            if size >= CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append(']}')
+        yield ''.join(chunk)
+
+
+def streaming_response(select, properties):
+    '''Stream a GeoJSON FeatureCollection response (see `features`).'''
+    return Response(stream_with_context(features(select, properties)),
+                    mimetype='application/json')
+
+
+def features_bytes(select, properties):
+    '''Serialize a whole GeoJSON FeatureCollection (see `features`), e.g. for
+    `cached_response`.'''
+    return ''.join(features(select, properties)).encode('utf-8')
+
+
+class _Entry(object):
+    def __init__(self, body, modified):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.modified = modified
+
+
+# Build function of every layer served so far, by name
+_builders = {}
+_build_lock = threading.Lock()
+
+
+def cached_response(name, build, mimetype='application/json'):
+    '''Respond with a cached layer, building it first if needed. Conditional
+    requests (If-None-Match / If-Modified-Since) get a 304 when the client's
+    copy is still current.
+
+    :param name: Name of the layer, e.g. 'sidewalks'.
+    :type name: str
+    :param build: Function returning the serialized layer as bytes.
+    :type build: callable
+    :param mimetype: The response mimetype.
+    :type mimetype: str
+
+    '''
+    _builders[name] = build
+    current = snapshot.current()
+    entry = current.layers.get(name)
+    if entry is None:
+        # One build at a time - concurrent requests wait for it rather than
+        # all running the full-table query.
+        with _build_lock:
+            entry = current.layers.get(name)
+            if entry is None:
+                with timing.stage('build_layer'):
+                    entry = _Entry(build(), current.loaded)
+                current.layers[name] = entry
+
+    response = Response(entry.body, mimetype=mimetype)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.modified
+    return response.make_conditional(request)
+
+
+@snapshot.on_build
+def prebuild(new, previous):
+    '''Build the layers that were requested from the previous snapshot into
+    a new one, so that requests after a reload don't wait for them.'''
+    if previous is None:
+        return
+    for name in list(previous.layers):
+        build = _builders.get(name)
+        if build is not None:
+            new.layers[name] = _Entry(build(), new.loaded)
@@ -0,0 +1,94 @@
+'''Cache of routing results, shared by the route and travelcost endpoints.
+
+Kiosks and apps ask for the same trips over and over (e.g. between transit
+stops and building entrances), so results are cached by what they actually
+depend on: the snapped start and end of the search, the cost profile and
+the data version. Entries for an old data version are purged when the data
+is reloaded.
+
+The storage is set with the RESULT_CACHE setting: an LRU cache in each
+process ('memory'), or a SQLite file that all the worker processes on a
+machine share ('sqlite'). Workers only share entries if they have the same
+data version, i.e. when the app is loaded before they are forked (e.g.
+gunicorn --preload).'''
+import os
+import tempfile
+import threading
+
+from accessmapapi import app, cache, snapshot
+
+
+class NoCache(object):
+    '''Stand-in for RESULT_CACHE=none: always computes.'''
+    hits = 0
+    misses = 0
+
+    def __len__(self):
+        return 0
+
+    def get_or_compute(self, key, compute):
+        self.misses += 1
+        return compute()
+
+    def clear(self):
+        pass
+
+
+def _create():
+    backend = app.config['RESULT_CACHE']
+    maxsize = app.config['RESULT_CACHE_SIZE']
+    ttl = app.config['RESULT_CACHE_TTL'] or None
+    if backend == 'memory':
+        return cache.LRUCache(maxsize, ttl=ttl)
+    if backend == 'sqlite':
+        path = app.config['RESULT_CACHE_PATH'] or os.path.join(
+            tempfile.gettempdir(), 'accessmapapi-results.sqlite')
+        return cache.SQLiteCache(path, maxsize, ttl=ttl)
+    if backend == 'none':
+        return NoCache()
+    raise ValueError('Unknown RESULT_CACHE: {}'.format(backend))
+
+
+_results = None
+_results_lock = threading.Lock()
+
+
+def _get():
+    global _results
+    if _results is None:
+        with _results_lock:
+            if _results is None:
+                _results = _create()
+    return _results
+
+
+def get_or_compute(key, compute):
+    '''Return the cached result for `key` in the data version of the
+    request's snapshot (see snapshot.current), calling `compute()` and
+    caching what it returns on a miss.
+
+    :param key: JSON-serializable tuple identifying the result, e.g.
+                ('route', engine, start, end, profile).
+    :type key: tuple
+    :param compute: Function computing the result. Results may be shared
+                    between requests, so callers must not modify them.
+    :type compute: callable
+
+    '''
+    return _get().get_or_compute(tuple(key) + (snapshot.current().version,),
+                                 compute)
+
+
+def stats():
+    '''Hit and miss counts (for this process) and number of entries.'''
+    results = _get()
+    return {'backend': app.config['RESULT_CACHE'],
+            'entries': len(results),
+            'hits': results.hits,
+            'misses': results.misses}
+
+
+@cache.on_invalidate
+def clear():
+    '''Purge the results of the old data version.'''
+    _get().clear()
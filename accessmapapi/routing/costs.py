@@ -2,7 +2,21 @@
 executable SQL (as a string) that refers to the correct tables, so each cost
 function is written as an actual function that requires specification of the
 input column names. In addition, cost function parameters can be made tunable
-using keyword arguments following required column name arguments.'''
+using keyword arguments following required column name arguments.
+
+Each cost function also has an `_array` counterpart that evaluates the same
+cost over NumPy arrays of edge attributes, for use with the in-memory routing
+graph. `edge_costs` evaluates one over a whole graph and caches the result
+per set of parameters, so repeated requests with the same user profile reuse
+the same array.
+
+Requests pick their parameters through a named profile and a few validated
+query parameters (see profile_params). Hard limits, like a maximum grade,
+make edges impassable rather than expensive, so they are pruned from the
+search instead of being explored at a huge cost.'''
+import inspect
+
+import numpy as np
 
 
 def manual_wheelchair(dist_col, grade_col, crossing_col, kdist=1.0, kele=1e10,
@@ -17,3 +31,257 @@ def manual_wheelchair(dist_col, grade_col, crossing_col, kdist=1.0, kele=1e10,
     cost = ' + '.join([dist_cost, grade_cost, crossing_cost])
 
     return cost
+
+
+# Parameters of the cost profiles, as PostgreSQL types, in the order the
+# SQL cost functions take them (see pgr_edges)
+SQL_PARAMS = [('kdist', 'double precision'),
+              ('kele', 'double precision'),
+              ('kcrossing', 'double precision'),
+              ('kcurb', 'double precision'),
+              ('max_uphill', 'double precision'),
+              ('max_downhill', 'double precision'),
+              ('require_curbramps', 'boolean')]
+
+
+def manual_wheelchair_template(dist_col, grade_col, crossing_col,
+                               curbramps_col, reverse=False):
+    '''`manual_wheelchair_array` as SQL, with the parameters left as
+    positional placeholders for PostgreSQL's format() - %1$L to %7$L, in the
+    order of SQL_PARAMS. Queries built on it stay the same whatever the
+    parameters, which are bound separately (see sql_params), so they can be
+    prepared once and reused. Impassable edges cost -1, which pgRouting
+    leaves out of the graph.
+
+    :param reverse: Cost of travelling the edge from target to source.
+    :type reverse: bool
+
+    '''
+    grade = '-{}'.format(grade_col) if reverse else grade_col
+    no_curbramps = '({} = 1 AND NOT COALESCE({}, false))'.format(
+        crossing_col, curbramps_col)
+    return '''CASE WHEN {grade} <= %5$L::double precision
+                  AND -({grade}) <= %6$L::double precision
+                 THEN %1$L::double precision * {dist} +
+                      %2$L::double precision * POW(ABS({grade}), 4) +
+                      %3$L::double precision * {crossing} +
+                      %4$L::double precision * {no_curbramps}::integer
+                 ELSE -1
+                  END'''.format(grade=grade, dist=dist_col,
+                                 crossing=crossing_col,
+                                 no_curbramps=no_curbramps)
+
+
+def pgr_edges(table, first):
+    '''SQL expression that builds the edge query for pgRouting functions -
+    `id, source, target, cost, reverse_cost` with the manual_wheelchair
+    cost - out of bound parameters. Crossings without curb ramps are left
+    out of the query altogether when they are required.
+
+    :param table: Name of the pgRouting edge table.
+    :type table: str
+    :param first: Number of the statement parameter holding the first cost
+                  parameter (kdist) - the others follow in the order of
+                  SQL_PARAMS.
+    :type first: int
+
+    '''
+    columns = ('length', 'grade', 'iscrossing', 'curbramps')
+    edges_sql = '''SELECT id::integer,
+                          source::integer,
+                          target::integer,
+                          ({})::double precision AS cost,
+                          ({})::double precision AS reverse_cost
+                     FROM {}
+                    WHERE NOT (%7$L::boolean
+                               AND iscrossing = 1
+                               AND NOT COALESCE(curbramps, false))'''.format(
+        manual_wheelchair_template(*columns),
+        manual_wheelchair_template(*columns, reverse=True), table)
+    placeholders = ', '.join('${}'.format(first + i)
+                             for i in range(len(SQL_PARAMS)))
+    return "format('{}', {})".format(edges_sql.replace("'", "''"),
+                                     placeholders)
+
+
+def sql_params(**kwargs):
+    '''The parameters of `manual_wheelchair_array` (with defaults filled
+    in), in the form the SQL cost functions take them (see SQL_PARAMS): no
+    grade limit becomes an infinite one.
+
+    :raises ValueError: if a cost coefficient is not a finite number.
+
+    '''
+    params = _defaults(manual_wheelchair_array)
+    params.update(kwargs)
+    for name, value in params.items():
+        if name == 'require_curbramps':
+            params[name] = bool(value)
+            continue
+        if value is None and name.startswith('max_'):
+            params[name] = float('inf')
+            continue
+        value = float(value)
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError('{} must be a finite number.'.format(name))
+        params[name] = value
+    return params
+
+
+# Query parameters of the route, travelcost and matrix endpoints that pick a
+# cost profile (see profile_params)
+PROFILES = {
+    # The defaults of manual_wheelchair_array
+    'manual_wheelchair': {},
+    'powered_wheelchair': {'kele': 1e6,
+                           'max_uphill': 0.12,
+                           'max_downhill': 0.12,
+                           'require_curbramps': True},
+    'cane': {'kele': 1e4,
+             'kcrossing': 50.0,
+             'kcurb': 200.0},
+    'walker': {'kele': 1e6,
+               'kcurb': 1e3,
+               'max_uphill': 0.1,
+               'max_downhill': 0.1},
+}
+
+# Extra cost of a crossing without curb ramps with avoid_curbs=true
+AVOID_CURBS_PENALTY = 1e3
+
+
+def profile_params(args):
+    '''Validate the cost profile query parameters of a request and turn
+    them into cost function parameters:
+
+        profile: a base profile, one of PROFILES (default:
+                 manual_wheelchair).
+        max_uphill, max_downhill: steepest grade (e.g. 0.08 for 8%) to go up
+                                  or down. Steeper edges are left out of the
+                                  search in that direction.
+        require_curbramps: true to only use crossings with curb ramps.
+        avoid_curbs: true to prefer crossings with curb ramps.
+        crossing_penalty: the cost of crossing a street, in meters of
+                          sidewalk.
+
+    :param args: The request's query parameters.
+    :type args: dict
+    :returns: dict of manual_wheelchair_array parameters (only those that
+              differ from the defaults, so that results are shared with
+              requests that don't give any).
+    :raises ValueError: with a message for the client, if a parameter is
+                        invalid.
+
+    '''
+    name = args.get('profile', 'manual_wheelchair')
+    if name not in PROFILES:
+        raise ValueError('profile must be one of {}.'.format(
+            ', '.join(sorted(PROFILES))))
+    params = dict(PROFILES[name])
+
+    def number(key, low, high):
+        try:
+            value = float(args[key])
+        except ValueError:
+            value = None
+        if value is None or not low <= value <= high:
+            raise ValueError('{} must be a number from {} to {}.'.format(
+                key, low, high))
+        return value
+
+    def boolean(key):
+        value = args[key]
+        if value not in ('true', 'false'):
+            raise ValueError('{} must be true or false.'.format(key))
+        return value == 'true'
+
+    for key in ('max_uphill', 'max_downhill'):
+        if key in args:
+            params[key] = number(key, 0.0, 1.0)
+    if 'crossing_penalty' in args:
+        params['kcrossing'] = number('crossing_penalty', 0.0, 1e6)
+    if 'require_curbramps' in args:
+        params['require_curbramps'] = boolean('require_curbramps')
+    if 'avoid_curbs' in args:
+        params['kcurb'] = (AVOID_CURBS_PENALTY if boolean('avoid_curbs')
+                           else 0.0)
+
+    defaults = _defaults(manual_wheelchair_array)
+    return dict((key, value) for key, value in params.items()
+                if value != defaults[key])
+
+
+def manual_wheelchair_array(length, grade, iscrossing, curbramps, kdist=1.0,
+                            kele=1e10, kcrossing=1e2, kcurb=0.0,
+                            max_uphill=None, max_downhill=None,
+                            require_curbramps=False):
+    '''Array version of `manual_wheelchair`: calculates the cost of every
+    edge at once from arrays of edge attributes, in the direction in which
+    `grade` is uphill. On top of `manual_wheelchair`, crossings without curb
+    ramps can cost an extra `kcurb`.
+
+    Hard limits are not penalties but make edges impassable (a cost of -1,
+    as in pgRouting): edges steeper than `max_uphill` or `max_downhill`
+    (grades, None for no limit) and, with `require_curbramps`, crossings
+    without curb ramps.
+
+    '''
+    cost = (kdist * length + kele * np.abs(grade) ** 4 +
+            kcrossing * iscrossing)
+    no_curbramps = (iscrossing > 0) & (curbramps == 0)
+    if kcurb:
+        cost = cost + kcurb * no_curbramps
+
+    impassable = np.zeros(len(cost), dtype=bool)
+    if max_uphill is not None:
+        impassable |= grade > max_uphill
+    if max_downhill is not None:
+        impassable |= -grade > max_downhill
+    if require_curbramps:
+        impassable |= no_curbramps
+    return np.where(impassable, -1.0, cost)
+
+
+def edge_costs(route_graph, costfun, reverse=False, **kwargs):
+    '''Evaluate an array cost function over every edge of the in-memory
+    routing graph. Results are cached on the graph per (cost function,
+    parameters, direction), least recently used first out.
+
+    :param route_graph: The in-memory routing graph.
+    :type route_graph: graph.Graph
+    :param costfun: An array cost function, e.g. manual_wheelchair_array.
+    :type costfun: callable
+    :param reverse: Cost of travelling edges from target to source, i.e.
+                    with their grades reversed.
+    :type reverse: bool
+    :param kwargs: Cost function parameters, e.g. kdist.
+    :returns: Read-only array with one cost per edge.
+
+    '''
+    key = profile_key(costfun, **kwargs)
+    params = dict(key[1:])
+    grade = -route_graph.grade if reverse else route_graph.grade
+
+    def compute():
+        cost = costfun(route_graph.length, grade, route_graph.iscrossing,
+                       route_graph.curbramps, **params)
+        cost = np.ascontiguousarray(cost, dtype=np.float64)
+        # Shared between requests (and threads) - nobody gets to modify it
+        cost.flags.writeable = False
+        return cost
+
+    return route_graph.cost_cache.get_or_compute((key, reverse), compute)
+
+
+def profile_key(costfun, **kwargs):
+    '''Hashable key identifying a cost function and its parameters, with
+    defaults filled in: (name, (param, value), ...).'''
+    params = _defaults(costfun)
+    params.update(kwargs)
+    return (costfun.__name__,) + tuple(sorted(params.items()))
+
+
+def _defaults(costfun):
+    parameters = inspect.signature(costfun).parameters.values()
+    return {p.name: p.default for p in parameters
+            if p.default is not inspect.Parameter.empty}
@@ -0,0 +1,168 @@
+'''Turn-by-turn steps for a route, built from the edges it travels in one
+pass. Consecutive sidewalk edges are grouped into one step until the route
+turns a corner; every crossing is a step of its own. Bearings come from the
+route geometry and distances from the edge lengths, so no queries are
+needed.
+
+Routes describe their edges as [iscrossing, distance, first, last,
+curbramps] lists, where `first` and `last` are the indices of the edge's
+first and last coordinates in the route geometry.'''
+import math
+
+
+# Turns sharper than this (degrees) start a new step
+TURN_ANGLE = 45.0
+DIRECTIONS = ('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW')
+DIRECTION_NAMES = {'N': 'north', 'NE': 'northeast', 'E': 'east',
+                   'SE': 'southeast', 'S': 'south', 'SW': 'southwest',
+                   'W': 'west', 'NW': 'northwest'}
+
+
+def bearing(a, b):
+    '''Compass bearing (degrees clockwise from north) from one (lon, lat)
+    point to another, or None if they are the same point.'''
+    dx = (b[0] - a[0]) * math.cos(math.radians((a[1] + b[1]) / 2))
+    dy = b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return None
+    return math.degrees(math.atan2(dx, dy)) % 360
+
+
+def direction(heading):
+    '''Cardinal direction (e.g. 'NE') of a bearing.'''
+    return DIRECTIONS[int((heading + 22.5) // 45) % 8]
+
+
+def turn(before, after):
+    '''Signed change of bearing, from -180 (left) to 180 (right).'''
+    return (after - before + 540) % 360 - 180
+
+
+def modifier(angle):
+    '''Describe a turn (see `turn`), e.g. 'slight left'.'''
+    size = abs(angle)
+    if size < 20:
+        return 'straight'
+    side = 'right' if angle > 0 else 'left'
+    if size < 60:
+        return 'slight ' + side
+    if size < 135:
+        return side
+    return 'sharp ' + side
+
+
+def _edge_bearings(coords, first, last):
+    '''Bearings at the start and end of the edge coords[first:last + 1].'''
+    start = None
+    for i in range(first, last):
+        start = bearing(coords[i], coords[i + 1])
+        if start is not None:
+            break
+    end = None
+    for i in range(last, first, -1):
+        end = bearing(coords[i - 1], coords[i])
+        if end is not None:
+            break
+    return start, end
+
+
+def steps(coords, legs):
+    '''Generate the steps of a route.
+
+    :param coords: The route geometry, as (lon, lat) coordinates.
+    :type coords: list
+    :param legs: The edges of each leg of the route, in order (see the
+                 module docstring).
+    :type legs: list of lists
+    :returns: list of step dicts: way_name ('sidewalk' or 'crossing'),
+              direction, heading, distance and maneuver (type, modifier,
+              location, instruction). Each leg starts with a 'depart' step
+              and ends with a 'waypoint' step, or 'arrive' for the last
+              one.
+
+    '''
+    result = []
+    heading = None
+    position = 0
+    for n, edges in enumerate(legs):
+        step = None
+        for iscrossing, distance, first, last, curbramps in edges:
+            position = last
+            start, end = _edge_bearings(coords, first, last)
+            if start is None:
+                continue
+            way = 'crossing' if iscrossing else 'sidewalk'
+            angle = 0.0 if heading is None else turn(heading, start)
+            heading = end
+            if (step is not None and way == 'sidewalk' and
+                    step['way_name'] == 'sidewalk' and
+                    abs(angle) < TURN_ANGLE):
+                step['distance'] += distance
+                continue
+
+            if step is None:
+                kind = 'depart'
+            elif iscrossing:
+                kind = 'cross'
+            else:
+                kind = 'turn'
+            step = _step(way, kind, start, angle, distance, coords[first],
+                         iscrossing and not curbramps)
+            result.append(step)
+
+        kind = 'arrive' if n == len(legs) - 1 else 'waypoint'
+        result.append(_step(None, kind, heading, 0.0, 0.0,
+                            coords[position] if coords else None, False))
+
+    return result
+
+
+def _step(way, kind, heading, angle, distance, location, no_curbramps):
+    maneuver = {'type': kind,
+                'location': {'type': 'Point', 'coordinates': location}}
+    if kind in ('turn', 'cross'):
+        maneuver['modifier'] = modifier(angle)
+    maneuver['instruction'] = _instruction(way, kind, heading, angle,
+                                           no_curbramps)
+    step = {'way_name': way or '',
+            'distance': distance,
+            'maneuver': maneuver}
+    if heading is not None:
+        step['heading'] = round(heading, 1)
+        step['direction'] = direction(heading)
+    return step
+
+
+def _instruction(way, kind, heading, angle, no_curbramps):
+    towards = ''
+    if heading is not None:
+        towards = DIRECTION_NAMES[direction(heading)]
+    if kind == 'depart':
+        return 'Head {} on the {}'.format(towards, way)
+    if kind == 'arrive':
+        return 'Arrive at your destination'
+    if kind == 'waypoint':
+        return 'Arrive at your waypoint'
+    if kind == 'cross':
+        instruction = 'Cross the street heading {}'.format(towards)
+        if no_curbramps:
+            instruction += ' - no curb ramps'
+        return instruction
+    turn_modifier = modifier(angle)
+    if turn_modifier == 'straight':
+        return 'Continue {} on the {}'.format(towards, way)
+    return 'Turn {} onto the {}'.format(turn_modifier, way)
+
+
+def summary(edges):
+    '''A short summary of a route: its number of crossings, and how many of
+    those have no curb ramps.'''
+    crossings = [edge for edge in edges if edge[0]]
+    if not crossings:
+        return 'No street crossings'
+    text = '{} street crossing{}'.format(len(crossings),
+                                         '' if len(crossings) == 1 else 's')
+    missing = sum(1 for edge in crossings if not edge[4])
+    if missing:
+        text += ', {} without curb ramps'.format(missing)
+    return text
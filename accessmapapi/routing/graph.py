@@ -0,0 +1,190 @@
+'''In-memory representation of the pgRouting graph. The `routing` and
+`routing_vertices_pgr` tables are read once and stored as flat arrays in
+compressed sparse row (CSR) form, so that shortest-path searches can run in
+process without asking PostgreSQL to rebuild the graph for every request.'''
+import json
+
+import numpy as np
+
+from accessmapapi import app, cache, db
+
+
+class Graph(object):
+    '''Undirected routing graph backed by flat NumPy arrays.
+
+    Nodes and edges are addressed by their index in the arrays below - the
+    original database ids are kept in `node_ids` (sorted) and `edge_ids`.
+
+    Edge attributes (one entry per edge):
+        source, target: node indices of the edge endpoints.
+        length, grade, iscrossing, curbramps: the routing table columns of
+            the same name (curbramps: whether a crossing has curb ramps).
+
+    Adjacency (CSR, two entries per edge - one for each direction):
+        indptr: the neighbors of node `u` are stored in the range
+                indptr[u]:indptr[u + 1] of the arrays below.
+        adj_node: the neighboring node.
+        adj_edge: the edge connecting the two nodes.
+        adj_forward: whether the edge is traversed from source to target.
+
+    Geometry:
+        node_coords: (lon, lat) of every node.
+        geom_indptr, geom_coords: the (lon, lat) coordinates of edge `e` are
+            geom_coords[geom_indptr[e]:geom_indptr[e + 1]]
+
+    Per-profile edge cost arrays are kept in `cost_cache` (see
+    costs.edge_costs), holding at most `cost_cache_size` of them, and ALT
+    landmarks in `landmarks`, by profile key (see landmarks.py).
+
+    Arrays that already have the right dtype are used as they are, not
+    copied - they may be read-only (see graphfile.read). The adjacency
+    arrays are built from the edges, unless given as an (indptr, adj_node,
+    adj_edge, adj_forward) tuple in `adjacency`.
+
+    '''
+    def __init__(self, node_ids, node_coords, edge_ids, source, target,
+                 length, grade, iscrossing, curbramps, geom_indptr,
+                 geom_coords, cost_cache_size=8, adjacency=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.node_coords = np.asarray(node_coords, dtype=np.float64)
+        self.edge_ids = np.asarray(edge_ids, dtype=np.int64)
+        self.source = np.asarray(source, dtype=np.int32)
+        self.target = np.asarray(target, dtype=np.int32)
+        self.length = np.asarray(length, dtype=np.float64)
+        self.grade = np.asarray(grade, dtype=np.float64)
+        self.iscrossing = np.asarray(iscrossing, dtype=np.float64)
+        self.curbramps = np.asarray(curbramps, dtype=np.float64)
+        self.geom_indptr = np.asarray(geom_indptr, dtype=np.int64)
+        self.geom_coords = np.asarray(geom_coords, dtype=np.float64)
+
+        self.cost_cache = cache.LRUCache(cost_cache_size)
+        self.landmarks = {}
+
+        if adjacency is None:
+            self._build_adjacency()
+        else:
+            self.indptr, self.adj_node, self.adj_edge, self.adj_forward = (
+                adjacency)
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_ids)
+
+    def _build_adjacency(self):
+        m = self.n_edges
+        heads = np.concatenate([self.source, self.target])
+        tails = np.concatenate([self.target, self.source])
+        edges = np.concatenate([np.arange(m), np.arange(m)])
+        forward = np.concatenate([np.ones(m, dtype=bool),
+                                  np.zeros(m, dtype=bool)])
+
+        order = np.argsort(heads, kind='mergesort')
+        counts = np.bincount(heads, minlength=self.n_nodes)
+
+        self.indptr = np.zeros(self.n_nodes + 1, dtype=np.int32)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.adj_node = tails[order].astype(np.int32)
+        self.adj_edge = edges[order].astype(np.int32)
+        self.adj_forward = forward[order]
+
+    def node_index(self, node_id):
+        '''Translate a routing_vertices_pgr id into a node index.
+
+        :raises KeyError: if there is no such node.
+
+        '''
+        index = int(np.searchsorted(self.node_ids, node_id))
+        if index == self.n_nodes or self.node_ids[index] != node_id:
+            raise KeyError(node_id)
+        return index
+
+    def edge_coords(self, edge, forward=True):
+        '''Coordinates of an edge, in the direction of travel.
+
+        :param edge: The edge index.
+        :type edge: int
+        :param forward: Whether the edge is traversed from source to target.
+        :type forward: bool
+
+        '''
+        start = self.geom_indptr[edge]
+        end = self.geom_indptr[edge + 1]
+        coords = self.geom_coords[start:end].tolist()
+        if not forward:
+            coords.reverse()
+        return coords
+
+
+def from_db(table='routing'):
+    '''Read a pgRouting edge table and its vertices table into a Graph.
+
+    :param table: Name of the pgRouting edge table.
+    :type table: str
+
+    '''
+    vertices_sql = '''
+      SELECT id,
+             ST_X(the_geom),
+             ST_Y(the_geom)
+        FROM {}_vertices_pgr
+    ORDER BY id
+    '''.format(table)
+    result = db.engine.execute(vertices_sql)
+    vertex_rows = list(result)
+    result.close()
+
+    node_ids = np.array([row[0] for row in vertex_rows], dtype=np.int64)
+    node_coords = np.array([[row[1], row[2]] for row in vertex_rows],
+                           dtype=np.float64).reshape(-1, 2)
+
+    edges_sql = '''
+      SELECT id::integer,
+             source::integer,
+             target::integer,
+             length::double precision,
+             grade::double precision,
+             iscrossing::double precision,
+             COALESCE(curbramps, false)::integer,
+             ST_AsGeoJSON(geom, 7)
+        FROM {}
+       WHERE source IS NOT NULL
+         AND target IS NOT NULL
+    ORDER BY id
+    '''.format(table)
+    result = db.engine.execute(edges_sql)
+
+    edge_ids = []
+    source = []
+    target = []
+    length = []
+    grade = []
+    iscrossing = []
+    curbramps = []
+    geom_indptr = [0]
+    geom_coords = []
+    for row in result:
+        edge_ids.append(row[0])
+        source.append(row[1])
+        target.append(row[2])
+        length.append(row[3] or 0.0)
+        grade.append(row[4] or 0.0)
+        iscrossing.append(row[5] or 0.0)
+        curbramps.append(row[6])
+        coords = json.loads(row[7])['coordinates']
+        geom_coords += coords
+        geom_indptr.append(len(geom_coords))
+    result.close()
+
+    # Node ids are sorted, so ids can be turned into indices with a search
+    source = np.searchsorted(node_ids, source)
+    target = np.searchsorted(node_ids, target)
+
+    return Graph(node_ids, node_coords, edge_ids, source, target, length,
+                 grade, iscrossing, curbramps, geom_indptr,
+                 np.array(geom_coords, dtype=np.float64).reshape(-1, 2),
+                 cost_cache_size=app.config['COST_CACHE_SIZE'])
+
@@ -0,0 +1,208 @@
+'''On-disk format of the in-memory routing graph, for fast worker startup.
+
+    python -m accessmapapi.routing.graphfile routing.graph
+
+exports the `routing` graph from the database into a file of flat arrays:
+the node ids and coordinates, the edges and their attributes, the edge
+geometries and the CSR adjacency (see graph.Graph), as well as the ALT
+landmarks of the standard cost profiles (see landmarks.py - skip them with
+`--landmarks 0`, as they take a few full-graph searches to compute). With
+GRAPH_FILE set,
+the memory routing engine maps the file read-only instead of reading the
+tables, so worker processes start in milliseconds and share one copy of
+the graph through the OS page cache.
+
+Layout: the MAGIC bytes, the format version and the length of a JSON header
+(two little-endian uint32), the header itself - which gives the dtype,
+shape and offset of every array, plus where and when the graph was
+exported - then the arrays. The data starts at the first multiple of
+ALIGNMENT bytes after the header, and array offsets (also multiples of
+ALIGNMENT) are counted from there. Files of another format version are
+refused.'''
+import argparse
+import datetime
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from accessmapapi import db
+from . import costs, graph, landmarks
+
+
+MAGIC = b'AMAPGRPH'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct('<8sII')
+
+# Graph attributes stored in the file, in order
+ARRAYS = ('node_ids', 'node_coords', 'edge_ids', 'source', 'target',
+          'length', 'grade', 'iscrossing', 'curbramps', 'geom_indptr',
+          'geom_coords', 'indptr', 'adj_node', 'adj_edge', 'adj_forward')
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write(route_graph, path, **metadata):
+    '''Write a graph to a file. The file is written next to `path` and then
+    renamed over it, so processes that have the old file mapped keep
+    reading it undisturbed.
+
+    :param route_graph: The graph to write.
+    :type route_graph: graph.Graph
+    :param path: Path of the file.
+    :type path: str
+    :param metadata: Extra JSON-serializable header entries, e.g. the table
+                     the graph was read from.
+
+    '''
+    arrays = [(name, np.ascontiguousarray(getattr(route_graph, name)))
+              for name in ARRAYS]
+    header = dict(metadata)
+    header['created'] = (datetime.datetime.utcnow()
+                         .replace(microsecond=0).isoformat() + 'Z')
+    header['n_nodes'] = route_graph.n_nodes
+    header['n_edges'] = route_graph.n_edges
+    header['arrays'] = {}
+
+    # Landmarks: their profile parameters, and arrays under a prefix
+    header['landmarks'] = []
+    for i, (key, profile_landmarks) in enumerate(
+            route_graph.landmarks.items()):
+        prefix = 'landmarks{}.'.format(i)
+        header['landmarks'].append({'costfun': key[0],
+                                    'params': dict(key[1:]),
+                                    'prefix': prefix})
+        arrays += [(prefix + 'nodes', profile_landmarks.nodes),
+                   (prefix + 'from_cost', profile_landmarks.from_cost),
+                   (prefix + 'to_cost', profile_landmarks.to_cost)]
+
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'dtype': array.dtype.str,
+                                  'shape': list(array.shape),
+                                  'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(header_bytes))
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    '''Read the header of a graph file.
+
+    :raises ValueError: if it is not a graph file of FORMAT_VERSION.
+
+    '''
+    with open(path, 'rb') as f:
+        return _header(f)[0]
+
+
+def _header(f):
+    '''Read the header of an open graph file.
+
+    :returns: the header and the offset of the data.
+
+    '''
+    prefix = f.read(_PREFIX.size)
+    if len(prefix) < _PREFIX.size:
+        raise ValueError('Not a routing graph file.')
+    magic, version, length = _PREFIX.unpack(prefix)
+    if magic != MAGIC:
+        raise ValueError('Not a routing graph file.')
+    if version != FORMAT_VERSION:
+        raise ValueError('Routing graph file format {} is not supported '
+                         '(expected {}) - export it again.'.format(
+                             version, FORMAT_VERSION))
+    header = json.loads(f.read(length).decode('utf-8'))
+    return header, _align(_PREFIX.size + length)
+
+
+def read(path, cost_cache_size=8):
+    '''Map a graph file read-only and return the graph. Its arrays are views
+    of the mapping: nothing is copied, and pages are only read from disk
+    (or the page cache) as they are used.
+
+    :param path: Path of the file.
+    :type path: str
+    :param cost_cache_size: See graph.Graph.
+    :type cost_cache_size: int
+    :raises ValueError: if it is not a graph file of FORMAT_VERSION.
+
+    '''
+    with open(path, 'rb') as f:
+        header, data_start = _header(f)
+        # The mapping stays valid after the file is closed
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        if count == 0:
+            arrays[name] = np.empty(spec['shape'], dtype=dtype)
+            continue
+        array = np.frombuffer(mapping, dtype=dtype, count=count,
+                              offset=data_start + spec['offset'])
+        arrays[name] = array.reshape(spec['shape'])
+
+    route_graph = graph.Graph(
+        arrays['node_ids'], arrays['node_coords'], arrays['edge_ids'],
+        arrays['source'], arrays['target'], arrays['length'],
+        arrays['grade'], arrays['iscrossing'], arrays['curbramps'],
+        arrays['geom_indptr'], arrays['geom_coords'],
+        cost_cache_size=cost_cache_size,
+        adjacency=(arrays['indptr'], arrays['adj_node'], arrays['adj_edge'],
+                   arrays['adj_forward']))
+
+    for entry in header.get('landmarks', []):
+        costfun = getattr(costs, entry['costfun'])
+        prefix = entry['prefix']
+        key = costs.profile_key(costfun, **entry['params'])
+        route_graph.landmarks[key] = landmarks.Landmarks(
+            arrays[prefix + 'nodes'], arrays[prefix + 'from_cost'],
+            arrays[prefix + 'to_cost'])
+
+    return route_graph
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export the routing graph from the database into a '
+                    'graph file for GRAPH_FILE.')
+    parser.add_argument('path', help='Path of the graph file to write.')
+    parser.add_argument('--table', default='routing',
+                        help='pgRouting edge table (default: routing).')
+    parser.add_argument('--landmarks', type=int,
+                        default=landmarks.DEFAULT_COUNT,
+                        help='ALT landmarks per cost profile, 0 for none '
+                             '(default: {}).'.format(
+                                 landmarks.DEFAULT_COUNT))
+    args = parser.parse_args(argv)
+
+    with db.statement_timeout(0):
+        route_graph = graph.from_db(args.table)
+    if args.landmarks > 0:
+        landmarks.build_profiles(route_graph, args.landmarks)
+    write(route_graph, args.path, table=args.table)
+    print('Wrote {} nodes and {} edges ({} landmark profiles) to {} '
+          '({:.1f} MB).'.format(
+              route_graph.n_nodes, route_graph.n_edges,
+              len(route_graph.landmarks), args.path,
+              os.path.getsize(args.path) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+'''Isochrones: everywhere that can be reached from an origin within a cost
+budget.
+
+`reachable` runs a bounded single-source search over the in-memory routing
+graph, which stops as soon as the budget is spent instead of exploring the
+whole network. `contours` turns the reached points (from either engine) into
+one polygon per cost threshold, so that clients get a handful of features
+rather than one point per reachable node.
+
+Contours are traced on a grid: every reached point spreads its cost to the
+grid cells around it (adding the cost of the distance off the network), and
+the cells within each threshold are outlined.'''
+import math
+
+import numpy as np
+
+from . import costs, search, spatial
+
+
+# Size of the grid cells contours are traced on, in meters
+CELL_SIZE = 20.0
+# How far from a reached point its cost spreads, in meters
+BUFFER = 40.0
+# Cost of a meter of travel off the network (a meter of flat sidewalk with
+# the default manual_wheelchair profile)
+OFF_NETWORK_COST = 1.0
+# Upper limit on the grid size - cells are made larger to stay under it
+MAX_CELLS = 4000000
+# Meters per degree of latitude (and of longitude, at the equator)
+METERS_PER_DEGREE = 111320.0
+
+
+def reachable(route_graph, snap, maxcost, edges=False,
+              costfun=costs.manual_wheelchair_array, **cost_params):
+    '''Find the nodes that can be reached from a point within `maxcost`.
+
+    :param route_graph: The in-memory routing graph.
+    :type route_graph: graph.Graph
+    :param snap: The origin, snapped to its closest edge.
+    :type snap: spatial.EdgeSnap
+    :param maxcost: The cost budget.
+    :type maxcost: float
+    :param edges: Also sample the coordinates along the reached edges
+                  (including partly reached ones), e.g. for `contours`.
+    :type edges: bool
+    :param costfun: An array cost function.
+    :type costfun: callable
+    :param cost_params: Cost function parameters, e.g. kdist.
+    :returns: (node coordinates, node costs, sample coordinates, sample
+              costs) as arrays of (lon, lat) and costs. The samples are
+              empty unless `edges` is set.
+
+    '''
+    cost = costs.edge_costs(route_graph, costfun, **cost_params)
+    reverse_cost = costs.edge_costs(route_graph, costfun, reverse=True,
+                                    **cost_params)
+    start = snap.split_costs(cost, reverse_cost, leaving=True)
+    settled, _ = search.dijkstra(route_graph, start, cost, reverse_cost,
+                                 maxcost=maxcost)
+
+    nodes = np.fromiter(settled.keys(), dtype=np.int64, count=len(settled))
+    node_costs = np.fromiter(settled.values(), dtype=np.float64,
+                             count=len(settled))
+    node_lonlat = route_graph.node_coords[nodes]
+
+    if not edges:
+        return node_lonlat, node_costs, np.zeros((0, 2)), np.zeros(0)
+
+    sample_lonlat, sample_costs = _edge_samples(route_graph, nodes,
+                                                node_costs, cost,
+                                                reverse_cost, maxcost)
+    # The origin itself, in case its edge has no reached ends
+    sample_lonlat = np.vstack([sample_lonlat, [snap.point]])
+    sample_costs = np.append(sample_costs, 0.0)
+    return node_lonlat, node_costs, sample_lonlat, sample_costs
+
+
+def _edge_samples(route_graph, nodes, node_costs, cost, reverse_cost,
+                  maxcost):
+    '''Cost of reaching every coordinate of the edges leaving reached nodes,
+    travelling along the edge from whichever end is cheaper.'''
+    node_cost = np.full(route_graph.n_nodes, np.inf)
+    node_cost[nodes] = node_costs
+    # Impassable directions can't be entered from their end
+    source_cost = np.where((cost >= 0) & np.isfinite(cost),
+                           node_cost[route_graph.source], np.inf)
+    target_cost = np.where((reverse_cost >= 0) & np.isfinite(reverse_cost),
+                           node_cost[route_graph.target], np.inf)
+    edges = np.nonzero(np.isfinite(source_cost) |
+                       np.isfinite(target_cost))[0]
+
+    # Indices into geom_coords of the coordinates of those edges
+    indptr = route_graph.geom_indptr
+    counts = indptr[edges + 1] - indptr[edges]
+    offsets = np.cumsum(counts) - counts
+    index = (np.repeat(indptr[edges] - offsets, counts) +
+             np.arange(counts.sum()))
+    coord_edge = np.repeat(edges, counts)
+    lonlat = route_graph.geom_coords[index]
+
+    # Fraction of the way along its edge of every coordinate, by length
+    steps = np.zeros(len(lonlat))
+    if len(lonlat):
+        steps[1:] = np.hypot(*(np.diff(lonlat, axis=0) *
+                               spatial._scale(lonlat)).T)
+    steps[offsets] = 0.0
+    along = np.cumsum(steps)
+    along -= np.repeat(along[offsets], counts)
+    total = np.repeat(along[offsets + counts - 1], counts)
+    fraction = np.where(total > 0, along / np.where(total > 0, total, 1), 0)
+
+    sample_costs = np.minimum(source_cost[coord_edge] +
+                              fraction * cost[coord_edge],
+                              target_cost[coord_edge] +
+                              (1 - fraction) * reverse_cost[coord_edge])
+    within = sample_costs <= maxcost
+    return lonlat[within], sample_costs[within]
+
+
+def contours(lonlat, point_costs, thresholds, cell_size=CELL_SIZE,
+             buffer=BUFFER):
+    '''Outline the area reachable within each of several costs.
+
+    :param lonlat: (lon, lat) of the reached points.
+    :type lonlat: numpy.ndarray
+    :param point_costs: The cost of reaching each point.
+    :type point_costs: numpy.ndarray
+    :param thresholds: The costs to draw contours at.
+    :type thresholds: list of float
+    :param cell_size: Grid cell size, in meters.
+    :type cell_size: float
+    :param buffer: How far the area around each point extends, in meters.
+    :type buffer: float
+    :returns: GeoJSON Features with a MultiPolygon geometry and a `cost`
+              property, largest threshold first. Contours are nested: each
+              one includes the area of the smaller ones.
+
+    '''
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+    point_costs = np.asarray(point_costs, dtype=np.float64)
+    thresholds = sorted(thresholds, reverse=True)
+    if not len(lonlat):
+        return [_feature([], threshold) for threshold in thresholds]
+
+    # A local planar frame, in meters
+    scale = spatial._scale(lonlat) * METERS_PER_DEGREE
+    xy = lonlat * scale
+    origin = xy.min(axis=0) - buffer - cell_size
+    extent = xy.max(axis=0) + buffer + cell_size - origin
+    n_cells = np.prod(extent / cell_size)
+    if n_cells > MAX_CELLS:
+        cell_size *= math.sqrt(n_cells / MAX_CELLS)
+    nx, ny = (np.ceil(extent / cell_size).astype(int) + 1).tolist()
+
+    field = _cost_field(xy - origin, point_costs, nx, ny, cell_size, buffer)
+
+    features = []
+    for threshold in thresholds:
+        rings = _trace(field <= threshold)
+        polygons = []
+        for polygon in _polygons(rings):
+            polygons.append([
+                [[round(float(origin[0] + i * cell_size) / scale[0], 7),
+                  round(float(origin[1] + j * cell_size) / scale[1], 7)]
+                 for i, j in ring]
+                for ring in polygon])
+        features.append(_feature(polygons, threshold))
+    return features
+
+
+def _feature(polygons, threshold):
+    return {'type': 'Feature',
+            'geometry': {'type': 'MultiPolygon',
+                         'coordinates': polygons},
+            'properties': {'cost': threshold}}
+
+
+def _cost_field(xy, point_costs, nx, ny, cell_size, buffer):
+    '''Grid of the cheapest cost of reaching each cell's center: the cost of
+    a nearby point plus the distance from it, off the network.'''
+    field = np.full(ny * nx, np.inf)
+    ci = np.floor(xy[:, 0] / cell_size).astype(int)
+    cj = np.floor(xy[:, 1] / cell_size).astype(int)
+    reach = int(math.ceil(buffer / cell_size))
+    for di in range(-reach, reach + 1):
+        for dj in range(-reach, reach + 1):
+            i = ci + di
+            j = cj + dj
+            distance = np.hypot((i + 0.5) * cell_size - xy[:, 0],
+                                (j + 0.5) * cell_size - xy[:, 1])
+            near = ((distance <= buffer) & (i >= 0) & (i < nx) &
+                    (j >= 0) & (j < ny))
+            np.minimum.at(field, j[near] * nx + i[near],
+                          point_costs[near] +
+                          OFF_NETWORK_COST * distance[near])
+    return field.reshape(ny, nx)
+
+
+# Outline edge directions, counterclockwise from east
+_DIRECTIONS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+
+def _trace(mask):
+    '''Outline the cells of a boolean grid as rings of grid corners (i, j).
+    Rings have the inside on their left: outer boundaries run
+    counterclockwise and holes clockwise.'''
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+    inside = padded[1:-1, 1:-1]
+
+    # (start corner, direction) of every boundary edge between an inside
+    # and an outside cell
+    outgoing = {}
+    for direction, (di, dj), (ci, cj) in [
+            (0, (0, -1), (0, 0)),   # bottom edge, running east
+            (1, (1, 0), (1, 0)),    # right edge, running north
+            (2, (0, 1), (1, 1)),    # top edge, running west
+            (3, (-1, 0), (0, 1))]:  # left edge, running south
+        neighbor = padded[1 + dj:padded.shape[0] - 1 + dj,
+                          1 + di:padded.shape[1] - 1 + di]
+        js, is_ = np.nonzero(inside & ~neighbor)
+        for i, j in zip((is_ + ci).tolist(), (js + cj).tolist()):
+            outgoing.setdefault((i, j), []).append(direction)
+
+    rings = []
+    while outgoing:
+        start = next(iter(outgoing))
+        corner = start
+        direction = None
+        ring = []
+        while True:
+            choices = outgoing.get(corner)
+            if not choices:
+                break
+            if direction is None:
+                chosen = choices[0]
+            else:
+                # Prefer turning left, so that cells touching at a corner
+                # are outlined separately
+                for turn in (1, 0, 3):
+                    chosen = (direction + turn) % 4
+                    if chosen in choices:
+                        break
+            choices.remove(chosen)
+            if not choices:
+                del outgoing[corner]
+            if chosen != direction:
+                ring.append(corner)
+            direction = chosen
+            step = _DIRECTIONS[direction]
+            corner = (corner[0] + step[0], corner[1] + step[1])
+        if ring and ring[0] != corner:
+            ring.append(corner)
+        # The start corner is only a vertex if the ring turns there
+        if len(ring) > 1 and _collinear(ring[-1], ring[0], ring[1]):
+            ring.pop(0)
+        ring.append(ring[0])
+        rings.append(ring)
+    return rings
+
+
+def _collinear(a, b, c):
+    return (b[0] - a[0]) * (c[1] - b[1]) == (b[1] - a[1]) * (c[0] - b[0])
+
+
+def _area(ring):
+    '''Signed area of a closed ring - positive when counterclockwise.'''
+    return sum(a[0] * b[1] - b[0] * a[1]
+               for a, b in zip(ring[:-1], ring[1:])) / 2.0
+
+
+def _contains(ring, point):
+    '''Whether a point (that is not on the ring) is inside a closed ring.'''
+    x, y = point
+    inside = False
+    for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+        if (y0 > y) != (y1 > y):
+            if x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+    return inside
+
+
+def _polygons(rings):
+    '''Group rings into GeoJSON polygons: each outer ring, followed by the
+    holes it immediately contains.'''
+    outers = []
+    holes = []
+    for ring in rings:
+        area = _area(ring)
+        if area > 0:
+            outers.append((area, ring))
+        elif area < 0:
+            holes.append(ring)
+    outers.sort(key=lambda outer: outer[0])
+
+    polygons = dict((id(ring), [ring]) for _, ring in outers)
+    for hole in holes:
+        # The middle of the outside cell to the right of the first edge
+        (x0, y0), (x1, y1) = hole[0], hole[1]
+        dx = (x1 > x0) - (x1 < x0)
+        dy = (y1 > y0) - (y1 < y0)
+        point = (x0 + dx * 0.5 + dy * 0.5, y0 + dy * 0.5 - dx * 0.5)
+        # The smallest outer ring around the hole is the one it belongs to
+        for _, ring in outers:
+            if _contains(ring, point):
+                polygons[id(ring)].append(hole)
+                break
+    return [polygons[id(ring)] for _, ring in reversed(outers)]
@@ -0,0 +1,163 @@
+'''ALT (A*, landmarks and the triangle inequality) speed-up for long routes
+on the in-memory engine.
+
+A few landmark nodes are picked around the edge of the graph, and the cost
+from every landmark to every node and from every node to every landmark is
+computed offline, for each standard cost profile (costs.PROFILES). By the
+triangle inequality, these give a lower bound on the cost between any two
+nodes, which A* (search.astar) uses to head straight for the destination:
+cross-neighborhood routes settle a small fraction of the nodes a plain
+Dijkstra search would.
+
+Landmarks are computed when exporting a graph file (see graphfile.py) and
+are only valid for the exact profile they were computed with - routes with
+any other cost parameters fall back to search.bidirectional_dijkstra.'''
+import numpy as np
+
+from . import costs, search
+
+
+# Landmarks per profile. Each takes 16 bytes per node.
+DEFAULT_COUNT = 8
+# Landmarks consulted per search: those giving the tightest bounds at the
+# origin.
+ACTIVE = 4
+
+
+class Landmarks(object):
+    '''Costs from and to a set of landmark nodes under one cost profile.
+
+    :param nodes: Node indices of the landmarks.
+    :type nodes: numpy.ndarray
+    :param from_cost: (landmarks, nodes) array of the cost from each
+                      landmark to each node, inf where there is no path.
+    :type from_cost: numpy.ndarray
+    :param to_cost: (landmarks, nodes) array of the cost from each node to
+                    each landmark.
+    :type to_cost: numpy.ndarray
+
+    '''
+    def __init__(self, nodes, from_cost, to_cost):
+        self.nodes = np.asarray(nodes, dtype=np.int32)
+        self.from_cost = np.asarray(from_cost, dtype=np.float64)
+        self.to_cost = np.asarray(to_cost, dtype=np.float64)
+
+    def _bounds(self, rows, target, nodes=None):
+        '''Lower bounds on the cost from `nodes` (default: all of them) to
+        `target` given by each of the landmarks `rows`, as a (rows, nodes)
+        array.'''
+        from_cost = self.from_cost[rows]
+        to_cost = self.to_cost[rows]
+        if nodes is not None:
+            from_nodes = from_cost[:, nodes]
+            to_nodes = to_cost[:, nodes]
+        else:
+            from_nodes = from_cost
+            to_nodes = to_cost
+        with np.errstate(invalid='ignore'):
+            # d(v, t) >= d(l, t) - d(l, v) and d(v, t) >= d(v, l) - d(t, l).
+            # inf - inf (no information) gives nan, which fmax skips.
+            bounds = np.fmax(from_cost[:, target, None] - from_nodes,
+                             to_nodes - to_cost[:, target, None])
+        bounds[np.isnan(bounds)] = 0.0
+        return bounds
+
+    def potential(self, start, end):
+        '''Lower bounds on the cost from every node to a destination, for
+        search.astar.
+
+        :param start: Origin node index, or a dict whose keys are origin node
+                      indices (see search.astar) - used to pick the
+                      landmarks that give the tightest bounds.
+        :type start: int or dict
+        :param end: Destination node index, or a dict mapping node indices
+                    to the cost of reaching the destination from them.
+        :type end: int or dict
+        :returns: float64 array with one bound per node, inf for nodes that
+                  cannot reach the destination.
+
+        '''
+        if not isinstance(start, dict):
+            start = {start: 0.0}
+        if not isinstance(end, dict):
+            end = {end: 0.0}
+
+        everything = np.arange(len(self.nodes))
+        at_start = self._bounds(everything, next(iter(end)),
+                                [next(iter(start))])[:, 0]
+        rows = np.argsort(-at_start, kind='mergesort')[:ACTIVE]
+
+        potential = None
+        for target, offset in end.items():
+            bounds = self._bounds(rows, target).max(axis=0) + offset
+            potential = (bounds if potential is None else
+                         np.minimum(potential, bounds))
+        return np.maximum(potential, 0.0)
+
+
+def select(route_graph, count=DEFAULT_COUNT):
+    '''Pick landmarks around the edge of the graph: the node furthest from
+    the center in each of `count` equal angular sectors. Only nodes
+    connected to the node nearest the center are considered, so that small
+    disconnected pieces don't waste landmarks.
+
+    :returns: array of node indices (fewer than `count` if some sectors are
+              empty).
+
+    '''
+    coords = route_graph.node_coords
+    scale = np.array([np.cos(np.radians(coords[:, 1].mean())), 1.0])
+    offsets = (coords - coords.mean(axis=0)) * scale
+    radius = np.hypot(offsets[:, 0], offsets[:, 1])
+
+    # The component of the center, ignoring edge directions and costs
+    center = int(np.argmin(radius))
+    reached, _ = search.dijkstra(route_graph, center, route_graph.length)
+    connected = np.zeros(route_graph.n_nodes, dtype=bool)
+    connected[list(reached)] = True
+
+    angle = np.arctan2(offsets[:, 1], offsets[:, 0])
+    sector = ((angle + np.pi) / (2 * np.pi) * count).astype(int) % count
+    nodes = []
+    for i in range(count):
+        candidates = np.nonzero(connected & (sector == i))[0]
+        if len(candidates):
+            nodes.append(candidates[np.argmax(radius[candidates])])
+    return np.array(nodes, dtype=np.int32)
+
+
+def build(route_graph, cost, reverse_cost, count=DEFAULT_COUNT):
+    '''Compute landmarks for one cost profile: two searches over the whole
+    graph per landmark, so this is meant to be run offline.
+
+    :param cost: Per-edge cost of the profile, from source to target.
+    :type cost: numpy.ndarray
+    :param reverse_cost: Per-edge cost from target to source.
+    :type reverse_cost: numpy.ndarray
+    :rtype: Landmarks
+
+    '''
+    nodes = select(route_graph, count)
+    shape = (len(nodes), route_graph.n_nodes)
+    from_cost = np.full(shape, np.inf)
+    to_cost = np.full(shape, np.inf)
+    for i, node in enumerate(nodes.tolist()):
+        reached, _ = search.dijkstra(route_graph, node, cost, reverse_cost)
+        from_cost[i, list(reached)] = list(reached.values())
+        # Swapping the costs turns the search around: costs *to* the node
+        reached, _ = search.dijkstra(route_graph, node, reverse_cost, cost)
+        to_cost[i, list(reached)] = list(reached.values())
+    return Landmarks(nodes, from_cost, to_cost)
+
+
+def build_profiles(route_graph, count=DEFAULT_COUNT):
+    '''Compute landmarks for every standard profile (costs.PROFILES) and
+    store them in `route_graph.landmarks`.'''
+    costfun = costs.manual_wheelchair_array
+    for name in sorted(costs.PROFILES):
+        params = costs.PROFILES[name]
+        cost = costs.edge_costs(route_graph, costfun, **params)
+        reverse_cost = costs.edge_costs(route_graph, costfun, reverse=True,
+                                        **params)
+        route_graph.landmarks[costs.profile_key(costfun, **params)] = build(
+            route_graph, cost, reverse_cost, count)
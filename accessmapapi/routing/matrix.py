@@ -0,0 +1,147 @@
+'''Cost and distance matrices between many points. Rather than routing every
+pair separately, all points are snapped at once and a single shortest-path
+tree is grown per source.'''
+from accessmapapi import db, snapshot
+from . import costs, search
+
+
+def cost_matrix(sources, destinations, **cost_params):
+    '''Calculate the cost and distance of travelling from every source to
+    every destination, one source at a time.
+
+    :param sources: [lat, lon] pairs.
+    :type sources: list
+    :param destinations: [lat, lon] pairs.
+    :type destinations: list
+    :param cost_params: Cost function parameters (see
+                        costs.manual_wheelchair_array and
+                        costs.profile_params).
+    :returns: Generator yielding one (costs, distances) pair of lists per
+              source, aligned with `destinations`. Unreachable destinations
+              are None.
+
+    '''
+    # Resolved here rather than in the generator, which may be advanced on
+    # other threads (see workers.iterate)
+    route_graph = snapshot.memory_graph()
+    if route_graph is not None:
+        return _memory_rows(route_graph, snapshot.edge_index(), sources,
+                            destinations, cost_params)
+    nodes = snapshot.nearest(list(sources) + list(destinations))
+    return _pgrouting_rows(nodes[:len(sources)], nodes[len(sources):],
+                           cost_params)
+
+
+def _memory_rows(route_graph, edge_index, sources, destinations,
+                 cost_params):
+    snaps = edge_index.nearest(list(sources) + list(destinations))
+    source_snaps = snaps[:len(sources)]
+    dest_snaps = snaps[len(sources):]
+
+    costfun = costs.manual_wheelchair_array
+    cost = costs.edge_costs(route_graph, costfun, **cost_params)
+    reverse_cost = costs.edge_costs(route_graph, costfun, reverse=True,
+                                    **cost_params)
+
+    # Nodes from which each destination's virtual node can be reached
+    dest_splits = [None if snap is None else
+                   snap.split_costs(cost, reverse_cost, leaving=False)
+                   for snap in dest_snaps]
+    targets = set()
+    for split in dest_splits:
+        if split is not None:
+            targets.update(split)
+
+    for source_snap in source_snaps:
+        n = len(dest_snaps)
+        if source_snap is None:
+            yield [None] * n, [None] * n
+            continue
+
+        start = source_snap.split_costs(cost, reverse_cost, leaving=True)
+        tree, pred = search.dijkstra(route_graph, start, cost, reverse_cost,
+                                     targets=targets)
+        lengths = {}
+
+        row_costs = []
+        row_distances = []
+        for dest_snap, split in zip(dest_snaps, dest_splits):
+            best_cost = None
+            best_distance = None
+            if split is not None:
+                for node, split_cost in split.items():
+                    if node not in tree:
+                        continue
+                    node_cost = tree[node] + split_cost
+                    if best_cost is None or node_cost < best_cost:
+                        best_cost = node_cost
+                        best_distance = (
+                            _tree_length(route_graph, pred, node, lengths,
+                                         source_snap) +
+                            dest_snap.partial_length(node))
+                direct = source_snap.direct_to(dest_snap, cost, reverse_cost)
+                if direct is not None and (best_cost is None or
+                                           direct[0] <= best_cost):
+                    best_cost, best_distance = direct[0], direct[1]
+            row_costs.append(best_cost)
+            row_distances.append(best_distance)
+
+        yield row_costs, row_distances
+
+
+def _tree_length(route_graph, pred, node, lengths, source_snap):
+    '''Distance from the source's virtual node to a node of its shortest-path
+    tree. Results are memoized in `lengths`, so each tree edge is only
+    summed once however many destinations share it.'''
+    chain = []
+    while node not in lengths:
+        step = pred[node]
+        if step is None:
+            lengths[node] = source_snap.partial_length(node)
+            break
+        chain.append((node, step))
+        node = step[0]
+
+    for node, (u, edge, forward) in reversed(chain):
+        lengths[node] = lengths[u] + route_graph.length[edge]
+
+    return float(lengths[chain[0][0]] if chain else lengths[node])
+
+
+# One search per source, to all of its targets at once
+MATRIX_ROW = db.PreparedStatement(
+    'matrix_row',
+    [('source_node', 'integer'),
+     ('targets', 'integer[]')] + costs.SQL_PARAMS,
+    '''
+      SELECT path.id1::integer AS target,
+             SUM(routing.length)::double precision,
+             SUM(path.cost)::double precision
+        FROM pgr_kdijkstraPath({}, $1, $2, true, true) AS path
+        JOIN routing
+          ON routing.id = path.id3
+    GROUP BY path.id1
+    '''.format(costs.pgr_edges('routing', 3)))
+
+
+def _pgrouting_rows(source_nodes, dest_nodes, cost_params):
+    params = costs.sql_params(**cost_params)
+
+    for source_node in source_nodes:
+        found = {source_node: (0.0, 0.0)}
+        targets = set(dest_nodes) - {source_node}
+        if targets:
+            rows = MATRIX_ROW.execute(source_node=int(source_node),
+                                      targets=[int(node) for node in targets],
+                                      **params)
+            for target, distance, cost in rows:
+                found[target] = (distance, cost)
+
+        row_costs = []
+        row_distances = []
+        for dest_node in dest_nodes:
+            distance, cost = found.get(dest_node, (None, None))
+            row_costs.append(cost)
+            row_distances.append(distance)
+
+        yield row_costs, row_distances
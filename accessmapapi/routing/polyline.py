@@ -0,0 +1,36 @@
+'''Encoded polyline geometries (the Google / OSRM / Mapbox format): every
+coordinate is rounded to a fixed number of decimals and stored as the
+difference from the previous one, packed into printable ASCII characters.
+Route geometries come out at a fraction of the size of GeoJSON coordinate
+lists.'''
+import numpy as np
+
+
+def encode(coords, precision=5):
+    '''Encode a line as a polyline string.
+
+    :param coords: (lon, lat) coordinates, as in GeoJSON. Polylines store
+                   them as (lat, lon).
+    :type coords: list
+    :param precision: Number of decimals to keep - 5 for the standard
+                      polyline, 6 for `polyline6`.
+    :type precision: int
+
+    '''
+    if not len(coords):
+        return ''
+    points = np.asarray(coords, dtype=np.float64)[:, ::-1]
+    scaled = np.round(points * 10 ** precision).astype(np.int64)
+    deltas = scaled.copy()
+    deltas[1:] -= scaled[:-1]
+    # Zigzag: sign in the lowest bit
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1).ravel()
+
+    chunks = []
+    for value in values.tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
@@ -1,109 +1,117 @@
-from accessmapapi import db
-from . import costs
+from accessmapapi import app, db, results, snapshot, timing
+from . import costs, directions, polyline, search
+from concurrent import futures
+import collections
 import json
+import threading
 
+import numpy as np
 
-def routing_request(waypoints):
+
+# Values of the `geometries` option: the number of decimals of encoded
+# polylines, or None for GeoJSON
+GEOMETRIES = {'geojson': None, 'polyline': 5, 'polyline6': 6}
+
+# Alternative routes (see _memory_alternatives): the edges of every route
+# found cost PENALTY times more in the next search. A route is only an
+# alternative if no more than MAX_OVERLAP of its length is shared with any
+# other route and it costs at most MAX_STRETCH times the best one. At most
+# MAX_ATTEMPTS searches are run per alternative asked for.
+MAX_ALTERNATIVES = 3
+PENALTY = 2.0
+MAX_OVERLAP = 0.7
+MAX_STRETCH = 1.5
+MAX_ATTEMPTS = 2
+
+
+def routing_request(waypoints, geometries='geojson', alternatives=0,
+                    **cost_params):
     '''Process a routing request, returning a Mapbox-compatible routing JSON
-    object.
+    object. The route visits every waypoint in order.
 
-    :param waypoints: list of coordinates for start, stop locations
+    :param waypoints: list of coordinates for start, (optional) via and stop
+                      locations
     :type waypoints: list of lists of coordinates
+    :param geometries: Format of the route geometry: 'geojson' (a
+                       LineString), 'polyline' or 'polyline6' (an encoded
+                       polyline string with 5 or 6 decimals).
+    :type geometries: str
+    :param alternatives: Number of alternative routes to look for, besides
+                         the best one (up to MAX_ALTERNATIVES). Only routes
+                         without via points on the in-memory engine get
+                         alternatives.
+    :type alternatives: int
+    :param cost_params: Cost function parameters (see
+                        costs.manual_wheelchair_array and
+                        costs.profile_params).
 
     '''
-    routing_table = 'routing'
-    # Isolate first and last points
-    origin = waypoints.pop(0)
-    dest = waypoints.pop()
-    # Find sidewalks closest to origin and destination ###
-    routing_vertices_table = routing_table + '_vertices_pgr'
-
-    # BIG FIXME: WOW, these aren't injection safe at all (Bobby Tables...)
-    point_sql = 'ST_SetSRID(ST_Makepoint({}, {}), 4326)'
-    # Note that in geoJSON, the order is [lon, lat], so reversed order here
-    origin_geom = point_sql.format(origin[1], origin[0])
-    dest_geom = point_sql.format(dest[1], dest[0])
-
-    # FIXME: The closest node to the selected point is not actually what we
-    # want - that ends up with weird backtracking scenarios. What we want is
-    # something like a new virtual node on the closest edge - i.e. the closest
-    # realistic start point in the real world. I haven't been able to find a
-    # pre-built solution for this in pgRouting. pgr_trsp can start and end at
-    # edges + a distance along that edge, but it may not work easily with
-    # custom cost functions (verify that). We can also roll our own option.
-    # It will add some complication, as we'll need to calculate costs for the
-    # two virtual edges of our virtual node. To do that super accurately, we'd
-    # need to go back to the functions used to label data and apply them again
-    # or approximate new costs (or attributes) on the virtual edges.
-    # FIXME: Once closest-edge selection is implemented, remember to include
-    # sidewalk edges and corners and disclude crossing edges.
-    closest_row_sql = '''  SELECT id
-                             FROM {}
-                         ORDER BY ST_Distance(the_geom, {})
-                            LIMIT 1'''
-    origin_query = closest_row_sql.format(routing_vertices_table, origin_geom)
-    dest_query = closest_row_sql.format(routing_vertices_table, dest_geom)
-
-    result = db.engine.execute(origin_query)
-    start_node = list(result)[0][0]
-    result.close()
-
-    result = db.engine.execute(dest_query)
-    end_node = list(result)[0][0]
-    result.close()
-
-    # Cost function and routing
-    cost_fun = costs.manual_wheelchair('length', 'grade', 'iscrossing')
-
-    ###########################################
-    # With start/end nodes, get optimal route #
-    ###########################################
-    # node_start = 15307
-    # node_end = 15308
-    # Origin and Destination nodes in pgRouting vertex table
-    pgr_sql = '''SELECT id::integer,
-                        source::integer,
-                        target::integer,
-                        {}::double precision AS cost
-                   FROM {}'''.format(cost_fun, routing_table)
-    # Request route - turn geometries directly into GeoJSON
-    route_sql = '''SELECT seq,
-                          id1::integer AS node,
-                          id2::integer AS edge,
-                          cost
-                     FROM pgr_dijkstra('{}',{},{},{},{})'''
-    route_query = route_sql.format(pgr_sql, start_node, end_node, 'false',
-                                   'false')
-    # FIXME: need to catch NULL result from route query, then get geojson
-    # SELECT ST_AsGeoJSON(ST_LineMerge(ST_Collect(route.geom)), 7)
-    output_sql = '''
-    SELECT ST_AsGeoJSON(route.geom, 7)
-      FROM (
-            SELECT CASE source
-                   WHEN pgr.node
-                   THEN geom
-                   ELSE ST_Reverse(geom)
-                    END
-                     AS geom
-              FROM {}
-              JOIN ({}) AS pgr
-                ON id = pgr.edge) AS route
+    route_graph = snapshot.memory_graph()
+    if route_graph is not None:
+        # Trips start and end at virtual nodes on the closest sidewalk edges
+        routes = _memory_routes(route_graph, waypoints, cost_params,
+                                min(alternatives, MAX_ALTERNATIVES))
+    else:
+        # FIXME: The closest node to the selected point is not actually what
+        # we want - that ends up with weird backtracking scenarios. The
+        # in-memory engine splits the closest edge at a virtual node instead,
+        # but I haven't been able to find a pre-built solution for this in
+        # pgRouting. pgr_trsp can start and end at edges + a distance along
+        # that edge, but it may not work easily with custom cost functions
+        # (verify that).
+        with timing.stage('snap'):
+            nodes = snapshot.nearest(waypoints)
+        with timing.stage('pgr_dijkstra'):
+            legs = _pgrouting_legs(nodes, cost_params)
+        routes = None if legs is None else [legs]
+
+    return _response(waypoints, routes, geometries)
+
+
+def batch_request(waypoint_lists, geometries='geojson', **cost_params):
+    '''Process many routing requests at once (see routing_request), e.g. for
+    overnight audits. The points of all the routes are snapped in one batch
+    and the legs are grouped by origin. On the in-memory engine, legs that
+    start at the same point share one search (see _memory_batch); with
+    pgRouting, each distinct leg is queried once (see _pgrouting_batch).
+
+    :param waypoint_lists: The waypoints of each route.
+    :type waypoint_lists: list of lists of coordinates
+    :param geometries: See routing_request.
+    :type geometries: str
+    :param cost_params: See routing_request - the same for every route.
+    :returns: Generator yielding an (index in `waypoint_lists`, routing
+              response) pair per route, as soon as each is done - not
+              necessarily in order.
+
     '''
+    # Resolved here rather than in the generator, which may be advanced on
+    # other threads (see workers.iterate)
+    route_graph = snapshot.memory_graph()
+    if route_graph is not None:
+        return _memory_batch(route_graph, snapshot.edge_index(),
+                             waypoint_lists, geometries, cost_params)
+    return _pgrouting_batch(waypoint_lists, geometries, cost_params)
 
-    output_query = output_sql.format(routing_table, route_query)
 
-    result = db.engine.execute(output_query)
-    route_rows = list(result)
-    result.close()
-    if not route_rows:
+def _response(waypoints, routes, geometries):
+    '''The response to a routing request, given the legs of its routes (or
+    None if there is no route).'''
+    if routes is None:
         return {'code': 'NoRoute',
                 'waypoints': [],
                 'routes': []}
+    # Isolate first and last points
+    origin = waypoints[0]
+    dest = waypoints[-1]
+    via = waypoints[1:-1]
+    with timing.stage('assemble'):
+        return _route_response(origin, dest, via, routes, geometries)
 
-    coords = []
-    for row in route_rows:
-        coords += json.loads(row[0])['coordinates']
 
+def _route_response(origin, dest, via, routes_legs, geometries='geojson'):
+    '''Build the route response (see routing_request) out of the legs of
+    each route, best route first.'''
     # Produce the response
     # TODO: return JSON directions similar to Mapbox or OSRM so e.g.
     # leaflet-routing-machine can be used
@@ -112,30 +120,33 @@ def routing_request(waypoints):
     JSON hash with:
         origin: geoJSON Feature with Point geometry for start point of route
         destination: geoJSON Feature with Point geometry for end point of route
-        waypoints: array of geoJSON Feature Points
-        routes: array of routes in descending order (just 1 for now):
-            summary: A short, human-readable summary of the route. DISABLED.
-            geometry: geoJSON LineString of the route (OSRM/Mapbox use
-                      polyline, often)
-            steps: optional array of route steps (directions/maneuvers).
-                   (NOT IMPLEMENTED YET)
-                way_name: way along which travel proceeds
+        waypoints: array of geoJSON Feature Points (the via points between
+                   origin and destination)
+        routes: array of routes, the best one first and then any
+                alternatives (see the `alternatives` parameter):
+            geometry: geoJSON LineString of the route, or an encoded
+                      polyline string (see the `geometries` parameter)
+            distance: distance of route in meters
+            cost: total cost of the route
+            legs: one entry per pair of consecutive waypoints:
+                distance: distance of the leg in meters
+                cost: cost of the leg
+            steps: array of route steps (directions/maneuvers), see
+                   directions.steps:
+                way_name: way along which travel proceeds ('sidewalk' or
+                          'crossing' - no street names yet)
                 direction: cardinal direction (e.g. N, SW, E, etc)
-                maneuver: JSON object representing the maneuver
-                    No spec yet, but will mirror driving directions:
-                        type: string of type of maneuver (short) e.g. cross
-                              left/right
+                heading: bearing at the start of the step, in degrees
+                distance: distance from step maneuver to next step
+                maneuver: JSON object representing the maneuver, mirroring
+                          driving directions:
+                        type: depart, turn, cross, waypoint or arrive
+                        modifier: e.g. left, slight right, straight
                         location: geoJSON Point geometry of maneuver location
                         instruction: e.g.
-                            turn left and cross <street> on near side
-
-
-    TODO:
-        Add these to routes:
-            distance: distance of route in meters
-        Add these to steps:
-            distance: distance from step maneuver to next step
-            heading: what is this for? Drawing an arrow maybe?
+                            Cross the street heading north - no curb ramps
+            summary: number of street crossings, and how many have no curb
+                     ramps
     '''
     origin_feature = {'type': 'Feature',
                       'geometry': {'type': 'Point',
@@ -147,40 +158,16 @@ def routing_request(waypoints):
                                  'coordinates': [dest[1], dest[0]]},
                     'properties': {}}
     waypoints_feature_list = []
-    for waypoint in waypoints:
+    for waypoint in via:
         waypoint_feature = {'type': 'Feature',
                             'geometry': {'type': 'Point',
-                                         'coordinates': waypoint},
+                                         'coordinates': [waypoint[1],
+                                                         waypoint[0]]},
                             'properties': {}}
         waypoints_feature_list.append(waypoint_feature)
 
-    # TODO: here's where to add alternative routes once we have them
-    routes = []
-    route = {}
-    route['geometry'] = {'type': 'LineString',
-                         'coordinates': []}
-    # Route geometries look like [coord1, coord2], if we just concatenated then
-    # coord2 from the first geometry is coord1 from the second - gotta exclude
-    # the first one after the initial
-    # FIXME: prepended and appended waypoints to fix bug - shouldn't
-    #        pgrouting return them as part of the steps?
-    # Origin coordinates (start)
-    route['geometry']['coordinates'].append([origin[1], origin[0]])
-    # Route coordinates
-    route['geometry']['coordinates'] += coords
-    # for geom in route_geoms:
-    #     # FIXME: this isn't quite what we want (likely has redundant points)
-    #     #        instead, generate polyline in the SQL command
-    #     for coord in geom['coordinates']:
-    #         route['geometry']['coordinates'].append(coord)
-    # Destination coordinates (end)
-    route['geometry']['coordinates'].append([dest[1], dest[0]])
-
-    # TODO: Add steps!
-    route['steps'] = []
-    route['summary'] = ''
-
-    routes.append(route)
+    routes = [_route(origin, dest, legs, geometries)
+              for legs in routes_legs]
 
     route_response = {}
     route_response['origin'] = origin_feature
@@ -190,3 +177,555 @@ def routing_request(waypoints):
     route_response['code'] = 'Ok'
 
     return route_response
+
+
+def _route(origin, dest, legs, geometries):
+    '''Build one route of the response out of its legs.'''
+    # Legs may be shared with the result cache - copy before modifying
+    legs = [dict(leg) for leg in legs]
+    route = {}
+    # FIXME: prepended and appended waypoints to fix bug - shouldn't
+    #        pgrouting return them as part of the steps?
+    # Origin coordinates (start)
+    coords = [[origin[1], origin[0]]]
+    # Route coordinates: legs meet at the via points, so skip the repeated
+    # coordinate where one leg ends and the next begins. Leg edges refer to
+    # leg coordinates - shift them to the route's.
+    leg_edges = []
+    for leg in legs:
+        start = _extend(coords, leg.pop('coordinates'))
+        leg_edges.append([[iscrossing, distance, start + first, start + last,
+                           curbramps]
+                          for iscrossing, distance, first, last, curbramps
+                          in leg.pop('edges')])
+    # Destination coordinates (end)
+    _extend(coords, [[dest[1], dest[0]]])
+
+    route['legs'] = legs
+    route['distance'] = sum(leg['distance'] for leg in legs)
+    route['cost'] = sum(leg['cost'] for leg in legs)
+
+    route['steps'] = directions.steps(coords, leg_edges)
+    route['summary'] = directions.summary([edge for edges in leg_edges
+                                           for edge in edges])
+
+    precision = GEOMETRIES[geometries]
+    if precision is None:
+        route['geometry'] = {'type': 'LineString',
+                             'coordinates': coords}
+    else:
+        route['geometry'] = polyline.encode(coords, precision)
+
+    return route
+
+
+# Threads running the pgr_dijkstra queries of multi-waypoint routes, shared
+# by all requests (see _leg_executor)
+_leg_executor_state = {'executor': None}
+_leg_executor_lock = threading.Lock()
+
+
+def _leg_executor():
+    '''The executor for route legs: ROUTE_LEG_WORKERS threads in all, so
+    that busy times don't multiply threads and database connections.'''
+    executor = _leg_executor_state['executor']
+    if executor is None:
+        with _leg_executor_lock:
+            executor = _leg_executor_state['executor']
+            if executor is None:
+                executor = futures.ThreadPoolExecutor(
+                    max_workers=app.config['ROUTE_LEG_WORKERS'])
+                _leg_executor_state['executor'] = executor
+    return executor
+
+
+def _pgrouting_legs(nodes, cost_params):
+    '''Route through a sequence of routing vertices with pgr_dijkstra, one
+    query per leg. Legs are independent, so they run concurrently on separate
+    database connections (see _leg_executor).
+
+    :param nodes: routing_vertices_pgr ids, in the order to visit them.
+    :type nodes: list of int
+    :param cost_params: Cost function parameters.
+    :type cost_params: dict
+    :returns: list of legs (see _pgrouting_leg), or None if any leg has no
+              route.
+
+    '''
+    # Cost function parameters
+    params = costs.sql_params(**cost_params)
+    profile = costs.profile_key(costs.manual_wheelchair_array, **cost_params)
+
+    pairs = list(zip(nodes[:-1], nodes[1:]))
+    if len(pairs) == 1:
+        legs = [_pgrouting_cached_leg(pairs[0], params, profile)]
+    else:
+        legs = _pgrouting_concurrent_legs(pairs, params, profile)
+
+    if any(leg is None for leg in legs):
+        return None
+    return legs
+
+
+def _pgrouting_cached_leg(pair, params, profile):
+    '''Route between a (start, end) pair of routing vertices (see
+    _pgrouting_leg), through the result cache.'''
+    start_node, end_node = pair
+    return results.get_or_compute(
+        ('route', 'pgrouting', start_node, end_node, profile),
+        lambda: _pgrouting_leg(start_node, end_node, params))
+
+
+def _pgrouting_concurrent_legs(pairs, params, profile):
+    '''Route between many (start, end) pairs of routing vertices at once, on
+    the leg executor (see _pgrouting_cached_leg).
+
+    :returns: list of legs, in the order of `pairs`.
+
+    '''
+    # Leg threads use the statement timeout of the calling thread
+    timeout = db.current_statement_timeout()
+
+    def leg(pair):
+        with db.statement_timeout(timeout):
+            return _pgrouting_cached_leg(pair, params, profile)
+
+    return list(_leg_executor().map(leg, pairs))
+
+
+def _pgrouting_batch(waypoint_lists, geometries, cost_params):
+    '''Route many requests with pgRouting (see batch_request). The points of
+    all the routes are snapped in one batch, and the legs are grouped by
+    their origin vertex: each distinct leg is queried once, and the legs
+    from one origin are queried together on the leg executor. Unlike on the
+    in-memory engine, every distinct leg is still its own pgr_dijkstra
+    search.'''
+    with timing.stage('snap'):
+        nodes = snapshot.nearest(
+            [point for waypoints in waypoint_lists for point in waypoints])
+
+    params = costs.sql_params(**cost_params)
+    profile = costs.profile_key(costs.manual_wheelchair_array, **cost_params)
+
+    # (route, leg) indices of every leg, by origin and then destination
+    groups = collections.OrderedDict()
+    legs = []
+    offset = 0
+    for i, waypoints in enumerate(waypoint_lists):
+        route_nodes = nodes[offset:offset + len(waypoints)]
+        offset += len(waypoints)
+        legs.append([None] * (len(route_nodes) - 1))
+        for j, (start_node, end_node) in enumerate(zip(route_nodes[:-1],
+                                                       route_nodes[1:])):
+            ends = groups.setdefault(start_node, collections.OrderedDict())
+            ends.setdefault(end_node, []).append((i, j))
+
+    pending = [len(route_legs) for route_legs in legs]
+    for start_node, ends in groups.items():
+        pairs = [(start_node, end_node) for end_node in ends]
+        with timing.stage('pgr_dijkstra'):
+            found = _pgrouting_concurrent_legs(pairs, params, profile)
+        for (_, end_node), leg in zip(pairs, found):
+            for i, j in ends[end_node]:
+                legs[i][j] = leg
+                pending[i] -= 1
+                if pending[i] == 0:
+                    route_legs = legs[i]
+                    legs[i] = None
+                    routes = None if None in route_legs else [route_legs]
+                    yield i, _response(waypoint_lists[i], routes, geometries)
+
+
+# Route between two routing vertices - turn geometries directly into GeoJSON.
+# The cost function parameters are bound like the vertices, so one plan
+# serves every request.
+ROUTE_LEG = db.PreparedStatement(
+    'route_leg',
+    [('start_node', 'integer'),
+     ('end_node', 'integer')] + costs.SQL_PARAMS,
+    '''
+    SELECT ST_AsGeoJSON(route.geom, 7),
+           route.length,
+           route.cost,
+           route.iscrossing,
+           route.curbramps
+      FROM (
+            SELECT CASE source
+                   WHEN pgr.id1
+                   THEN geom
+                   ELSE ST_Reverse(geom)
+                    END
+                     AS geom,
+                   length::double precision,
+                   pgr.cost,
+                   iscrossing = 1 AS iscrossing,
+                   COALESCE(curbramps, false) AS curbramps,
+                   pgr.seq
+              FROM routing
+              JOIN pgr_dijkstra({}, $1, $2, true, true) AS pgr
+                ON id = pgr.id2) AS route
+    ORDER BY route.seq
+    '''.format(costs.pgr_edges('routing', 3)))
+
+
+def _pgrouting_leg(start_node, end_node, params):
+    '''Route between two routing vertices with pgr_dijkstra.
+
+    :param params: The cost function parameters (see costs.sql_params).
+    :type params: dict
+    :returns: dict with the concatenated coordinates of the route edges
+              ('coordinates'), the 'edges' (see directions.py), 'distance'
+              and 'cost' - or None if there is no route.
+
+    '''
+    if start_node == end_node:
+        return {'coordinates': [], 'edges': [], 'distance': 0.0, 'cost': 0.0}
+
+    route_rows = ROUTE_LEG.execute(start_node=int(start_node),
+                                   end_node=int(end_node), **params)
+    if not route_rows:
+        return None
+
+    coords = []
+    edges = []
+    for row in route_rows:
+        edge_coords = json.loads(row[0])['coordinates']
+        first = _extend(coords, edge_coords)
+        edges.append([bool(row[3]), row[1] or 0.0, first,
+                      first + len(edge_coords) - 1, bool(row[4])])
+
+    return {'coordinates': coords,
+            'edges': edges,
+            'distance': sum(row[1] or 0.0 for row in route_rows),
+            'cost': sum(row[2] for row in route_rows)}
+
+
+def _memory_routes(route_graph, waypoints, cost_params, alternatives=0):
+    '''Route through a sequence of [lat, lon] points on the in-memory routing
+    graph. All points are snapped in one batch and every leg is searched
+    with the same edge cost array.
+
+    Each point is snapped to the closest point on a sidewalk or corner edge,
+    which splits that edge into two virtual edges (see spatial.EdgeSnap).
+    Prorating the parent edge's cost by length approximates re-labeling the
+    virtual edges from scratch.
+
+    :param alternatives: Number of alternative routes to look for (see
+                         _memory_alternatives) - only between two points.
+    :type alternatives: int
+    :returns: list of routes, each a list of legs (see _memory_leg): the
+              best route, then the alternatives. None if any leg has no
+              route.
+
+    '''
+    with timing.stage('snap'):
+        snaps = snapshot.edge_index().nearest(waypoints)
+    if None in snaps:
+        return None
+
+    costfun = costs.manual_wheelchair_array
+    profile = costs.profile_key(costfun, **cost_params)
+    cost = costs.edge_costs(route_graph, costfun, **cost_params)
+    reverse_cost = costs.edge_costs(route_graph, costfun, reverse=True,
+                                    **cost_params)
+    # Only standard profiles have landmarks (see landmarks.py)
+    profile_landmarks = route_graph.landmarks.get(profile)
+
+    legs = []
+    for start_snap, end_snap in zip(snaps[:-1], snaps[1:]):
+        with timing.stage('search'):
+            leg = results.get_or_compute(
+                ('route', 'memory', start_snap.key, end_snap.key, profile),
+                lambda: _memory_leg(route_graph, start_snap, end_snap, cost,
+                                    reverse_cost, profile_landmarks))
+        if leg is None:
+            return None
+        legs.append(leg)
+
+    routes = [legs]
+    if alternatives > 0 and len(snaps) == 2:
+        start_snap, end_snap = snaps
+        with timing.stage('alternatives'):
+            found = results.get_or_compute(
+                ('alternatives', 'memory', start_snap.key, end_snap.key,
+                 profile, alternatives),
+                lambda: _memory_alternatives(route_graph, start_snap,
+                                             end_snap, cost, reverse_cost,
+                                             legs[0]['cost'], alternatives))
+        routes += [[leg] for leg in found]
+
+    return routes
+
+
+def _memory_leg(route_graph, start_snap, end_snap, cost, reverse_cost,
+                profile_landmarks=None):
+    '''Route between two snapped points on the in-memory routing graph.
+
+    :param profile_landmarks: ALT landmarks of the cost profile, for an A*
+                              search instead of a bidirectional Dijkstra
+                              search.
+    :type profile_landmarks: landmarks.Landmarks
+    :returns: dict with the route 'coordinates', 'edges' (see
+              directions.py), 'distance' and 'cost' - or None if there is no
+              route.
+
+    '''
+    start = start_snap.split_costs(cost, reverse_cost, leaving=True)
+    end = end_snap.split_costs(cost, reverse_cost, leaving=False)
+    if profile_landmarks is not None and start and end:
+        found = search.astar(route_graph, start, end, cost, reverse_cost,
+                             profile_landmarks.potential(start, end))
+    else:
+        found = search.bidirectional_dijkstra(route_graph, start, end, cost,
+                                              reverse_cost)
+    return _found_leg(route_graph, start_snap, end_snap, cost, reverse_cost,
+                      found)
+
+
+def _tree_leg(route_graph, start_snap, end_snap, cost, reverse_cost, tree,
+              pred):
+    '''Route between two snapped points using a shortest-path tree grown
+    from the first one (see search.dijkstra), which must have reached the
+    ends of the second one's edge. Returns the same as _memory_leg.'''
+    end = end_snap.split_costs(cost, reverse_cost, leaving=False)
+    found = None
+    for node, end_cost in end.items():
+        if node in tree and (found is None or
+                             tree[node] + end_cost < found[0]):
+            first, path = search.path_to(pred, node)
+            found = (tree[node] + end_cost, path, first, node)
+    return _found_leg(route_graph, start_snap, end_snap, cost, reverse_cost,
+                      found)
+
+
+def _found_leg(route_graph, start_snap, end_snap, cost, reverse_cost, found):
+    '''Build a leg (see _memory_leg) out of the result of a search between
+    two snapped points.'''
+    # Both points on one edge: the graph route may go around the block, while
+    # the direct one just follows the edge.
+    direct = start_snap.direct_to(end_snap, cost, reverse_cost)
+    if direct is not None and (found is None or direct[0] <= found[0]):
+        direct_cost, distance, coords = direct
+        return {'coordinates': coords,
+                'edges': [_edge(route_graph, start_snap.edge, distance, 0,
+                                len(coords) - 1)],
+                'distance': distance,
+                'cost': direct_cost}
+
+    if found is None:
+        return None
+    total_cost, path, first, last = found
+    return _path_leg(route_graph, start_snap, end_snap, path, first, last,
+                     total_cost)
+
+
+def _memory_batch(route_graph, edge_index, waypoint_lists, geometries,
+                  cost_params):
+    '''Route many requests on the in-memory graph (see batch_request). The
+    legs of all the routes are grouped by their snapped origin: an origin
+    with several legs gets one shortest-path tree, grown until it reaches
+    all of their destinations, instead of one search per leg. Every leg
+    goes through the result cache, as with routing_request.'''
+    with timing.stage('snap'):
+        snaps = edge_index.nearest(
+            [point for waypoints in waypoint_lists for point in waypoints])
+
+    costfun = costs.manual_wheelchair_array
+    profile = costs.profile_key(costfun, **cost_params)
+    cost = costs.edge_costs(route_graph, costfun, **cost_params)
+    reverse_cost = costs.edge_costs(route_graph, costfun, reverse=True,
+                                    **cost_params)
+    profile_landmarks = route_graph.landmarks.get(profile)
+
+    # Legs of each route, grouped by their origin's snap key
+    groups = collections.OrderedDict()
+    legs = []
+    offset = 0
+    for i, waypoints in enumerate(waypoint_lists):
+        route_snaps = snaps[offset:offset + len(waypoints)]
+        offset += len(waypoints)
+        if None in route_snaps:
+            legs.append(None)
+            yield i, _response(waypoints, None, geometries)
+            continue
+        legs.append([None] * (len(route_snaps) - 1))
+        for j, (start_snap, end_snap) in enumerate(zip(route_snaps[:-1],
+                                                       route_snaps[1:])):
+            group = groups.setdefault(start_snap.key, (start_snap, []))
+            group[1].append((i, j, end_snap))
+
+    pending = [0 if route_legs is None else len(route_legs)
+               for route_legs in legs]
+    for start_snap, group_legs in groups.values():
+        # The tree is only grown if some leg isn't in the result cache
+        trees = []
+
+        def tree_leg(end_snap):
+            if not trees:
+                start = start_snap.split_costs(cost, reverse_cost,
+                                               leaving=True)
+                targets = set()
+                for _, _, group_end in group_legs:
+                    targets.update(group_end.split_costs(cost, reverse_cost,
+                                                         leaving=False))
+                trees.append(search.dijkstra(route_graph, start, cost,
+                                             reverse_cost, targets=targets))
+            tree, pred = trees[0]
+            return _tree_leg(route_graph, start_snap, end_snap, cost,
+                             reverse_cost, tree, pred)
+
+        for i, j, end_snap in group_legs:
+            if len(group_legs) == 1:
+                compute = (lambda: _memory_leg(route_graph, start_snap,
+                                               end_snap, cost, reverse_cost,
+                                               profile_landmarks))
+            else:
+                compute = (lambda: tree_leg(end_snap))
+            with timing.stage('search'):
+                legs[i][j] = results.get_or_compute(
+                    ('route', 'memory', start_snap.key, end_snap.key,
+                     profile),
+                    compute)
+            pending[i] -= 1
+            if pending[i] == 0:
+                route_legs = legs[i]
+                legs[i] = None
+                routes = None if None in route_legs else [route_legs]
+                yield i, _response(waypoint_lists[i], routes, geometries)
+
+
+def _path_leg(route_graph, start_snap, end_snap, path, first, last,
+              total_cost):
+    '''Build a leg (see _memory_leg) out of a path found by
+    search.bidirectional_dijkstra.'''
+
+    coords = start_snap.partial_coords(first, leaving=True)
+    edges = [_edge(route_graph, start_snap.edge,
+                   start_snap.partial_length(first), 0, len(coords) - 1)]
+    for edge, forward in path:
+        edge_coords = route_graph.edge_coords(edge, forward)
+        start = _extend(coords, edge_coords)
+        edges.append(_edge(route_graph, edge, route_graph.length[edge],
+                           start, start + len(edge_coords) - 1))
+    end_coords = end_snap.partial_coords(last, leaving=False)
+    start = _extend(coords, end_coords)
+    edges.append(_edge(route_graph, end_snap.edge,
+                       end_snap.partial_length(last), start,
+                       start + len(end_coords) - 1))
+
+    distance = (start_snap.partial_length(first) +
+                sum(route_graph.length[edge] for edge, forward in path) +
+                end_snap.partial_length(last))
+
+    return {'coordinates': coords,
+            'edges': edges,
+            'distance': float(distance),
+            'cost': float(total_cost)}
+
+
+def _memory_alternatives(route_graph, start_snap, end_snap, cost,
+                         reverse_cost, best_cost, count):
+    '''Find up to `count` alternatives to the best route between two snapped
+    points with the penalty method: after every search, the edges of the
+    route found cost PENALTY times more, and the next search looks for the
+    cheapest route under those costs. The virtual edges from and to the
+    snapped points count as route edges too, so that routes between points
+    on neighboring edges (with no full edges) get alternatives as well.
+    Routes that overlap too much with one already found, or cost too much
+    more than the best one (see MAX_OVERLAP and MAX_STRETCH), are skipped,
+    as are repeats. Each attempt is one bidirectional search over a copy of
+    the cost arrays - the graph itself is not touched.
+
+    :param best_cost: Cost of the best route.
+    :type best_cost: float
+    :returns: list of legs (see _memory_leg), cheapest first.
+
+    '''
+    search_cost = np.array(cost)
+    search_reverse_cost = np.array(reverse_cost)
+    start = start_snap.split_costs(cost, reverse_cost, leaving=True)
+    end = end_snap.split_costs(cost, reverse_cost, leaving=False)
+    search_start = dict(start)
+    search_end = dict(end)
+    length = route_graph.length
+
+    # Routes found so far: their edges and those edges' lengths, with the
+    # virtual edges as ('start', node) and ('end', node)
+    paths = []
+    seen = set()
+    alternatives = []
+    for attempt in range(1 + MAX_ATTEMPTS * count):
+        found = search.bidirectional_dijkstra(route_graph, search_start,
+                                              search_end, search_cost,
+                                              search_reverse_cost)
+        if found is None:
+            break
+        _, path, first, last = found
+        edges = dict((edge, float(length[edge])) for edge, forward in path)
+        index = np.fromiter(edges, dtype=np.int64, count=len(edges))
+        # Negative (impassable) costs stay negative
+        search_cost[index] *= PENALTY
+        search_reverse_cost[index] *= PENALTY
+        search_start[first] *= PENALTY
+        search_end[last] *= PENALTY
+        edges[('start', first)] = float(start_snap.partial_length(first))
+        edges[('end', last)] = float(end_snap.partial_length(last))
+
+        # The first search finds the best route again
+        signature = (first, tuple(path), last)
+        if attempt == 0:
+            paths.append(edges)
+            seen.add(signature)
+            continue
+        if signature in seen:
+            continue
+
+        total_cost = _path_cost(start, end, cost, reverse_cost, path, first,
+                                last)
+        if total_cost > MAX_STRETCH * best_cost:
+            continue
+        path_length = sum(edges.values())
+        if any(sum(edges[key] for key in edges if key in other) >
+               MAX_OVERLAP * path_length for other in paths):
+            continue
+        paths.append(edges)
+        seen.add(signature)
+        alternatives.append(_path_leg(route_graph, start_snap, end_snap,
+                                      path, first, last, total_cost))
+        if len(alternatives) == count:
+            break
+
+    alternatives.sort(key=lambda leg: leg['cost'])
+    return alternatives
+
+
+def _path_cost(start, end, cost, reverse_cost, path, first, last):
+    '''Cost of a path from search.bidirectional_dijkstra, including the
+    virtual edges at both ends.'''
+    total = start[first] + end[last]
+    for edge, forward in path:
+        total += cost[edge] if forward else reverse_cost[edge]
+    return float(total)
+
+
+def _edge(route_graph, edge, distance, first, last):
+    '''Describe a (part of an) edge of a route for directions.py.'''
+    return [bool(route_graph.iscrossing[edge]), float(distance), first, last,
+            bool(route_graph.curbramps[edge])]
+
+
+def _extend(coords, more):
+    '''Append a line to another, in place, leaving out the first coordinate
+    of `more` if the line already ends there (e.g. where consecutive edges
+    meet).
+
+    :returns: The index in `coords` of the first coordinate of `more`.
+
+    '''
+    if more and coords and coords[-1] == more[0]:
+        start = len(coords) - 1
+        coords.extend(more[1:])
+    else:
+        start = len(coords)
+        coords.extend(more)
+    return start
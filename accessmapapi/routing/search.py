@@ -0,0 +1,300 @@
+'''Shortest-path searches over an in-memory `graph.Graph`. Costs are given as
+per-edge arrays, mirroring the `cost` and `reverse_cost` columns pgRouting
+expects: `cost` applies when an edge is traversed from source to target,
+`reverse_cost` when it is traversed from target to source.'''
+import heapq
+
+
+INF = float('inf')
+
+
+def _path_cost(cost, reverse_cost, edge, forward):
+    return cost[edge] if forward else reverse_cost[edge]
+
+
+def bidirectional_dijkstra(graph, start, end, cost, reverse_cost=None):
+    '''Find the cheapest path between two nodes by searching from both ends
+    at once.
+
+    :param graph: The routing graph.
+    :type graph: graph.Graph
+    :param start: Node index of the origin, or a dict mapping node indices to
+                  the cost of reaching them from the origin (e.g. the two ends
+                  of the edge a virtual origin node lies on).
+    :type start: int or dict
+    :param end: Node index of the destination, or a dict mapping node indices
+                to the cost of reaching the destination from them.
+    :type end: int or dict
+    :param cost: Per-edge cost of travelling from source to target.
+    :type cost: numpy.ndarray
+    :param reverse_cost: Per-edge cost of travelling from target to source.
+                         Defaults to `cost` (an undirected graph).
+    :type reverse_cost: numpy.ndarray
+    :returns: A (total cost, path, first node, last node) tuple where path
+              is a list of (edge index, forward) pairs, or None if the nodes
+              are not connected.
+
+    '''
+    if reverse_cost is None:
+        reverse_cost = cost
+
+    indptr = memoryview(graph.indptr)
+    adj_node = memoryview(graph.adj_node)
+    adj_edge = memoryview(graph.adj_edge)
+    adj_forward = memoryview(graph.adj_forward)
+    cost = memoryview(cost)
+    reverse_cost = memoryview(reverse_cost)
+
+    if not isinstance(start, dict):
+        start = {start: 0.0}
+    if not isinstance(end, dict):
+        end = {end: 0.0}
+
+    # Index 0 is the search out of `start`, index 1 the search into `end`.
+    dist = (dict(start), dict(end))
+    pred = (dict.fromkeys(start), dict.fromkeys(end))
+    settled = (set(), set())
+    queues = ([(d, u) for u, d in start.items()],
+              [(d, u) for u, d in end.items()])
+    heapq.heapify(queues[0])
+    heapq.heapify(queues[1])
+
+    best = INF
+    meeting = None
+    for u, d in start.items():
+        if u in end and d + end[u] < best:
+            best = d + end[u]
+            meeting = u
+
+    while queues[0] and queues[1]:
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+
+        # Expand whichever frontier is closer to its root
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        d, u = heapq.heappop(queues[side])
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+
+        side_dist = dist[side]
+        side_pred = pred[side]
+        other_dist = dist[1 - side]
+        for i in range(indptr[u], indptr[u + 1]):
+            v = adj_node[i]
+            edge = adj_edge[i]
+            forward = adj_forward[i]
+            # The backward search walks edges against the direction of travel
+            if side == 0:
+                w = _path_cost(cost, reverse_cost, edge, forward)
+            else:
+                w = _path_cost(cost, reverse_cost, edge, not forward)
+            if w < 0 or w == INF:
+                # pgRouting convention: negative costs mark impassable edges
+                continue
+            nd = d + w
+            if nd < side_dist.get(v, INF):
+                side_dist[v] = nd
+                side_pred[v] = (u, edge, forward)
+                heapq.heappush(queues[side], (nd, v))
+            if v in other_dist and nd + other_dist[v] < best:
+                best = nd + other_dist[v]
+                meeting = v
+
+    if meeting is None:
+        return None
+
+    # Walk back from the meeting node to the origin...
+    path = []
+    node = meeting
+    while pred[0][node] is not None:
+        u, edge, forward = pred[0][node]
+        path.append((edge, forward))
+        node = u
+    first = node
+    path.reverse()
+    # ...and forward from the meeting node to the destination.
+    node = meeting
+    while pred[1][node] is not None:
+        v, edge, forward = pred[1][node]
+        # Stored from the perspective of the backward search, so flip it
+        path.append((edge, not forward))
+        node = v
+    last = node
+
+    return best, path, first, last
+
+
+def astar(graph, start, end, cost, reverse_cost, potential):
+    '''Find the cheapest path between two nodes with A*: nodes are settled in
+    order of their cost from the origin plus a lower bound on their cost to
+    the destination, so the search heads towards the destination instead
+    of spreading out in every direction.
+
+    :param graph: The routing graph.
+    :type graph: graph.Graph
+    :param start: Node index of the origin, or a dict (see
+                  bidirectional_dijkstra).
+    :type start: int or dict
+    :param end: Node index of the destination, or a dict (see
+                bidirectional_dijkstra).
+    :type end: int or dict
+    :param cost: Per-edge cost of travelling from source to target.
+    :type cost: numpy.ndarray
+    :param reverse_cost: Per-edge cost of travelling from target to source.
+    :type reverse_cost: numpy.ndarray
+    :param potential: Per-node lower bound on the cost of reaching the
+                      destination, inf for nodes that cannot reach it (see
+                      landmarks.Landmarks.potential). It must be consistent
+                      for the path found to be the cheapest.
+    :type potential: numpy.ndarray
+    :returns: See bidirectional_dijkstra.
+
+    '''
+    indptr = memoryview(graph.indptr)
+    adj_node = memoryview(graph.adj_node)
+    adj_edge = memoryview(graph.adj_edge)
+    adj_forward = memoryview(graph.adj_forward)
+    cost = memoryview(cost)
+    reverse_cost = memoryview(reverse_cost)
+    potential = memoryview(potential)
+
+    if not isinstance(start, dict):
+        start = {start: 0.0}
+    if not isinstance(end, dict):
+        end = {end: 0.0}
+
+    dist = dict(start)
+    pred = dict.fromkeys(start)
+    settled = set()
+    queue = [(d + potential[u], d, u) for u, d in start.items()
+             if potential[u] != INF]
+    heapq.heapify(queue)
+
+    best = INF
+    last = None
+    while queue:
+        estimate, d, u = heapq.heappop(queue)
+        if estimate >= best:
+            break
+        if u in settled:
+            continue
+        settled.add(u)
+        if u in end and d + end[u] < best:
+            best = d + end[u]
+            last = u
+
+        for i in range(indptr[u], indptr[u + 1]):
+            v = adj_node[i]
+            if v in settled:
+                continue
+            edge = adj_edge[i]
+            forward = adj_forward[i]
+            w = _path_cost(cost, reverse_cost, edge, forward)
+            if w < 0 or w == INF:
+                continue
+            nd = d + w
+            if nd < dist.get(v, INF):
+                h = potential[v]
+                if h == INF:
+                    # The destination can't be reached from v
+                    continue
+                dist[v] = nd
+                pred[v] = (u, edge, forward)
+                heapq.heappush(queue, (nd + h, nd, v))
+
+    if last is None:
+        return None
+    first, path = path_to(pred, last)
+    return best, path, first, last
+
+
+def dijkstra(graph, start, cost, reverse_cost=None, targets=None,
+             maxcost=None):
+    '''Single-source search: the cheapest cost from an origin to every node
+    it reaches, i.e. a shortest-path tree.
+
+    :param graph: The routing graph.
+    :type graph: graph.Graph
+    :param start: Node index of the origin, or a dict mapping node indices to
+                  the cost of reaching them from the origin.
+    :type start: int or dict
+    :param cost: Per-edge cost of travelling from source to target.
+    :type cost: numpy.ndarray
+    :param reverse_cost: Per-edge cost of travelling from target to source.
+                         Defaults to `cost` (an undirected graph).
+    :type reverse_cost: numpy.ndarray
+    :param targets: Stop as soon as all of these node indices are reached.
+    :type targets: iterable
+    :param maxcost: Stop before settling any node costlier than this.
+    :type maxcost: float
+    :returns: A (costs, pred) tuple: costs maps every settled node index to
+              its cost, pred maps node indices to the (previous node, edge
+              index, forward) step that reached them (None for the origin).
+
+    '''
+    if reverse_cost is None:
+        reverse_cost = cost
+    if not isinstance(start, dict):
+        start = {start: 0.0}
+
+    indptr = memoryview(graph.indptr)
+    adj_node = memoryview(graph.adj_node)
+    adj_edge = memoryview(graph.adj_edge)
+    adj_forward = memoryview(graph.adj_forward)
+    cost = memoryview(cost)
+    reverse_cost = memoryview(reverse_cost)
+
+    tentative = dict(start)
+    pred = dict.fromkeys(start)
+    settled = {}
+    queue = [(d, u) for u, d in start.items()]
+    heapq.heapify(queue)
+    remaining = None if targets is None else set(targets)
+    if maxcost is None:
+        maxcost = INF
+
+    while queue:
+        d, u = heapq.heappop(queue)
+        if u in settled:
+            continue
+        if d > maxcost:
+            break
+        settled[u] = d
+        if remaining is not None:
+            remaining.discard(u)
+            if not remaining:
+                break
+
+        for i in range(indptr[u], indptr[u + 1]):
+            v = adj_node[i]
+            if v in settled:
+                continue
+            edge = adj_edge[i]
+            forward = adj_forward[i]
+            w = _path_cost(cost, reverse_cost, edge, forward)
+            if w < 0 or w == INF:
+                continue
+            nd = d + w
+            if nd < tentative.get(v, INF):
+                tentative[v] = nd
+                pred[v] = (u, edge, forward)
+                heapq.heappush(queue, (nd, v))
+
+    return settled, pred
+
+
+def path_to(pred, node):
+    '''Walk a shortest-path tree back from a node to its root.
+
+    :returns: (root node, path) where path is a list of (edge index,
+              forward) pairs from the root to `node`.
+
+    '''
+    path = []
+    while pred[node] is not None:
+        u, edge, forward = pred[node]
+        path.append((edge, forward))
+        node = u
+    path.reverse()
+    return node, path
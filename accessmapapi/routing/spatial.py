@@ -0,0 +1,489 @@
+'''In-memory spatial indices for snapping points to the routing graph. These
+replace `ORDER BY ST_Distance(...) LIMIT 1` queries, which cannot use a GiST
+index and scan the whole vertices table for every lookup.'''
+import heapq
+import threading
+
+import numpy as np
+
+from accessmapapi import db
+
+
+class KDTree(object):
+    '''Static 2D KD-tree over an array of points.
+
+    The tree is stored implicitly: `order` is a permutation of the points in
+    which the median of every range [lo, hi) sits at its middle position, and
+    `dims` holds the axis that position splits on. Ranges of `leafsize`
+    points or fewer are scanned directly.
+
+    '''
+    def __init__(self, points, leafsize=16):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.leafsize = leafsize
+        self.order = np.arange(len(self.points))
+        self.dims = np.zeros(len(self.points), dtype=np.int8)
+        self._build(0, len(self.points))
+        # The permuted points are what queries read
+        self.sorted_points = self.points[self.order]
+
+    def _build(self, lo, hi):
+        stack = [(lo, hi)]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo <= self.leafsize:
+                continue
+            idx = self.order[lo:hi]
+            pts = self.points[idx]
+            dim = int(np.argmax(pts.max(axis=0) - pts.min(axis=0)))
+            mid = (hi - lo) // 2
+            part = np.argpartition(pts[:, dim], mid)
+            self.order[lo:hi] = idx[part]
+            self.dims[lo + mid] = dim
+            stack.append((lo, lo + mid))
+            stack.append((lo + mid + 1, hi))
+
+    def query(self, point):
+        '''Find the index of the point nearest to a single query point.
+
+        :param point: The (x, y) query point.
+        :type point: tuple
+        :returns: (index, squared distance) of the nearest point.
+
+        '''
+        x, y = float(point[0]), float(point[1])
+        pts = self.sorted_points
+        dims = self.dims
+        leafsize = self.leafsize
+
+        best = float('inf')
+        best_i = -1
+        # Entries are (squared distance to splitting plane, lo, hi)
+        stack = [(0.0, 0, len(pts))]
+        while stack:
+            plane_dist, lo, hi = stack.pop()
+            if plane_dist >= best:
+                continue
+            if hi - lo <= leafsize:
+                if lo == hi:
+                    continue
+                chunk = pts[lo:hi]
+                sq = (chunk[:, 0] - x) ** 2 + (chunk[:, 1] - y) ** 2
+                i = int(np.argmin(sq))
+                if sq[i] < best:
+                    best = float(sq[i])
+                    best_i = lo + i
+                continue
+
+            mid = lo + (hi - lo) // 2
+            px, py = pts[mid]
+            sq = (px - x) ** 2 + (py - y) ** 2
+            if sq < best:
+                best = sq
+                best_i = mid
+            if dims[mid] == 0:
+                diff = x - px
+            else:
+                diff = y - py
+            near, far = (lo, mid), (mid + 1, hi)
+            if diff > 0:
+                near, far = far, near
+            # Pushed first so that the near side is searched first
+            stack.append((diff * diff, far[0], far[1]))
+            stack.append((0.0, near[0], near[1]))
+
+        return int(self.order[best_i]), best
+
+    def nearest(self, points):
+        '''Find the nearest point for every query point.
+
+        :param points: (x, y) query points.
+        :type points: list
+        :returns: Array of indices into the indexed points.
+
+        '''
+        return np.array([self.query(p)[0] for p in points], dtype=np.int64)
+
+
+class VertexIndex(object):
+    '''Nearest-vertex lookups for a pgRouting vertices table.
+
+    :param node_ids: routing_vertices_pgr ids.
+    :type node_ids: numpy.ndarray
+    :param node_coords: (lon, lat) of each vertex.
+    :type node_coords: numpy.ndarray
+
+    '''
+    def __init__(self, node_ids, node_coords):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        node_coords = np.asarray(node_coords, dtype=np.float64).reshape(-1, 2)
+        self.scale = _scale(node_coords)
+        self.tree = KDTree(node_coords * self.scale)
+
+    def nearest(self, points):
+        '''Find the closest vertex to each of a batch of points.
+
+        :param points: [lat, lon] pairs (the same order as route waypoints).
+        :type points: list
+        :returns: list of routing_vertices_pgr ids.
+
+        '''
+        lonlat = np.array([[p[1], p[0]] for p in points],
+                          dtype=np.float64).reshape(-1, 2)
+        indices = self.tree.nearest(lonlat * self.scale)
+        return self.node_ids[indices].tolist()
+
+
+def _scale(lonlat):
+    '''Scale factors that make lon, lat degrees roughly isotropic near the
+    data: a degree of longitude shrinks with the cosine of the latitude.'''
+    if not len(lonlat):
+        return np.ones(2)
+    lat = np.radians(lonlat[:, 1].mean())
+    return np.array([np.cos(lat), 1.0])
+
+
+def from_db(table='routing'):
+    '''Build a VertexIndex for a pgRouting vertices table.'''
+    sql = '''
+      SELECT id,
+             ST_X(the_geom),
+             ST_Y(the_geom)
+        FROM {}_vertices_pgr
+    '''.format(table)
+    result = db.engine.execute(sql)
+    rows = list(result)
+    result.close()
+    node_ids = [row[0] for row in rows]
+    node_coords = [[row[1], row[2]] for row in rows]
+
+    return VertexIndex(node_ids, node_coords)
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def get_vertex_index(table='routing'):
+    '''Return the shared vertex index for a routing table, building it on
+    first use. The index of the `routing` table is part of the data snapshot
+    instead (see snapshot.nearest).'''
+    index = _indices.get(table)
+    if index is None:
+        with _indices_lock:
+            index = _indices.get(table)
+            if index is None:
+                with db.statement_timeout(0):
+                    index = from_db(table)
+                _indices[table] = index
+    return index
+
+
+def nearest(points, table='routing'):
+    '''Snap a batch of [lat, lon] points to their closest routing vertices.
+
+    :param points: [lat, lon] pairs.
+    :type points: list
+    :param table: Name of the pgRouting edge table.
+    :type table: str
+    :returns: list of routing_vertices_pgr ids.
+
+    '''
+    return get_vertex_index(table).nearest(points)
+
+
+class RTree(object):
+    '''Static R-tree over bounding boxes, packed with the Sort-Tile-Recursive
+    (STR) algorithm.
+
+    `levels[0]` holds the items themselves (in packed order, see `order`)
+    and every level above holds nodes whose children are the range
+    lo[i]:hi[i] of the level below. Each level is a (boxes, lo, hi) tuple,
+    where boxes is an (n, 4) array of minx, miny, maxx, maxy.
+
+    '''
+    def __init__(self, boxes, capacity=16):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.capacity = capacity
+
+        n = len(boxes)
+        self.order = _str_order(boxes, capacity)
+        items = np.arange(n)
+        self.levels = [(boxes[self.order], items, items + 1)]
+        while len(self.levels[-1][0]) > 1:
+            child_boxes = self.levels[-1][0]
+            m = len(child_boxes)
+            lo = np.arange(0, m, capacity)
+            hi = np.minimum(lo + capacity, m)
+            parent_boxes = np.column_stack([
+                np.minimum.reduceat(child_boxes[:, 0], lo),
+                np.minimum.reduceat(child_boxes[:, 1], lo),
+                np.maximum.reduceat(child_boxes[:, 2], lo),
+                np.maximum.reduceat(child_boxes[:, 3], lo),
+            ])
+            # Pack the parents in turn, carrying their child ranges along
+            order = _str_order(parent_boxes, capacity)
+            self.levels.append((parent_boxes[order], lo[order], hi[order]))
+
+    def nearest(self, x, y, distance):
+        '''Best-first search for the item closest to a point.
+
+        :param x: Query x coordinate.
+        :type x: float
+        :param y: Query y coordinate.
+        :type y: float
+        :param distance: Callback taking an array of item ids and returning
+                         their exact distances to the query point. Must never
+                         be less than the distance to the item's box.
+        :type distance: callable
+        :returns: (item id, distance), or None if the tree is empty.
+
+        '''
+        if not len(self.order):
+            return None
+
+        top = len(self.levels) - 1
+        heap = [(0.0, top, 0)]
+        while heap:
+            d, level, i = heapq.heappop(heap)
+            if level < 0:
+                # Exact item distances are only queued once computed
+                return int(self.order[i]), d
+            _, lo, hi = self.levels[level]
+            start, end = int(lo[i]), int(hi[i])
+            if level == 0:
+                ids = self.order[start:end]
+                dists = distance(ids)
+                for j, dist in enumerate(dists.tolist()):
+                    heapq.heappush(heap, (dist, -1, start + j))
+            else:
+                boxes = self.levels[level - 1][0][start:end]
+                dx = np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 2]),
+                                0)
+                dy = np.maximum(np.maximum(boxes[:, 1] - y, y - boxes[:, 3]),
+                                0)
+                for j, dist in enumerate(np.hypot(dx, dy).tolist()):
+                    heapq.heappush(heap, (dist, level - 1, start + j))
+
+        return None
+
+
+def _str_order(boxes, capacity):
+    '''Sort-Tile-Recursive ordering of boxes: sort by x center into vertical
+    slices of sqrt(n / capacity) * capacity boxes, then sort each slice by
+    y center.'''
+    n = len(boxes)
+    if not n:
+        return np.arange(0)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    n_leaves = int(np.ceil(n / float(capacity)))
+    slice_size = int(np.ceil(np.sqrt(n_leaves))) * capacity
+    by_x = np.argsort(cx, kind='mergesort')
+    order = []
+    for start in range(0, n, slice_size):
+        ids = by_x[start:start + slice_size]
+        order.append(ids[np.argsort(cy[ids], kind='mergesort')])
+    return np.concatenate(order)
+
+
+class EdgeSnap(object):
+    '''The closest point on a routing edge to some location. The point acts
+    as a virtual node splitting its edge into two virtual edges, whose costs
+    are the parent edge's cost prorated by length.
+
+    :param route_graph: The in-memory routing graph.
+    :param edge: Edge index in the in-memory graph.
+    :param segment: Index of the edge geometry segment holding the point.
+    :param point: (lon, lat) of the closest point.
+    :param fraction: How far along the edge the point is, from source (0) to
+                     target (1), by length.
+
+    '''
+    def __init__(self, route_graph, edge, segment, point, fraction):
+        self.graph = route_graph
+        self.edge = edge
+        self.segment = segment
+        self.point = point
+        self.fraction = fraction
+
+    @property
+    def key(self):
+        '''Hashable identity of the snapped point, e.g. for caching results:
+        its edge id and (rounded) fraction along the edge.'''
+        return (int(self.graph.edge_ids[self.edge]),
+                round(float(self.fraction), 6))
+
+    @property
+    def source(self):
+        return int(self.graph.source[self.edge])
+
+    @property
+    def target(self):
+        return int(self.graph.target[self.edge])
+
+    def split_costs(self, cost, reverse_cost, leaving=True):
+        '''Costs between the virtual node and the two ends of its edge, as a
+        {node index: cost} dict.
+
+        :param leaving: Whether travel goes from the virtual node to the edge
+                        ends (an origin) rather than from the ends to the node
+                        (a destination).
+        :type leaving: bool
+
+        '''
+        edge = self.edge
+        fraction = self.fraction
+        if leaving:
+            split = [(self.source, fraction * reverse_cost[edge]),
+                     (self.target, (1 - fraction) * cost[edge])]
+        else:
+            split = [(self.source, fraction * cost[edge]),
+                     (self.target, (1 - fraction) * reverse_cost[edge])]
+
+        nodes = {}
+        for node, node_cost in split:
+            # Negative costs mark impassable directions
+            if node_cost >= 0 and node_cost < nodes.get(node, float('inf')):
+                nodes[node] = float(node_cost)
+        return nodes
+
+    def partial_length(self, node):
+        '''Length of the virtual edge between the point and one end of its
+        edge.'''
+        length = self.graph.length[self.edge]
+        if node == self.source:
+            return float(self.fraction * length)
+        return float((1 - self.fraction) * length)
+
+    def partial_coords(self, node, leaving=True):
+        '''Coordinates of the virtual edge between the point and one end of
+        its edge, in the direction of travel.'''
+        coords = self.graph.edge_coords(self.edge)
+        i = self.segment
+        if node == self.source:
+            partial = coords[:i + 1] + [self.point]
+            forward = not leaving
+        else:
+            partial = [self.point] + coords[i + 1:]
+            forward = leaving
+        if not forward:
+            partial.reverse()
+        return partial
+
+    def direct_to(self, other, cost, reverse_cost):
+        '''Travel along the shared edge from this point to another one
+        snapped to the same edge.
+
+        :returns: (cost, distance, coordinates) or None if the points are on
+                  different edges or that direction is impassable.
+
+        '''
+        if other.edge != self.edge:
+            return None
+        edge = self.edge
+        if self.fraction <= other.fraction:
+            direct_cost = (other.fraction - self.fraction) * cost[edge]
+            first, last = self, other
+        else:
+            direct_cost = (self.fraction - other.fraction) * reverse_cost[edge]
+            first, last = other, self
+        if direct_cost < 0:
+            return None
+
+        coords = self.graph.edge_coords(edge)
+        partial = ([first.point] +
+                   coords[first.segment + 1:last.segment + 1] +
+                   [last.point])
+        if first is other:
+            partial.reverse()
+        distance = (last.fraction - first.fraction) * self.graph.length[edge]
+        return float(direct_cost), float(distance), partial
+
+
+class EdgeIndex(object):
+    '''Nearest-edge lookups for the in-memory routing graph. Every segment of
+    every sidewalk and corner edge is indexed by its bounding box - crossings
+    are left out, as nobody should start or end a trip in the street.
+
+    :param route_graph: The in-memory routing graph.
+    :type route_graph: graph.Graph
+
+    '''
+    def __init__(self, route_graph):
+        self.graph = route_graph
+        coords = route_graph.geom_coords
+        self.scale = _scale(coords)
+        scaled = coords * self.scale
+
+        # Every coordinate but the last of an edge starts a segment
+        indptr = route_graph.geom_indptr
+        coord_edge = np.repeat(np.arange(route_graph.n_edges),
+                               np.diff(indptr))
+        is_start = np.ones(len(coords), dtype=bool)
+        is_start[indptr[1:][np.diff(indptr) > 0] - 1] = False
+        sidewalks = route_graph.iscrossing == 0
+        self.seg_start = np.nonzero(is_start & sidewalks[coord_edge])[0]
+        self.seg_edge = coord_edge[self.seg_start]
+
+        self.p0 = scaled[self.seg_start]
+        self.p1 = scaled[self.seg_start + 1]
+        boxes = np.column_stack([np.minimum(self.p0, self.p1),
+                                 np.maximum(self.p0, self.p1)])
+        self.tree = RTree(boxes)
+
+    def _project(self, segments, x, y):
+        '''Closest points on segments to (x, y): returns the distances and the
+        position t (0 - 1) of each point along its segment.'''
+        p0 = self.p0[segments]
+        d = self.p1[segments] - p0
+        sq_len = (d ** 2).sum(axis=1)
+        t = ((x - p0[:, 0]) * d[:, 0] + (y - p0[:, 1]) * d[:, 1])
+        t = np.clip(t / np.where(sq_len > 0, sq_len, 1), 0, 1)
+        closest = p0 + d * t[:, np.newaxis]
+        dist = np.hypot(closest[:, 0] - x, closest[:, 1] - y)
+        return dist, t
+
+    def nearest(self, points):
+        '''Find the closest point on a sidewalk or corner edge to each of a
+        batch of points.
+
+        :param points: [lat, lon] pairs (the same order as route waypoints).
+        :type points: list
+        :returns: list of EdgeSnap (None where there are no edges).
+
+        '''
+        snaps = []
+        for point in points:
+            x = point[1] * self.scale[0]
+            y = point[0] * self.scale[1]
+            found = self.tree.nearest(x, y,
+                                      lambda s: self._project(s, x, y)[0])
+            if found is None:
+                snaps.append(None)
+                continue
+            segment = found[0]
+            t = float(self._project(np.array([segment]), x, y)[1][0])
+            snaps.append(self._snap(segment, t))
+        return snaps
+
+    def _snap(self, segment, t):
+        edge = int(self.seg_edge[segment])
+        coords = self.graph.geom_coords
+        start = int(self.graph.geom_indptr[edge])
+        end = int(self.graph.geom_indptr[edge + 1])
+        i = int(self.seg_start[segment])
+
+        point = coords[i] + (coords[i + 1] - coords[i]) * t
+        seg_lengths = np.hypot(*((np.diff(coords[start:end], axis=0) *
+                                  self.scale).T))
+        total = seg_lengths.sum()
+        if total > 0:
+            along = seg_lengths[:i - start].sum() + seg_lengths[i - start] * t
+            fraction = float(along / total)
+        else:
+            fraction = 0.0
+
+        return EdgeSnap(self.graph, edge, i - start, point.tolist(),
+                        fraction)
+
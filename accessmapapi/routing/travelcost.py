@@ -1,57 +1,139 @@
 '''Functions to calculate travel costs originating at a given point. Can be
 used to make things like isochrone maps.'''
-import json
-from accessmapapi import db
-
-
-def travel_cost(lat, lon, costfun, table='routing', maxcost=1000):
-    '''Given a lat, lon input and cost function (SQL string), calculate the
-    time to travel out to a maximum cost value.'''
-
-    # Find the origin point (a vertex on the routing vertices table)
-    lonlat = 'ST_Setsrid(ST_Makepoint({}, {}), 4326)'.format(lon, lat)
-    origin_sql = '''
-      SELECT id
-        FROM {}_vertices_pgr
-    ORDER BY ST_Distance(the_geom, {})
-       LIMIT 1;
-    '''.format(table, lonlat)
-    result = db.engine.execute(origin_sql)
-    origin = result.fetchone()[0]
-    result.close()
-
-    travel_cost_sql = """
-    SELECT seq,
-           id1 AS node,
-           cost,
-           ST_AsGeoJSON(ST_Transform(nodes.the_geom, 4326)) AS geom
-      FROM pgr_drivingDistance(
-           'SELECT id::integer,
-                   source::int4,
-                   target::int4,
-                   {} AS cost
-              FROM {}',
-           {},
-           {},
-           false,
-           false) pg
-      JOIN {}_vertices_pgr nodes
-        ON nodes.id = pg.id1
-    """.format(costfun, table, origin, maxcost, table)
+import numpy as np
+from accessmapapi import db, results, snapshot, timing
+from . import costs, isochrone
+
+
+# Largest cost travelcost.json searches out to, with or without contours
+MAX_COST = 10000
+
+
+def travel_cost(lat, lon, table='routing', maxcost=1000, contours=None,
+                **cost_params):
+    '''Given a lat, lon input, calculate the cost (see
+    costs.manual_wheelchair) to travel out to a maximum cost value. Results
+    are cached per snapped origin (see results.get_or_compute).
+
+    :param contours: Costs at which to return the outline of the reachable
+                     area (see isochrone.contours) instead of one point per
+                     reachable node. The search then stops at the largest of
+                     them, which may not be above `maxcost`.
+    :type contours: list of float
+    :param cost_params: Cost function parameters (see
+                        costs.manual_wheelchair_array and
+                        costs.profile_params).
+    :raises ValueError: if a contour is above `maxcost`.
+
+    '''
+    if contours:
+        # A tuple, so that it can be part of the result cache key
+        contours = tuple(sorted(float(c) for c in contours))
+        if contours[-1] > maxcost:
+            raise ValueError('Contours may not be above maxcost.')
+        maxcost = contours[-1]
+
+    route_graph = snapshot.memory_graph() if table == 'routing' else None
+    if route_graph is not None:
+        with timing.stage('snap'):
+            snap = snapshot.edge_index().nearest([[float(lat),
+                                                   float(lon)]])[0]
+        if snap is None:
+            return {'type': 'FeatureCollection',
+                    'features': []}
+        array_costfun = costs.manual_wheelchair_array
+        key = ('travelcost', 'memory', snap.key,
+               costs.profile_key(array_costfun, **cost_params), maxcost,
+               contours)
+
+        def reached():
+            with timing.stage('search'):
+                return isochrone.reachable(route_graph, snap, maxcost,
+                                           edges=bool(contours),
+                                           costfun=array_costfun,
+                                           **cost_params)
+    else:
+        # Find the origin point (a vertex on the routing vertices table)
+        with timing.stage('snap'):
+            origin = snapshot.nearest([[float(lat), float(lon)]],
+                                      table=table)[0]
+        params = costs.sql_params(**cost_params)
+        key = ('travelcost', table, origin,
+               costs.profile_key(costs.manual_wheelchair_array,
+                                 **cost_params),
+               maxcost, contours)
+
+        def reached():
+            with timing.stage('pgr_drivingDistance'):
+                node_lonlat, node_costs = _pgrouting_reached(origin, params,
+                                                             table, maxcost)
+            return node_lonlat, node_costs, np.zeros((0, 2)), np.zeros(0)
+
+    return results.get_or_compute(
+        key, lambda: _feature_collection(reached(), contours))
+
+
+def _feature_collection(reached, contours):
+    node_lonlat, node_costs, sample_lonlat, sample_costs = reached
+    with timing.stage('assemble'):
+        return _assemble(node_lonlat, node_costs, sample_lonlat,
+                         sample_costs, contours)
+
+
+def _assemble(node_lonlat, node_costs, sample_lonlat, sample_costs,
+              contours):
     fc = {'type': 'FeatureCollection',
           'features': []}
-    result = db.engine.execute(travel_cost_sql)
-    for row in result:
-        cost = row[2]
-        geom = json.loads(row[3])
+    if contours:
+        fc['features'] = isochrone.contours(
+            np.vstack([node_lonlat, sample_lonlat]),
+            np.concatenate([node_costs, sample_costs]),
+            contours)
+        return fc
+
+    for (node_lon, node_lat), cost in zip(node_lonlat.tolist(),
+                                          node_costs.tolist()):
         feature = {
             'type': 'Feature',
-            'geometry': geom,
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [node_lon, node_lat]
+            },
             'properties': {
                 'cost': cost
             }
         }
         fc['features'].append(feature)
-    result.close()
 
     return fc
+
+
+_REACHED = {}
+
+
+def _pgrouting_reached(origin, params, table, maxcost):
+    '''Coordinates and costs of the nodes reachable within maxcost, from
+    pgr_drivingDistance.'''
+    statement = _REACHED.get(table)
+    if statement is None:
+        statement = db.PreparedStatement(
+            'travel_cost_{}'.format(table),
+            [('origin', 'integer'),
+             ('maxcost', 'double precision')] + costs.SQL_PARAMS,
+            '''
+            SELECT pg.cost,
+                   ST_X(ST_Transform(nodes.the_geom, 4326)),
+                   ST_Y(ST_Transform(nodes.the_geom, 4326))
+              FROM pgr_drivingDistance({}, $1, $2, true, true) pg
+              JOIN {}_vertices_pgr nodes
+                ON nodes.id = pg.id1
+            '''.format(costs.pgr_edges(table, 3), table))
+        _REACHED[table] = statement
+
+    rows = statement.execute(origin=int(origin), maxcost=float(maxcost),
+                             **params)
+
+    lonlat = np.array([[row[1], row[2]] for row in rows],
+                      dtype=np.float64).reshape(-1, 2)
+    node_costs = np.array([row[0] for row in rows], dtype=np.float64)
+    return lonlat, node_costs
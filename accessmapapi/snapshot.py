@@ -0,0 +1,310 @@
+'''Versioned snapshots of the routing data.
+
+Everything the API derives from the routing tables - the in-memory routing
+graph, the spatial indices used for snapping and the cached full-city layers
+(see layers.cached_response) - belongs to one Snapshot. A request uses the
+snapshot that was current when it first asked for one (see `current`) until
+it ends, so it never mixes data from before and after a reload.
+
+`reload` builds a new snapshot in a background thread while the current one
+keeps serving requests, then swaps it in at once and moves to a new data
+version (see cache.invalidate), which the result and tile caches key on.
+Only one reload runs at a time, and it waits for the requests still using
+the snapshot retired by the previous reload to finish before it starts - so
+there are never more than two snapshots in memory. If they haven't finished
+after RELOAD_DRAIN_TIMEOUT seconds, the reload fails (see `status`).
+
+Reloads are started with POST /admin/reload (see views/admin.py) or by
+touching the RELOAD_TRIGGER file, e.g. after the data has been republished.'''
+import datetime
+import gc
+import os
+import threading
+import time
+import weakref
+
+from flask import g, has_app_context
+
+from accessmapapi import app, cache, db
+from accessmapapi.routing import graph, graphfile, spatial
+
+
+class Snapshot(object):
+    '''The routing data of one data version. Apart from the layers, which
+    are built as they are first requested, snapshots are never modified.
+
+    :param route_graph: The in-memory routing graph, or None when routing
+                        goes through pgRouting.
+    :type route_graph: graph.Graph
+    :param edge_index: Edge index over the graph (None without a graph).
+    :type edge_index: spatial.EdgeIndex
+    :param vertex_index: Index of the routing vertices.
+    :type vertex_index: spatial.VertexIndex
+    :param error: Why the in-memory routing graph could not be loaded, if
+                  it couldn't.
+    :type error: str
+
+    '''
+    def __init__(self, route_graph, edge_index, vertex_index, error=None):
+        self.graph = route_graph
+        self.edge_index = edge_index
+        self.vertex_index = vertex_index
+        # Serialized full-city layers, by name (see layers.cached_response)
+        self.layers = {}
+        self.loaded = datetime.datetime.utcnow().replace(microsecond=0)
+        self.error = error
+        # Set when the snapshot is installed
+        self.version = None
+
+
+_warmers = []
+
+
+def on_build(callback):
+    '''Register a function to call with (snapshot, previous snapshot) when a
+    snapshot has been built, before it is installed - e.g. to fill its
+    caches. `previous` is None for the first snapshot. Can be used as a
+    decorator.'''
+    _warmers.append(callback)
+    return callback
+
+
+def build(route_graph=None, previous=None):
+    '''Build a snapshot from the database (and GRAPH_FILE, if set). If the
+    memory engine's graph fails to load, the snapshot has no graph and
+    routes through pgRouting instead.
+
+    :param route_graph: Routing graph to use instead of reading one from the
+                        database (e.g. a synthetic one for benchmarks).
+    :type route_graph: graph.Graph
+    :param previous: The snapshot this one will replace, if any.
+    :type previous: Snapshot
+
+    '''
+    error = None
+    # One-off full reads - not a request
+    with db.statement_timeout(0):
+        if route_graph is None and app.config['ROUTING_ENGINE'] == 'memory':
+            try:
+                route_graph = _load_graph()
+            except Exception as e:
+                app.logger.exception('Could not load the routing graph - '
+                                     'falling back to pgRouting until the '
+                                     'next reload.')
+                error = 'Could not load the routing graph: {}'.format(
+                    _describe(e))
+        if route_graph is not None:
+            edge_index = spatial.EdgeIndex(route_graph)
+            vertex_index = spatial.VertexIndex(route_graph.node_ids,
+                                               route_graph.node_coords)
+        else:
+            edge_index = None
+            vertex_index = spatial.from_db()
+
+    snapshot = Snapshot(route_graph, edge_index, vertex_index, error)
+    for warm in _warmers:
+        warm(snapshot, previous)
+    return snapshot
+
+
+def _load_graph():
+    '''Load the in-memory routing graph from GRAPH_FILE or the database.'''
+    if app.config['GRAPH_FILE']:
+        return graphfile.read(app.config['GRAPH_FILE'],
+                              app.config['COST_CACHE_SIZE'])
+    return graph.from_db()
+
+
+def _describe(error):
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+_current = None
+_retired = None
+_lock = threading.Lock()
+
+
+def install(snapshot):
+    '''Make a snapshot the current one, under a new data version. Requests
+    that already use the previous snapshot keep it until they end.'''
+    global _current, _retired
+    with _lock:
+        cache.invalidate()
+        snapshot.version = cache.data_version()
+        if _current is not None:
+            _retired = weakref.ref(_current)
+        _current = snapshot
+    with _state_lock:
+        _state['error'] = snapshot.error
+
+
+def latest():
+    '''The current snapshot, building it on first use.'''
+    snapshot = _current
+    if snapshot is None:
+        with _reload_lock:
+            snapshot = _current
+            if snapshot is None:
+                snapshot = build()
+                install(snapshot)
+    return snapshot
+
+
+def current():
+    '''The snapshot to use: within a request, the one that was current when
+    the request first asked for it; otherwise the latest one.'''
+    if not has_app_context():
+        return latest()
+    snapshot = g.get('snapshot')
+    if snapshot is None:
+        snapshot = latest()
+        g.snapshot = snapshot
+    return snapshot
+
+
+def memory_graph():
+    '''Return the in-memory routing graph if that engine is enabled, or None
+    if routing should go through pgRouting (including when the graph failed
+    to load, see `build`).'''
+    if app.config['ROUTING_ENGINE'] != 'memory':
+        return None
+    return current().graph
+
+
+def edge_index():
+    '''The edge index over the in-memory routing graph.'''
+    return current().edge_index
+
+
+def nearest(points, table='routing'):
+    '''Snap a batch of [lat, lon] points to their closest routing vertices.
+
+    :param points: [lat, lon] pairs.
+    :type points: list
+    :param table: Name of the pgRouting edge table. Only the `routing`
+                  table is part of the snapshot - indices of other tables
+                  are read once and never reloaded.
+    :type table: str
+    :returns: list of routing_vertices_pgr ids.
+
+    '''
+    if table == 'routing':
+        return current().vertex_index.nearest(points)
+    return spatial.nearest(points, table)
+
+
+# Held while a snapshot is being built
+_reload_lock = threading.Lock()
+_state = {'reloading': False, 'error': None, 'started': None,
+          'finished': None}
+_state_lock = threading.Lock()
+
+
+def reload():
+    '''Start building a new snapshot in a background thread and install it
+    when done.
+
+    :returns: False if a reload is already running, True otherwise.
+
+    '''
+    with _state_lock:
+        if _state['reloading']:
+            return False
+        _state['reloading'] = True
+        _state['started'] = time.time()
+    thread = threading.Thread(target=_reload, name='snapshot-reload')
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def _reload():
+    error = None
+    try:
+        with _reload_lock:
+            _drain(app.config['RELOAD_DRAIN_TIMEOUT'])
+            snapshot = build(previous=_current)
+            install(snapshot)
+        error = snapshot.error
+        app.logger.info('Reloaded the routing data (version %s).',
+                        snapshot.version)
+    except Exception as e:
+        app.logger.exception('Could not reload the routing data - keeping '
+                             'the current snapshot.')
+        error = _describe(e)
+    finally:
+        # Return the layer builds' connection to the pool
+        db.session.remove()
+        with _state_lock:
+            _state['reloading'] = False
+            _state['error'] = error
+            _state['finished'] = time.time()
+
+
+def _drain(timeout):
+    '''Wait until no request uses the snapshot retired by the last reload.
+
+    :param timeout: Seconds to wait at most.
+    :type timeout: float
+    :raises RuntimeError: if the snapshot is still in use after that.
+
+    '''
+    deadline = time.time() + timeout
+    while _retired is not None and _retired() is not None:
+        if time.time() > deadline:
+            raise RuntimeError(
+                'The data retired by the last reload was still in use after '
+                '{:g} seconds - not reloading, so as not to keep three '
+                'copies in memory. Try again later.'.format(timeout))
+        gc.collect()
+        time.sleep(0.1)
+
+
+def status():
+    '''Version and load time of the current snapshot, and the state of the
+    last reload.'''
+    snapshot = _current
+    with _state_lock:
+        result = dict(_state)
+    if snapshot is not None:
+        result['version'] = snapshot.version
+        result['loaded'] = snapshot.loaded.isoformat() + 'Z'
+        if snapshot.graph is not None:
+            result['nodes'] = snapshot.graph.n_nodes
+            result['edges'] = snapshot.graph.n_edges
+    return result
+
+
+# RELOAD_TRIGGER: modification time when last seen, and when it was checked
+_trigger = {'mtime': None, 'checked': 0.0}
+_trigger_lock = threading.Lock()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+@app.before_request
+def check_trigger():
+    '''Start a reload when the RELOAD_TRIGGER file has been touched (checked
+    at most every RELOAD_TRIGGER_INTERVAL seconds).'''
+    path = app.config['RELOAD_TRIGGER']
+    if not path:
+        return
+    now = time.time()
+    with _trigger_lock:
+        if now - _trigger['checked'] < app.config['RELOAD_TRIGGER_INTERVAL']:
+            return
+        _trigger['checked'] = now
+        mtime = _mtime(path)
+        if _trigger['mtime'] is None:
+            # First check: the data loaded at startup is current
+            _trigger['mtime'] = mtime
+            return
+        if mtime == _trigger['mtime']:
+            return
+        _trigger['mtime'] = mtime
+    reload()
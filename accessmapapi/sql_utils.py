@@ -1,5 +1,6 @@
 import geoalchemy2 as ga
 import geoalchemy2.functions as func
+import sqlalchemy as sa
 
 
 class ST_MakeEnvelope(ga.functions.GenericFunction):
@@ -20,3 +21,31 @@ def in_bbox(col, bounds):
     envelope = ST_MakeEnvelope(bounds[0], bounds[1], bounds[2], bounds[3],
                                4326)
     return ga.functions.ST_Intersects(col, envelope)
+
+
+def geojson(col, tolerance=0.0, precision=7):
+    '''Return an SQL expression - the GeoJSON text of a geom column,
+    generalized in the database so that less is sent and serialized.
+
+    :param col: The column (an SQLAlchemy object).
+    :param tolerance: Simplify lines to within this distance (in degrees)
+                      with ST_SimplifyPreserveTopology. 0 to keep every
+                      vertex.
+    :type tolerance: float
+    :param precision: Number of decimals of the coordinates. Below 7,
+                      coordinates are also snapped to that grid, which drops
+                      the vertices that would round to the same point. Lines
+                      too short to survive snapping are kept unsnapped.
+    :type precision: int
+
+    '''
+    geom = col
+    if tolerance > 0:
+        geom = sa.func.ST_SimplifyPreserveTopology(geom, tolerance)
+    if precision < 7:
+        snapped = sa.func.ST_SnapToGrid(geom, 10.0 ** -precision)
+        # Collapsed lines come back NULL or EMPTY, depending on the PostGIS
+        # version
+        geom = sa.case([(sa.func.ST_IsEmpty(snapped).is_(False), snapped)],
+                       else_=geom)
+    return func.ST_AsGeoJSON(geom, precision)
@@ -0,0 +1,184 @@
+'''Mapbox Vector Tiles of the sidewalks, crossings and curbramps layers.
+
+Tiles are encoded by PostGIS (`ST_AsMVT`, PostGIS 2.4+), with line geometries
+simplified to about one tile pixel at each zoom level. Rendered tiles are
+kept in an on-disk cache with one directory per tile version, and tile ETags
+carry the same version. The version is a digest of the layer tables, so all
+worker processes (and restarts) agree on it and share the cache. It is
+computed again after each reload, and the directories of other versions are
+removed then.'''
+import os
+import shutil
+import tempfile
+import threading
+
+import sqlalchemy as sa
+
+from accessmapapi import app, cache, db
+
+
+# Half the width of the Web Mercator (EPSG:3857) world, in meters
+ORIGIN_SHIFT = 20037508.342789244
+# Tile coordinate space - the MVT default
+EXTENT = 4096
+# Extra tile units around each tile, so lines don't end at the tile edge
+BUFFER = 64
+
+TILE_SQL = sa.text('''
+WITH bounds AS (
+    SELECT ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 3857) AS geom
+)
+SELECT COALESCE((
+           SELECT ST_AsMVT(t, 'sidewalks', :extent, 'geom')
+             FROM (
+                   SELECT s.id,
+                          s.grade::double precision AS grade,
+                          ST_AsMVTGeom(ST_Simplify(ST_Transform(s.geom, 3857),
+                                                   :tolerance),
+                                       bounds.geom, :extent, :buffer, true)
+                            AS geom
+                     FROM sidewalks AS s, bounds
+                    WHERE s.geom && ST_Transform(bounds.geom, 4326)) AS t
+       ), ''::bytea) ||
+       COALESCE((
+           SELECT ST_AsMVT(t, 'crossings', :extent, 'geom')
+             FROM (
+                   SELECT c.id,
+                          c.grade::double precision AS grade,
+                          c.curbramps,
+                          ST_AsMVTGeom(ST_Simplify(ST_Transform(c.geom, 3857),
+                                                   :tolerance),
+                                       bounds.geom, :extent, :buffer, true)
+                            AS geom
+                     FROM crossings AS c, bounds
+                    WHERE c.geom && ST_Transform(bounds.geom, 4326)) AS t
+       ), ''::bytea) ||
+       COALESCE((
+           SELECT ST_AsMVT(t, 'curbramps', :extent, 'geom')
+             FROM (
+                   SELECT r.id,
+                          ST_AsMVTGeom(ST_Transform(r.geom, 3857),
+                                       bounds.geom, :extent, :buffer, true)
+                            AS geom
+                     FROM curbramps AS r, bounds
+                    WHERE r.geom && ST_Transform(bounds.geom, 4326)) AS t
+       ), ''::bytea)
+''')
+
+
+# Digest of the contents of the tables the tiles are made of
+VERSION_SQL = sa.text('''
+SELECT md5(string_agg(t.digest, '' ORDER BY t.name))
+  FROM (SELECT 'sidewalks' AS name,
+               md5(string_agg(md5(s::text), '' ORDER BY s.id)) AS digest
+          FROM sidewalks AS s
+        UNION ALL
+        SELECT 'crossings',
+               md5(string_agg(md5(c::text), '' ORDER BY c.id))
+          FROM crossings AS c
+        UNION ALL
+        SELECT 'curbramps',
+               md5(string_agg(md5(r::text), '' ORDER BY r.id))
+          FROM curbramps AS r) AS t
+''')
+
+
+def valid(z, x, y):
+    '''Whether z/x/y addresses an existing tile.'''
+    return 0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def bounds(z, x, y):
+    '''Web Mercator bounds (xmin, ymin, xmax, ymax) of a tile.'''
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    xmin = -ORIGIN_SHIFT + x * size
+    ymax = ORIGIN_SHIFT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def render(z, x, y):
+    '''Encode a tile from the database.
+
+    :returns: The tile as bytes (empty for tiles below TILE_MIN_ZOOM).
+
+    '''
+    if z < app.config['TILE_MIN_ZOOM']:
+        return b''
+    xmin, ymin, xmax, ymax = bounds(z, x, y)
+    # About one tile unit, in meters
+    tolerance = (xmax - xmin) / EXTENT
+    with db.statement_timeout(app.config['STATEMENT_TIMEOUT_TILES']):
+        result = db.engine.execute(TILE_SQL, xmin=xmin, ymin=ymin,
+                                   xmax=xmax, ymax=ymax, extent=EXTENT,
+                                   buffer=BUFFER, tolerance=tolerance)
+        data = result.scalar()
+        result.close()
+    return bytes(data or b'')
+
+
+def _cache_dir():
+    return app.config['TILE_CACHE_DIR'] or os.path.join(
+        tempfile.gettempdir(), 'accessmapapi-tiles')
+
+
+# Tile version, and the data version it was computed for
+_version = {'data': None, 'tiles': None}
+_version_lock = threading.Lock()
+
+
+def version():
+    '''The version of the tiles: a digest of the sidewalks, crossings and
+    curbramps tables, the same in every process. It is computed once per
+    data version (see cache.data_version).'''
+    data_version = cache.data_version()
+    with _version_lock:
+        if _version['data'] != data_version:
+            # One-off full read - not a tile
+            with db.statement_timeout(0):
+                result = db.engine.execute(VERSION_SQL)
+                digest = result.scalar() or ''
+                result.close()
+            _version['data'] = data_version
+            _version['tiles'] = digest[:16].rjust(16, '0')
+            _prune(_version['tiles'])
+        return _version['tiles']
+
+
+def _prune(current):
+    '''Remove the cached tiles of every version but `current`.'''
+    cache_dir = _cache_dir()
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        if name != current and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def get_tile(z, x, y):
+    '''Return a tile from the on-disk cache, rendering and storing it first
+    if needed.'''
+    version_dir = os.path.join(_cache_dir(), version())
+    path = os.path.join(version_dir, str(z), str(x), '{}.mvt'.format(y))
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        pass
+
+    data = render(z, x, y)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial tile
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                         threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        app.logger.exception('Could not write tile to the tile cache.')
+
+    return data
@@ -0,0 +1,151 @@
+'''Request timing. Every request is timed as a whole, and the code on the hot
+paths marks out its stages (snapping, the database search, assembling the
+response...) with `stage`:
+
+    with timing.stage('snap'):
+        nodes = spatial.nearest(waypoints)
+
+Durations go into histograms per endpoint and per (endpoint, stage), served
+in the Prometheus text format at /metrics. With SERVER_TIMING=true, the
+stages of each request are also sent back in a `Server-Timing` header.
+
+Streaming responses are timed up to the point where the body starts to be
+sent.'''
+import bisect
+import contextlib
+import threading
+import time
+
+from flask import g, has_request_context, request
+
+from accessmapapi import app
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    '''Counts of durations per bucket (see BUCKETS), plus their sum.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += seconds
+
+    def snapshot(self):
+        '''(cumulative count per bucket, count, sum) - the last cumulative
+        count is for the +Inf bucket.'''
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.total
+        cumulative = []
+        running = 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return cumulative, count, total
+
+
+_requests = {}
+_stages = {}
+_histograms_lock = threading.Lock()
+
+
+def _histogram(histograms, key):
+    histogram = histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = histograms.setdefault(key, Histogram())
+    return histogram
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    # e.g. a worker thread
+    return 'background'
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''Time a block of code as one stage of the current request. Stages may
+    nest; each is recorded separately.
+
+    :param name: Name of the stage, e.g. 'snap'.
+    :type name: str
+
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        endpoint = _endpoint()
+        _histogram(_stages, (endpoint, name)).observe(seconds)
+        if has_request_context():
+            if g.get('timings') is None:
+                g.timings = []
+            g.timings.append((name, seconds))
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def finish_request(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    _histogram(_requests, _endpoint()).observe(seconds)
+
+    if app.config['SERVER_TIMING']:
+        entries = ['{};dur={:.2f}'.format(name, 1000 * stage_seconds)
+                   for name, stage_seconds in g.get('timings', [])]
+        entries.append('total;dur={:.2f}'.format(1000 * seconds))
+        response.headers.add('Server-Timing', ', '.join(entries))
+
+    return response
+
+
+def prometheus():
+    '''The request and stage histograms in the Prometheus text format.'''
+    lines = []
+
+    def histogram(metric, help_text, histograms):
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for labels, hist in sorted(histograms, key=lambda item: item[0]):
+            cumulative, count, total = hist.snapshot()
+            label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            for bound, c in zip(BUCKETS + ('+Inf',), cumulative):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    metric, label_text, bound, c))
+            lines.append('{}_sum{{{}}} {!r}'.format(metric, label_text,
+                                                    total))
+            lines.append('{}_count{{{}}} {}'.format(metric, label_text,
+                                                    count))
+
+    with _histograms_lock:
+        requests = [((('endpoint', endpoint),), hist)
+                    for endpoint, hist in _requests.items()]
+        stages = [((('endpoint', endpoint), ('stage', name)), hist)
+                  for (endpoint, name), hist in _stages.items()]
+
+    histogram('accessmapapi_request_seconds',
+              'Time to handle a request, per endpoint.', requests)
+    histogram('accessmapapi_stage_seconds',
+              'Time spent in each stage of a request.', stages)
+    return '\n'.join(lines) + '\n'
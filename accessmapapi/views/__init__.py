@@ -1,2 +1,4 @@
 from . import v1
 from . import v2
+from . import metrics
+from . import admin
@@ -0,0 +1,26 @@
+import hmac
+
+from accessmapapi import app, snapshot
+from flask import abort, jsonify, request
+
+
+def _authorize():
+    '''Only let requests with the ADMIN_TOKEN through - and hide the admin
+    endpoints altogether when no token is set.'''
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        abort(404)
+    given = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(given.encode('utf-8'),
+                               'Bearer {}'.format(token).encode('utf-8')):
+        abort(403)
+
+
+@app.route('/admin/reload', methods=['GET', 'POST'])
+def reload():
+    _authorize()
+    if request.method == 'GET':
+        return jsonify(snapshot.status())
+    if not snapshot.reload():
+        return 'Conflict - a reload is already running.', 409
+    return jsonify(snapshot.status()), 202
@@ -0,0 +1,23 @@
+from accessmapapi import app, db, results, timing, workers
+from flask import Response, jsonify
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(timing.prometheus(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/pool.json')
+def poolmetrics():
+    return jsonify(db.pool_metrics())
+
+
+@app.route('/metrics/results.json')
+def resultsmetrics():
+    return jsonify(results.stats())
+
+
+@app.route('/metrics/workers.json')
+def workersmetrics():
+    return jsonify(workers.stats())
@@ -1,6 +1,5 @@
-from accessmapapi import app, db, models, sql_utils
+from accessmapapi import app, db, layers, models, sql_utils
 from flask import jsonify, request
-import geoalchemy2.functions as gfunc
 # import geoalchemy2 as ga
 import geojson
 import json
@@ -9,8 +8,12 @@ import json
 @app.route('/v1/sidewalks.geojson')
 def sidewalksv1():
     table = models.SidewalksData
+    try:
+        tolerance, precision = layers.generalization(request.args)
+    except ValueError as e:
+        return 'Bad request - {}'.format(e), 400
     bbox = request.args.get('bbox')
-    geojson_query = gfunc.ST_AsGeoJSON(table.geom, 7)
+    geojson_query = sql_utils.geojson(table.geom, tolerance, precision)
     geojson_geom = geojson_query.label('geom')
     if not bbox:
         select = db.session.query(table.id,
@@ -28,7 +31,7 @@ def sidewalksv1():
     feature_collection = geojson.FeatureCollection([])
     for row in result:
         feature = geojson.Feature()
-        geometry = json.loads(row.geom)
+        geometry = None if row.geom is None else json.loads(row.geom)
         feature['geometry'] = geometry
         feature['properties'] = {'id': row.id,
                                  'grade': str(round(row.grade, 3))}
@@ -40,8 +43,12 @@ def sidewalksv1():
 @app.route('/v1/curbramps.geojson')
 def curbrampsv1():
     table = models.CurbrampsData
+    try:
+        tolerance, precision = layers.generalization(request.args)
+    except ValueError as e:
+        return 'Bad request - {}'.format(e), 400
     bbox = request.args.get('bbox')
-    geojson_query = gfunc.ST_AsGeoJSON(table.geom, 7)
+    geojson_query = sql_utils.geojson(table.geom, tolerance, precision)
     geojson_geom = geojson_query.label('geom')
     if not bbox:
         select = db.session.query(table.id,
@@ -57,7 +64,8 @@ def curbrampsv1():
     fc = geojson.FeatureCollection([])
     for row in result:
         feature = geojson.Feature()
-        feature['geometry'] = json.loads(row.geom)
+        feature['geometry'] = (None if row.geom is None else
+                               json.loads(row.geom))
         feature['properties'] = {'id': row.id}
         fc['features'].append(feature)
 
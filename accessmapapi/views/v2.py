@@ -1,128 +1,121 @@
-from accessmapapi import app, db, models, sql_utils
-from accessmapapi.routing import costs, route, travelcost
-from flask import jsonify, request
-import geoalchemy2.functions as gfunc
+from accessmapapi import (app, db, layers, models, sql_utils, tiles,
+                          timing, workers)
+from accessmapapi.routing import costs, matrix, route, travelcost
+from flask import Response, abort, jsonify, request, stream_with_context
 # import geoalchemy2 as ga
-import geojson
 import json
 
 
 @app.route('/v2/sidewalks.geojson')
 def sidewalksv2():
+    return _layer(models.Sidewalks, 'sidewalks', _sidewalks_select,
+                  _sidewalk_properties)
+
+
+def _sidewalks_select(tolerance=0.0, precision=layers.PRECISION):
     table = models.Sidewalks
-    bbox = request.args.get('bbox')
-    all_rows = request.args.get('all')
-    geojson_query = gfunc.ST_AsGeoJSON(table.geom, 7)
+    geojson_query = sql_utils.geojson(table.geom, tolerance, precision)
     geojson_geom = geojson_query.label('geom')
-    if all_rows == 'true':
-        select = db.session.query(table.id,
-                                  geojson_geom,
-                                  table.grade)
-        result = select.all()
-    else:
-        if not bbox:
-            select = db.session.query(table.id,
-                                      geojson_geom,
-                                      table.grade)
-            result = select.limit(10).all()
-        else:
-            bounds = [float(b) for b in bbox.split(',')]
-            in_bbox = sql_utils.in_bbox(table.geom, bounds)
-            select = db.session.query(table.id,
-                                      geojson_geom,
-                                      table.grade)
-            result = select.filter(in_bbox).all()
+    return db.session.query(table.id,
+                            geojson_geom,
+                            table.grade)
 
-    feature_collection = geojson.FeatureCollection([])
-    for row in result:
-        feature = geojson.Feature()
-        geometry = json.loads(row.geom)
-        feature['geometry'] = geometry
-        feature['properties'] = {'id': row.id,
-                                 'grade': str(round(row.grade, 3))}
-        feature_collection['features'].append(feature)
 
-    return jsonify(feature_collection)
+def _sidewalk_properties(row):
+    return {'id': row.id,
+            'grade': str(round(row.grade, 3))}
 
 
 @app.route('/v2/crossings.geojson')
 def crossingsv2():
+    return _layer(models.Crossings, 'crossings', _crossings_select,
+                  _crossing_properties)
+
+
+def _crossings_select(tolerance=0.0, precision=layers.PRECISION):
     table = models.Crossings
-    bbox = request.args.get('bbox')
-    all_rows = request.args.get('all')
-    geojson_query = gfunc.ST_AsGeoJSON(table.geom, 7)
+    geojson_query = sql_utils.geojson(table.geom, tolerance, precision)
     geojson_geom = geojson_query.label('geom')
-    if all_rows == 'true':
-        select = db.session.query(table.id,
-                                  geojson_geom,
-                                  table.grade,
-                                  table.curbramps)
-        result = select.all()
-    else:
-        if not bbox:
-            select = db.session.query(table.id,
-                                      geojson_geom,
-                                      table.grade,
-                                      table.curbramps)
-            result = select.limit(10).all()
-        else:
-            bounds = [float(b) for b in bbox.split(',')]
-            in_bbox = sql_utils.in_bbox(table.geom, bounds)
-            select = db.session.query(table.id,
-                                      geojson_geom,
-                                      table.grade,
-                                      table.curbramps)
-            result = select.filter(in_bbox).all()
-
-    fc = geojson.FeatureCollection([])
-    for row in result:
-        feature = geojson.Feature()
-        geometry = json.loads(row.geom)
-        for i, lonlat in enumerate(geometry['coordinates']):
-            lon = round(lonlat[0], 7)
-            lat = round(lonlat[1], 7)
-            geometry['coordinates'][i] = [lon, lat]
-        feature['geometry'] = geometry
-        feature['properties'] = {'id': row.id,
-                                 'grade': str(round(row.grade, 3)),
-                                 'curbramps': row.curbramps}
-        fc['features'].append(feature)
-
-    return jsonify(fc)
+    return db.session.query(table.id,
+                            geojson_geom,
+                            table.grade,
+                            table.curbramps)
+
+
+def _crossing_properties(row):
+    return {'id': row.id,
+            'grade': str(round(row.grade, 3)),
+            'curbramps': row.curbramps}
 
 
 @app.route('/v2/curbramps.geojson')
 def curbrampsv2():
+    return _layer(models.Curbramps, 'curbramps', _curbramps_select,
+                  _curbramp_properties)
+
+
+def _curbramps_select(tolerance=0.0, precision=layers.PRECISION):
     table = models.Curbramps
+    geojson_query = sql_utils.geojson(table.geom, tolerance, precision)
+    geojson_geom = geojson_query.label('geom')
+    return db.session.query(table.id,
+                            geojson_geom)
+
+
+def _curbramp_properties(row):
+    return {'id': row.id}
+
+
+def _layer(table, name, select, properties):
+    '''Respond to a data layer request: the whole layer with all=true
+    (cached when not generalized), the features in a bbox, or a few example
+    features - with generalized geometries if asked (see
+    layers.generalization).'''
+    try:
+        tolerance, precision = layers.generalization(request.args)
+    except ValueError as e:
+        return 'Bad request - {}'.format(e), 400
+
     bbox = request.args.get('bbox')
     all_rows = request.args.get('all')
-    geojson_query = gfunc.ST_AsGeoJSON(table.geom, 7)
-    geojson_geom = geojson_query.label('geom')
+    if all_rows == 'true' and (tolerance, precision) == (0.0,
+                                                       layers.PRECISION):
+        # Only the full-detail layer is cached - generalized copies of it
+        # are streamed, so that they don't multiply the cache and reloads
+        return layers.cached_response(
+            name, lambda: layers.features_bytes(select(tolerance, precision),
+                                                properties))
+
+    query = select(tolerance, precision)
     if all_rows == 'true':
-        select = db.session.query(table.id,
-                                  geojson_geom)
-        result = select.all()
+        return layers.streaming_response(query, properties)
+    if not bbox:
+        query = query.limit(10)
     else:
-        if not bbox:
-            select = db.session.query(table.id,
-                                      geojson_geom)
-            result = select.limit(10).all()
-        else:
-            bounds = [float(b) for b in bbox.split(',')]
-            in_bbox = sql_utils.in_bbox(table.geom, bounds)
-            select = db.session.query(table.id,
-                                      geojson_geom)
-            result = select.filter(in_bbox).all()
+        bounds = [float(b) for b in bbox.split(',')]
+        in_bbox = sql_utils.in_bbox(table.geom, bounds)
+        query = query.filter(in_bbox)
+
+    return layers.streaming_response(query, properties)
 
-    feature_collection = geojson.FeatureCollection([])
-    for row in result:
-        feature = geojson.Feature()
-        geometry = json.loads(row.geom)
-        feature['geometry'] = geometry
-        feature['properties'] = {'id': row.id}
-        feature_collection['features'].append(feature)
 
-    return jsonify(feature_collection)
+@app.route('/v2/tiles/<int:z>/<int:x>/<int:y>.mvt')
+def tilesv2(z, x, y):
+    if not tiles.valid(z, x, y):
+        abort(404)
+
+    # The ETag doesn't depend on the tile itself, so clients with a current
+    # copy get a 304 without the tile being read or rendered
+    etag = '{}-{}-{}-{}'.format(tiles.version(), z, x, y)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(tiles.get_tile(z, x, y),
+                            mimetype='application/vnd.mapbox-vector-tile')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['TILE_MAX_AGE']
+    return response
 
 
 @app.route('/v2/route.json', methods=['GET'])
@@ -133,14 +126,100 @@ def routev2():
     waypoints_input = request.args.get('waypoints', None)
     if waypoints_input is None:
         return 'Bad request - waypoints parameter is required.'
-    waypoints_input_list = json.loads(waypoints_input)
-    # Consume in pairs
-    waypoints = zip(waypoints_input_list[0::2], waypoints_input_list[1::2])
+    try:
+        waypoints = _coordinates(waypoints_input)
+    except ValueError:
+        return ('Bad request - waypoints must be a list of lat, lon '
+                'numbers.', 400)
+    if len(waypoints) < 2:
+        return ('Bad request - waypoints must have at least two points.',
+                400)
+    try:
+        cost_params = costs.profile_params(request.args)
+    except ValueError as e:
+        return 'Bad request - {}'.format(e), 400
+    geometries = request.args.get('geometries', 'geojson')
+    if geometries not in route.GEOMETRIES:
+        return ('Bad request - geometries must be one of {}.'.format(
+            ', '.join(sorted(route.GEOMETRIES))), 400)
+    try:
+        alternatives = int(request.args.get('alternatives', 0))
+        if not 0 <= alternatives <= route.MAX_ALTERNATIVES:
+            raise ValueError
+    except ValueError:
+        return ('Bad request - alternatives must be an integer from 0 to '
+                '{}.'.format(route.MAX_ALTERNATIVES), 400)
 
     # request route
-    route_response = route.routing_request(list(waypoints))
+    try:
+        with db.statement_timeout(app.config['STATEMENT_TIMEOUT_ROUTING']):
+            route_response = workers.run(route.routing_request, waypoints,
+                                         geometries=geometries,
+                                         alternatives=alternatives,
+                                         **cost_params)
+    except workers.Overloaded:
+        return _overloaded()
+
+    with timing.stage('jsonify'):
+        return jsonify(route_response)
+
+
+@app.route('/v2/routes/batch', methods=['POST'])
+def routesbatchv2():
+    # Process arguments
+    # body (required!): a JSON array of waypoint lists, or one waypoint list
+    # per line (newline-delimited JSON), each in the format of route.json's
+    # `waypoints`
+    body = request.get_data(as_text=True)
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            entries = [json.loads(line) for line in body.splitlines()
+                       if line.strip()]
+        else:
+            entries = json.loads(body)
+        if not isinstance(entries, list):
+            raise ValueError
+        waypoint_lists = [_pairs(entry) for entry in entries]
+        if not all(len(waypoints) >= 2 for waypoints in waypoint_lists):
+            raise ValueError
+    except ValueError:
+        return ('Bad request - the body must be a JSON array (or '
+                'newline-delimited JSON) of [lat1,lon1,lat2,lon2,...] '
+                'waypoint lists, with at least two points each.', 400)
+    if not waypoint_lists:
+        return 'Bad request - no routes given.', 400
+    if len(waypoint_lists) > app.config['ROUTE_BATCH_SIZE']:
+        return ('Bad request - at most {} routes per batch.'.format(
+            app.config['ROUTE_BATCH_SIZE']), 400)
+    try:
+        cost_params = costs.profile_params(request.args)
+    except ValueError as e:
+        return 'Bad request - {}'.format(e), 400
+    geometries = request.args.get('geometries', 'geojson')
+    if geometries not in route.GEOMETRIES:
+        return ('Bad request - geometries must be one of {}.'.format(
+            ', '.join(sorted(route.GEOMETRIES))), 400)
+
+    timeout = app.config['STATEMENT_TIMEOUT_ROUTING']
+    responses = route.batch_request(waypoint_lists, geometries=geometries,
+                                    **cost_params)
+    # The routes are computed on the worker pool, which the stream holds a
+    # place in until it ends
+    try:
+        responses = workers.iterate(responses)
+    except workers.Overloaded:
+        return _overloaded()
 
-    return jsonify(route_response)
+    # Newline-delimited JSON, one line per route, sent as soon as each route
+    # is done - not in order, so every line has the route's `index`.
+    def generate():
+        with db.statement_timeout(timeout):
+            for i, route_response in responses:
+                route_response['index'] = i
+                yield json.dumps(route_response) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
 
 
 @app.route('/v2/travelcost.json', methods=['GET'])
@@ -153,8 +232,130 @@ def travelcostv2():
     if lat is None or lon is None:
         return 'Bad request - lat and lon parameters are required.'
 
+    # contours (optional): costs to outline the reachable area at, instead
+    # of returning every reachable node
+    contours_input = request.args.get('contours', None)
+    contours = None
+    if contours_input is not None:
+        try:
+            contours = [float(c) for c in json.loads(contours_input)]
+        except (ValueError, TypeError):
+            contours = None
+        if not contours or not all(0 < c <= travelcost.MAX_COST
+                                   for c in contours):
+            return ('Bad request - contours must be a list of positive '
+                    'costs, up to {}.'.format(travelcost.MAX_COST), 400)
+
+    try:
+        lat = float(lat)
+        lon = float(lon)
+    except ValueError:
+        return 'Bad request - lat and lon must be numbers.', 400
+    try:
+        cost_params = costs.profile_params(request.args)
+    except ValueError as e:
+        return 'Bad request - {}'.format(e), 400
+
     # Calculate travel time
-    costfun = costs.manual_wheelchair('length', 'grade', 'iscrossing')
-    cost_points = travelcost.travel_cost(lat, lon, costfun, maxcost=10000)
+    try:
+        with db.statement_timeout(app.config['STATEMENT_TIMEOUT_ROUTING']):
+            cost_points = workers.run(travelcost.travel_cost, lat, lon,
+                                      maxcost=travelcost.MAX_COST,
+                                      contours=contours,
+                                      **cost_params)
+    except workers.Overloaded:
+        return _overloaded()
+
+    with timing.stage('jsonify'):
+        return jsonify(cost_points)
+
+
+@app.route('/v2/matrix.json', methods=['GET'])
+def matrixv2():
+    # Process arguments
+    # sources (required!), destinations (default: the sources)
+    sources_input = request.args.get('sources', None)
+    if sources_input is None:
+        return 'Bad request - sources parameter is required.', 400
+    destinations_input = request.args.get('destinations', sources_input)
+    try:
+        sources = _coordinates(sources_input)
+        destinations = _coordinates(destinations_input)
+    except ValueError:
+        return ('Bad request - sources and destinations must be lists of '
+                'lat, lon numbers.', 400)
+    size = len(sources) * len(destinations)
+    if size > app.config['MATRIX_MAX_SIZE']:
+        return ('Bad request - at most {} sources x destinations per '
+                'matrix.'.format(app.config['MATRIX_MAX_SIZE']), 400)
+    try:
+        cost_params = costs.profile_params(request.args)
+    except ValueError as e:
+        return 'Bad request - {}'.format(e), 400
+
+    rows = matrix.cost_matrix(sources, destinations, **cost_params)
+    timeout = app.config['STATEMENT_TIMEOUT_ROUTING']
+
+    stream = request.args.get('stream')
+    if stream != 'true' and size <= app.config['MATRIX_STREAM_SIZE']:
+        try:
+            with db.statement_timeout(timeout):
+                matrix_rows = workers.run(list, rows)
+        except workers.Overloaded:
+            return _overloaded()
+        matrix_costs = [row_costs for row_costs, _ in matrix_rows]
+        matrix_distances = [row_distances for _, row_distances in matrix_rows]
+        return jsonify({'code': 'Ok',
+                        'costs': matrix_costs,
+                        'distances': matrix_distances})
+
+    # Large matrices: newline-delimited JSON, one line per source, sent as
+    # soon as each shortest-path tree is done. The rows are still computed
+    # on the worker pool, which the stream holds a place in until it ends.
+    try:
+        rows = workers.iterate(rows)
+    except workers.Overloaded:
+        return _overloaded()
+
+    def generate():
+        with db.statement_timeout(timeout):
+            for i, (row_costs, row_distances) in enumerate(rows):
+                yield json.dumps({'source': i,
+                                  'costs': row_costs,
+                                  'distances': row_distances}) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def _coordinates(text):
+    '''Parse a [lat1,lon1,lat2,lon2,...] argument into [lat, lon] pairs.
+
+    :raises ValueError: if it isn't a list of an even number of numbers.
+
+    '''
+    return _pairs(json.loads(text))
+
+
+def _pairs(values):
+    '''Turn a parsed [lat1,lon1,lat2,lon2,...] list into [lat, lon] pairs.
+
+    :raises ValueError: if it isn't a list of an even number of numbers.
+
+    '''
+    if not isinstance(values, list) or len(values) % 2:
+        raise ValueError('Expected a list of lat, lon pairs.')
+    try:
+        values = [float(value) for value in values]
+    except TypeError:
+        raise ValueError('Expected a list of lat, lon numbers.')
+    return [list(pair) for pair in zip(values[0::2], values[1::2])]
+
 
-    return jsonify(cost_points)
+def _overloaded():
+    '''503 response for when the routing workers are all busy.'''
+    response = Response('Service unavailable - too many routing requests, '
+                        'try again shortly.', status=503,
+                        mimetype='text/plain')
+    response.headers['Retry-After'] = str(app.config['ROUTING_RETRY_AFTER'])
+    return response
@@ -0,0 +1,207 @@
+'''Bounded worker pool for the routing endpoints.
+
+With ROUTING_WORKERS set, route, travelcost and matrix computations run on a
+shared pool of that many threads instead of the thread handling the request.
+At most ROUTING_QUEUE_SIZE more can wait for a free worker; requests beyond
+that are turned away at once (see `Overloaded`) instead of piling up behind
+slow searches. The database waits release the GIL, as do most of the NumPy
+operations of the in-memory engine, whose graph and caches are read-only or
+locked and so can be shared by all the workers.
+
+Worker calls run as if on the request's own thread: with its statement
+timeout, its request context and the snapshot it uses (see
+snapshot.current), and the stages they time are added to the request's
+timings (see timing.stage). Streamed responses hold a place in the pool
+until they are done (see `iterate`).
+
+With ROUTING_WORKERS=0 (the default) computations run inline, as before.'''
+import threading
+from concurrent import futures
+
+from flask import copy_current_request_context, g, has_request_context
+
+from accessmapapi import app, db
+
+
+class Overloaded(Exception):
+    '''Raised when the pool and its queue are full.'''
+    pass
+
+
+class Pool(object):
+    '''A thread pool that admits at most `workers + queue_size` calls at a
+    time.
+
+    :param workers: Number of worker threads.
+    :type workers: int
+    :param queue_size: Number of calls that may wait for a worker.
+    :type queue_size: int
+
+    '''
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+    def run(self, fn, *args, **kwargs):
+        '''Call fn(*args, **kwargs) on a worker and wait for its result.
+
+        :raises Overloaded: if the pool is full.
+
+        '''
+        self._acquire()
+        try:
+            return self._call(fn, *args, **kwargs)
+        finally:
+            self._release()
+
+    def iterate(self, iterable):
+        '''Iterate over `iterable` on the workers, one item per call, e.g.
+        to stream the rows of a response as they are computed. The iterator
+        holds a place in the pool until it is exhausted or closed.
+
+        :raises Overloaded: at once, if the pool is full.
+
+        '''
+        self._acquire()
+        return _Stream(self, iter(iterable))
+
+    def _acquire(self):
+        if not self._slots.acquire(False):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded()
+        with self._lock:
+            self.admitted += 1
+            self.in_flight += 1
+
+    def _call(self, fn, *args, **kwargs):
+        '''Run fn(*args, **kwargs) on a worker, as if on this thread.'''
+        timeout = db.current_statement_timeout()
+        in_request = has_request_context()
+        caller_g = g._get_current_object() if in_request else None
+        worker_g = {}
+
+        def call():
+            with db.statement_timeout(timeout):
+                if not in_request:
+                    return fn(*args, **kwargs)
+                worker_g['g'] = g._get_current_object()
+                if worker_g['g'] is not caller_g:
+                    # A new app context: pin the request's snapshot
+                    snapshot = caller_g.get('snapshot')
+                    if snapshot is not None:
+                        g.snapshot = snapshot
+                    g.timings = []
+                return fn(*args, **kwargs)
+
+        if in_request:
+            call = copy_current_request_context(call)
+        try:
+            return self.executor.submit(call).result()
+        finally:
+            worked = worker_g.get('g')
+            if worked is not None and worked is not caller_g:
+                if caller_g.get('snapshot') is None:
+                    caller_g.snapshot = worked.get('snapshot')
+                if worked.timings:
+                    if caller_g.get('timings') is None:
+                        caller_g.timings = []
+                    caller_g.timings.extend(worked.timings)
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers,
+                    'capacity': self.capacity,
+                    'in_flight': self.in_flight,
+                    'admitted': self.admitted,
+                    'rejected': self.rejected}
+
+
+class _Stream(object):
+    '''Iterator of Pool.iterate.'''
+    def __init__(self, pool, iterator):
+        self.pool = pool
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            raise StopIteration
+        try:
+            return self.pool._call(next, self.iterator)
+        except BaseException:
+            # Including StopIteration
+            self.close()
+            raise
+
+    def close(self):
+        if self.iterator is not None:
+            iterator = self.iterator
+            self.iterator = None
+            self.pool._release()
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def __del__(self):
+        self.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get():
+    global _pool
+    if _pool is None and app.config['ROUTING_WORKERS'] > 0:
+        with _pool_lock:
+            if _pool is None:
+                _pool = Pool(app.config['ROUTING_WORKERS'],
+                             app.config['ROUTING_QUEUE_SIZE'])
+    return _pool
+
+
+def run(fn, *args, **kwargs):
+    '''Call fn(*args, **kwargs) on the routing worker pool, or inline if
+    there is none.
+
+    :raises Overloaded: if the pool is full.
+
+    '''
+    pool = _get()
+    if pool is None:
+        return fn(*args, **kwargs)
+    return pool.run(fn, *args, **kwargs)
+
+
+def iterate(iterable):
+    '''Iterate over `iterable` on the routing worker pool (see
+    Pool.iterate), or inline if there is none.
+
+    :raises Overloaded: if the pool is full.
+
+    '''
+    pool = _get()
+    if pool is None:
+        return iter(iterable)
+    return pool.iterate(iterable)
+
+
+def stats():
+    '''State of the pool, and admitted and rejected call counts.'''
+    pool = _get()
+    if pool is None:
+        return {'workers': 0}
+    return pool.stats()
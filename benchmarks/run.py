@@ -0,0 +1,190 @@
+'''Benchmark the routing and layer endpoints on synthetic grid cities of
+growing size (see synthetic.City), through Flask's test client.
+
+    python -m benchmarks.run --sizes 10,20,40 --requests 200
+
+With `--backend memory` (the default) the city is loaded straight into the
+in-memory routing engine and no database is needed, so only the routing
+endpoints are run. With `--backend postgis` the city is written into the
+database given with `--database-url`, replacing its tables, and the layer
+endpoints are run as well; routing goes through pgRouting unless `--engine
+memory` is given. As a safeguard, that database may not be the app's own
+DATABASE_URL unless `--overwrite-app-database` is given too.
+
+For each size and endpoint, prints the p50/p95/p99 latency, throughput and
+the peak memory use of the process so far. Cities, request points and
+bboxes are generated from fixed seeds, so runs are repeatable.'''
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# The app's own database, which the postgis backend won't overwrite unless
+# asked to
+APP_DATABASE_URL = os.environ.get('DATABASE_URL')
+# The app needs a database URL to start, even when it doesn't use it
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/accessmap_bench')
+# Measure the work itself, not the result cache
+os.environ.setdefault('RESULT_CACHE', 'none')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory_mb():
+    '''Peak resident memory of the process, in MB (None if unknown).'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on OS X
+    if sys.platform == 'darwin':
+        return peak / 1e6
+    return peak / 1e3
+
+
+def load(city, backend, engine, landmark_count=0):
+    '''Make the app serve a city, dropping everything derived from the last
+    one.'''
+    # Imported here, so that main can choose the database first
+    from accessmapapi import app, db, snapshot
+    from accessmapapi.routing import landmarks
+
+    app.config['ROUTING_ENGINE'] = engine
+    if backend == 'postgis':
+        city.load_postgis(db.engine)
+    route_graph = None
+    if backend == 'memory':
+        route_graph = city.to_graph(app.config['COST_CACHE_SIZE'])
+        if landmark_count > 0:
+            landmarks.build_profiles(route_graph, landmark_count)
+    snapshot.install(snapshot.build(route_graph))
+
+
+def requests(city, count, backend):
+    '''The URLs to benchmark, per endpoint.'''
+    points = city.random_points(2 * count)
+    urls = {}
+    urls['route'] = [
+        '/v2/route.json?waypoints={}'.format(json.dumps(a + b))
+        for a, b in zip(points[0::2], points[1::2])]
+    urls['travelcost'] = [
+        '/v2/travelcost.json?lat={!r}&lon={!r}&contours=[300,600]'.format(
+            lat, lon) for lat, lon in points[:count]]
+    if backend == 'postgis':
+        bboxes = city.random_bboxes(count)
+        for layer in ('sidewalks', 'crossings', 'curbramps'):
+            urls[layer] = [
+                '/v2/{}.geojson?bbox={}'.format(
+                    layer, ','.join(repr(b) for b in bbox))
+                for bbox in bboxes]
+    return urls
+
+
+def measure(client, urls, warmup=5):
+    '''Request every URL in turn.
+
+    :returns: dict of latency percentiles (ms), throughput (requests per
+              second) and the number of failed requests.
+
+    '''
+    for url in urls[:warmup]:
+        client.get(url).data
+
+    latencies = []
+    failures = 0
+    for url in urls:
+        start = time.perf_counter()
+        response = client.get(url)
+        # Consume streamed bodies
+        response.data
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            failures += 1
+
+    latencies = np.array(latencies)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'p50': p50,
+            'p95': p95,
+            'p99': p99,
+            'throughput': len(latencies) / latencies.sum(),
+            'failures': failures}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,20,40',
+                        help='Intersections along each side of the grid, '
+                             'comma-separated (default: 10,20,40).')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests per endpoint and size (default: 200).')
+    parser.add_argument('--backend', choices=['memory', 'postgis'],
+                        default='memory',
+                        help='Where to load the city (default: memory).')
+    parser.add_argument('--database-url',
+                        help='Scratch PostGIS/pgRouting database to write '
+                             'the cities into, for the postgis backend. Its '
+                             'tables are replaced!')
+    parser.add_argument('--overwrite-app-database', action='store_true',
+                        help='Allow --database-url to be the app\'s own '
+                             'DATABASE_URL.')
+    parser.add_argument('--engine', choices=['memory', 'pgrouting'],
+                        help='Routing engine (default: memory for the '
+                             'memory backend, pgrouting for postgis).')
+    parser.add_argument('--landmarks', type=int, default=0,
+                        help='ALT landmarks per cost profile for the memory '
+                             'backend (default: 0, plain searches).')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the synthetic city (default: 0).')
+    args = parser.parse_args(argv)
+
+    engine = args.engine
+    if engine is None:
+        engine = 'memory' if args.backend == 'memory' else 'pgrouting'
+    if args.backend == 'memory' and engine != 'memory':
+        parser.error('the memory backend needs the memory routing engine.')
+    if args.backend == 'postgis':
+        if not args.database_url:
+            parser.error('the postgis backend needs --database-url, whose '
+                         'tables it replaces.')
+        if (args.database_url == APP_DATABASE_URL and
+                not args.overwrite_app_database):
+            parser.error('--database-url is the app\'s DATABASE_URL - give '
+                         '--overwrite-app-database to replace its tables '
+                         'anyway.')
+        if 'accessmapapi' in sys.modules:
+            parser.error('--database-url must be chosen before the app is '
+                         'imported.')
+        os.environ['DATABASE_URL'] = args.database_url
+
+    # Imported once the database is chosen: both start the app
+    from accessmapapi import app
+    from . import synthetic
+
+    client = app.test_client()
+    header = '{:>6} {:>7} {:>12} {:>9} {:>9} {:>9} {:>9} {:>6} {:>9}'.format(
+        'size', 'edges', 'endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s',
+        'fail', 'peak MB')
+    print(header)
+    for size in [int(s) for s in args.sizes.split(',')]:
+        city = synthetic.City(size, seed=args.seed)
+        load(city, args.backend, engine, args.landmarks)
+        urls = requests(city, args.requests, args.backend)
+        for endpoint in sorted(urls):
+            result = measure(client, urls[endpoint])
+            peak = peak_memory_mb()
+            print('{:>6} {:>7} {:>12} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} '
+                  '{:>6} {:>9}'.format(
+                      size, len(city.routing), endpoint, result['p50'],
+                      result['p95'], result['p99'], result['throughput'],
+                      result['failures'],
+                      '-' if peak is None else '{:.1f}'.format(peak)))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
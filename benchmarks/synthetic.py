@@ -0,0 +1,280 @@
+'''Synthetic sidewalk networks for benchmarking: a grid city of square blocks
+with a sidewalk along every side of every street, a crossing across every
+leg of every intersection and (most) corners with curb ramps.
+
+Every intersection has four corner nodes, offset from the street centerlines
+by half the street width. Sidewalks run between the corners of neighboring
+intersections and crossings between the corners of one intersection. Grades
+come from a smooth random elevation surface, so that hills are steep in one
+direction and flat across.'''
+import math
+
+import numpy as np
+
+from accessmapapi.routing import graph
+
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+
+class City(object):
+    '''The tables of a synthetic grid city, as lists of row dicts with their
+    geometries as lists of (lon, lat) coordinates.
+
+    :param size: Number of intersections along each side of the grid.
+    :type size: int
+    :param block: Length of a block, in meters.
+    :type block: float
+    :param street: Width of a street, in meters.
+    :type street: float
+    :param seed: Random seed - the same seed gives the same city.
+    :type seed: int
+    :param origin: (lon, lat) of the south-west intersection.
+    :type origin: tuple
+
+    '''
+    def __init__(self, size, block=100.0, street=15.0, seed=0,
+                 origin=(-122.33, 47.60)):
+        self.size = size
+        self.block = block
+        self.street = street
+        self.origin = origin
+        self.random = np.random.RandomState(seed)
+
+        self.vertices = []
+        self.routing = []
+        self.sidewalks = []
+        self.crossings = []
+        self.curbramps = []
+        self._build()
+
+    def _lonlat(self, x, y):
+        '''Convert meters east and north of the origin into (lon, lat).'''
+        lon0, lat0 = self.origin
+        lon = lon0 + x / (METERS_PER_DEGREE * math.cos(math.radians(lat0)))
+        lat = lat0 + y / METERS_PER_DEGREE
+        return [lon, lat]
+
+    def _elevation(self):
+        '''Random smooth elevation (meters) at every intersection.'''
+        n = self.size
+        x, y = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+        elevation = np.zeros((n, n))
+        for _ in range(3):
+            kx, ky = self.random.uniform(0.05, 0.4, size=2)
+            phase = self.random.uniform(0, 2 * math.pi)
+            amplitude = self.random.uniform(2, 8)
+            elevation += amplitude * np.sin(kx * x + ky * y + phase)
+        return elevation
+
+    def _build(self):
+        n = self.size
+        half = self.street / 2
+        elevation = self._elevation()
+
+        # Corner nodes: (i, j, dx, dy), dx and dy -1 or 1 for the side of
+        # the intersection the corner is on
+        corners = {}
+        for i in range(n):
+            for j in range(n):
+                for dx in (-1, 1):
+                    for dy in (-1, 1):
+                        node_id = len(self.vertices) + 1
+                        coords = self._lonlat(i * self.block + dx * half,
+                                              j * self.block + dy * half)
+                        corners[(i, j, dx, dy)] = node_id
+                        self.vertices.append({'id': node_id,
+                                              'coords': coords,
+                                              'elevation': elevation[i, j]})
+                        if self.random.uniform() < 0.85:
+                            self.curbramps.append({
+                                'id': len(self.curbramps) + 1,
+                                'coords': coords})
+
+        def add_edge(u, v, iscrossing, curbramps=True):
+            source = self.vertices[u - 1]
+            target = self.vertices[v - 1]
+            coords = [source['coords'], target['coords']]
+            length = self._length(coords)
+            grade = ((target['elevation'] - source['elevation']) /
+                     length if length else 0.0)
+            if iscrossing:
+                grade *= 0.2
+            edge = {'id': len(self.routing) + 1,
+                    'source': u,
+                    'target': v,
+                    'length': length,
+                    'grade': round(grade, 3),
+                    'iscrossing': int(iscrossing),
+                    'curbramps': bool(iscrossing and curbramps),
+                    'coords': coords}
+            self.routing.append(edge)
+            if iscrossing:
+                self.crossings.append({'id': len(self.crossings) + 1,
+                                       'coords': coords,
+                                       'grade': edge['grade'],
+                                       'curbramps': curbramps})
+            else:
+                self.sidewalks.append({'id': len(self.sidewalks) + 1,
+                                       'coords': coords,
+                                       'grade': edge['grade']})
+
+        for i in range(n):
+            for j in range(n):
+                # Sidewalks to the intersections to the east and north
+                if i + 1 < n:
+                    for dy in (-1, 1):
+                        add_edge(corners[(i, j, 1, dy)],
+                                 corners[(i + 1, j, -1, dy)], False)
+                if j + 1 < n:
+                    for dx in (-1, 1):
+                        add_edge(corners[(i, j, dx, 1)],
+                                 corners[(i, j + 1, dx, -1)], False)
+                # Crossings across each leg of the intersection
+                for a, b in (((-1, -1), (1, -1)), ((-1, 1), (1, 1)),
+                             ((-1, -1), (-1, 1)), ((1, -1), (1, 1))):
+                    curbramps = self.random.uniform() < 0.8
+                    add_edge(corners[(i, j) + a], corners[(i, j) + b], True,
+                             curbramps)
+
+    @staticmethod
+    def _length(coords):
+        (lon0, lat0), (lon1, lat1) = coords
+        dx = ((lon1 - lon0) * METERS_PER_DEGREE *
+              math.cos(math.radians((lat0 + lat1) / 2)))
+        dy = (lat1 - lat0) * METERS_PER_DEGREE
+        return math.hypot(dx, dy)
+
+    def bounds(self):
+        '''(west, south, east, north) of the city.'''
+        coords = np.array([v['coords'] for v in self.vertices])
+        west, south = coords.min(axis=0).tolist()
+        east, north = coords.max(axis=0).tolist()
+        return west, south, east, north
+
+    def random_points(self, count, seed=1):
+        '''Random [lat, lon] points within the city.'''
+        west, south, east, north = self.bounds()
+        random = np.random.RandomState(seed)
+        lons = random.uniform(west, east, count)
+        lats = random.uniform(south, north, count)
+        return [[lat, lon] for lat, lon in zip(lats.tolist(), lons.tolist())]
+
+    def random_bboxes(self, count, blocks=3, seed=2):
+        '''Random bboxes (west, south, east, north), a few blocks across.'''
+        west, south, east, north = self.bounds()
+        lon_span = (east - west) * min(1.0, blocks / max(self.size - 1, 1))
+        lat_span = (north - south) * min(1.0, blocks / max(self.size - 1, 1))
+        random = np.random.RandomState(seed)
+        bboxes = []
+        for _ in range(count):
+            w = random.uniform(west, east - lon_span)
+            s = random.uniform(south, north - lat_span)
+            bboxes.append((w, s, w + lon_span, s + lat_span))
+        return bboxes
+
+    def to_graph(self, cost_cache_size=8):
+        '''The in-memory routing graph of the city (see graph.Graph).'''
+        node_ids = [v['id'] for v in self.vertices]
+        node_coords = [v['coords'] for v in self.vertices]
+        geom_indptr = [0]
+        geom_coords = []
+        for edge in self.routing:
+            geom_coords += edge['coords']
+            geom_indptr.append(len(geom_coords))
+        return graph.Graph(
+            node_ids, node_coords,
+            [e['id'] for e in self.routing],
+            # Vertex ids are 1, 2, 3... so indices are ids - 1
+            [e['source'] - 1 for e in self.routing],
+            [e['target'] - 1 for e in self.routing],
+            [e['length'] for e in self.routing],
+            [e['grade'] for e in self.routing],
+            [e['iscrossing'] for e in self.routing],
+            [e['curbramps'] for e in self.routing],
+            geom_indptr,
+            np.array(geom_coords, dtype=np.float64).reshape(-1, 2),
+            cost_cache_size=cost_cache_size)
+
+    def load_postgis(self, engine):
+        '''Write the city into a PostGIS/pgRouting database, replacing the
+        sidewalks, crossings, curbramps, routing and routing_vertices_pgr
+        tables. Only use this on a database set aside for benchmarks (see
+        the --database-url option of run.py)!
+
+        :param engine: SQLAlchemy engine of the database.
+
+        '''
+        def linestring(coords):
+            return 'SRID=4326;LINESTRING({})'.format(
+                ', '.join('{!r} {!r}'.format(x, y) for x, y in coords))
+
+        def point(coords):
+            return 'SRID=4326;POINT({!r} {!r})'.format(*coords)
+
+        with engine.begin() as conn:
+            for table in ('sidewalks', 'crossings', 'curbramps', 'routing',
+                          'routing_vertices_pgr'):
+                conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+            conn.execute('''CREATE TABLE sidewalks (
+                                id integer PRIMARY KEY,
+                                geom geometry(LineString, 4326),
+                                grade numeric)''')
+            conn.execute('''CREATE TABLE crossings (
+                                id integer PRIMARY KEY,
+                                geom geometry(LineString, 4326),
+                                grade numeric,
+                                curbramps boolean)''')
+            conn.execute('''CREATE TABLE curbramps (
+                                id integer PRIMARY KEY,
+                                geom geometry(Point, 4326))''')
+            conn.execute('''CREATE TABLE routing (
+                                id integer PRIMARY KEY,
+                                source integer,
+                                target integer,
+                                length double precision,
+                                grade double precision,
+                                iscrossing integer,
+                                curbramps boolean,
+                                geom geometry(LineString, 4326))''')
+            conn.execute('''CREATE TABLE routing_vertices_pgr (
+                                id integer PRIMARY KEY,
+                                the_geom geometry(Point, 4326))''')
+
+            conn.execute(
+                'INSERT INTO sidewalks VALUES (%(id)s, %(geom)s, %(grade)s)',
+                [{'id': r['id'], 'geom': linestring(r['coords']),
+                  'grade': r['grade']} for r in self.sidewalks])
+            conn.execute(
+                'INSERT INTO crossings VALUES (%(id)s, %(geom)s, %(grade)s, '
+                '%(curbramps)s)',
+                [{'id': r['id'], 'geom': linestring(r['coords']),
+                  'grade': r['grade'], 'curbramps': r['curbramps']}
+                 for r in self.crossings])
+            conn.execute(
+                'INSERT INTO curbramps VALUES (%(id)s, %(geom)s)',
+                [{'id': r['id'], 'geom': point(r['coords'])}
+                 for r in self.curbramps])
+            conn.execute(
+                'INSERT INTO routing VALUES (%(id)s, %(source)s, %(target)s, '
+                '%(length)s, %(grade)s, %(iscrossing)s, %(curbramps)s, '
+                '%(geom)s)',
+                [{'id': r['id'], 'source': r['source'],
+                  'target': r['target'], 'length': r['length'],
+                  'grade': r['grade'], 'iscrossing': r['iscrossing'],
+                  'curbramps': r['curbramps'],
+                  'geom': linestring(r['coords'])} for r in self.routing])
+            conn.execute(
+                'INSERT INTO routing_vertices_pgr VALUES (%(id)s, %(geom)s)',
+                [{'id': r['id'], 'geom': point(r['coords'])}
+                 for r in self.vertices])
+
+            for table in ('sidewalks', 'crossings', 'curbramps', 'routing'):
+                conn.execute('CREATE INDEX {0}_geom_idx ON {0} '
+                             'USING GIST (geom)'.format(table))
+            conn.execute('CREATE INDEX routing_vertices_pgr_geom_idx '
+                         'ON routing_vertices_pgr USING GIST (the_geom)')
+            for table in ('sidewalks', 'crossings', 'curbramps', 'routing',
+                          'routing_vertices_pgr'):
+                conn.execute('ANALYZE {}'.format(table))
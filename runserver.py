@@ -12,4 +12,6 @@ if __name__ == '__main__':
     except ValueError:
         PORT = 5555
     print(HOST, PORT)
-    app.run(HOST, PORT)
+    # One thread per request, so that requests waiting on the routing
+    # workers (see accessmapapi.workers) don't hold up the others
+    app.run(HOST, PORT, threaded=True)